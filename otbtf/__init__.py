@@ -22,16 +22,20 @@ OTBTF python module
 """
 import pkg_resources
 try:
-    from otbtf.utils import read_as_np_arr, gdal_open  # noqa
+    from otbtf.utils import read_as_np_arr, read_windows, read_patches, \
+        extract_patches, grid_positions, read_points, write_patches_image, \
+        retile_patches_image, gdal_open  # noqa
     from otbtf.dataset import Buffer, PatchesReaderBase, PatchesImagesReader, \
-        IteratorBase, RandomIterator, Dataset, DatasetFromPatchesImages  # noqa
+        ArrayPatchesReader, ScenePatchesReader, MaskedWindowsReader, \
+        PatchesReaderView, TFRecordsReader, IteratorBase, RandomIterator, \
+        InfiniteIterator, Dataset, DatasetFromPatchesImages  # noqa
 except ImportError:
     print(
         "Warning: otbtf.utils and otbtf.dataset were not imported. "
         "Using OTBTF without GDAL."
     )
 
-from otbtf.tfrecords import TFRecords  # noqa
+from otbtf.tfrecords import TFRecords, SavedDataset  # noqa
 from otbtf.model import ModelBase  # noqa
 from otbtf import layers, ops  # noqa
 __version__ = pkg_resources.require("otbtf")[0].version
@@ -26,14 +26,21 @@ OTBTF framework.
 """
 import logging
 import multiprocessing
+import os
+import queue
+import struct
 import threading
 import time
+import weakref
+import zlib
 from abc import ABC, abstractmethod
+from functools import partial
 
-from typing import Any, List, Dict, Type, Callable
+from typing import Any, List, Dict, Type, Callable, Sequence, Tuple
 import numpy as np
 import tensorflow as tf
 
+import otbtf.ops
 import otbtf.tfrecords
 import otbtf.utils
 
@@ -82,6 +89,9 @@ class PatchesReaderBase(ABC):
     Base class for patches delivery
     """
 
+    # Block cache used by the reader, if any (see `otbtf.utils.BlockCache`)
+    cache = None
+
     @abstractmethod
     def get_sample(self, index: int) -> Any:
         """
@@ -130,6 +140,153 @@ class PatchesReaderBase(ABC):
 
         """
 
+    def get_samples(self, indices: Sequence[int]) -> List[Any]:
+        """
+        Return multiple samples. Readers can override this method to read
+        consecutive samples in large blocks rather than one by one.
+
+        Params:
+            indices: samples indices
+
+        Returns:
+            list of samples, in the order of `indices`
+        """
+        return [self.get_sample(index=int(index)) for index in indices]
+
+    def reopen(self):
+        """
+        Re-open the resources (e.g. files) used by the reader. This is called
+        in the child processes of the parallel writers (see
+        `otbtf.tfrecords.TFRecords.ds2tfrecord()`), so that they do not share
+        file handles with the parent process. Does nothing by default.
+        """
+
+    def get_cache_hit_rate(self) -> float:
+        """
+        Returns:
+            the ratio of the blocks requests served from the block cache of
+            the reader, or None when the reader does not use a cache
+        """
+        return self.cache.hit_rate if self.cache is not None else None
+
+    def get_identity(self) -> Any:
+        """
+        Returns the identity of the samples delivered by the reader, used to
+        name the cache files of the preprocessed samples (see
+        `Dataset.get_tf_dataset()`). By default, this is the checksum of all
+        the samples. The readers of files override this method, to use the
+        signatures of the files instead (see `otbtf.utils.file_signature()`).
+
+        Returns:
+            JSON serializable identity
+        """
+        crc = 0
+        for start in range(0, self.get_size(), 256):
+            crc = _samples_crc32(self.get_samples(
+                range(start, min(start + 256, self.get_size()))
+            ), crc)
+        return crc
+
+    def _get_stats_sample_by_sample(self, keys: List[str]) -> dict:
+        """
+        Compute the statistics of the given sources, iterating over all
+        samples with `get_sample()`. Nothing else than one sample is kept in
+        memory.
+
+        Params:
+            keys: keys of the sources for which statistics are computed
+
+        Returns:
+            statistics dict (see `get_stats()`)
+
+        """
+        accumulator = StatsAccumulator(keys=keys)
+        for index in range(self.get_size()):
+            accumulator.add(self.get_sample(index=index))
+        return accumulator.get_stats()
+
+
+def _samples_crc32(samples: Sequence[Dict[str, Any]], crc: int = 0) -> int:
+    """
+    Returns the CRC32 checksum of the arrays of some samples
+    """
+    for sample in samples:
+        for key in sorted(sample):
+            crc = zlib.crc32(
+                np.ascontiguousarray(sample[key]).tobytes(), crc
+            )
+    return crc
+
+
+class StatsAccumulator:
+    """
+    Accumulates the statistics of the sources (min, max, mean and std of
+    each channel), sample by sample.
+    """
+
+    def __init__(self, keys: List[str]):
+        """
+        Params:
+            keys: keys of the sources for which statistics are computed
+
+        """
+        self.keys = keys
+        self.count = 0
+        self._maxs, self._mins, self._sums, self._sqsums = {}, {}, {}, {}
+
+    def add(self, sample: Dict[str, np.ndarray]):
+        """
+        Add one sample.
+
+        Params:
+            sample: the sample
+
+        """
+        axis = (0, 1)  # (row, col)
+        self.count += 1
+        for src_key in self.keys:
+            # float64, so that the squares of integer patches don't overflow
+            np_arr = np.asarray(sample[src_key], dtype=np.float64)
+            if src_key not in self._sums:
+                nb_of_channels = np_arr.shape[-1]
+                self._maxs[src_key] = np.full(nb_of_channels, -float("inf"))
+                self._mins[src_key] = np.full(nb_of_channels, float("inf"))
+                self._sums[src_key] = np.zeros(nb_of_channels)
+                self._sqsums[src_key] = np.zeros(nb_of_channels)
+            rnumel = 1.0 / float(np_arr.shape[0] * np_arr.shape[1])
+            self._mins[src_key] = np.minimum(
+                np.amin(np_arr, axis=axis).flatten(), self._mins[src_key]
+            )
+            self._maxs[src_key] = np.maximum(
+                np.amax(np_arr, axis=axis).flatten(), self._maxs[src_key]
+            )
+            self._sums[src_key] += rnumel * np.sum(
+                np_arr, axis=axis
+            ).flatten()
+            self._sqsums[src_key] += rnumel * np.sum(
+                np.square(np_arr), axis=axis
+            ).flatten()
+
+    def get_stats(self) -> dict:
+        """
+        Returns:
+            statistics dict (see `PatchesReaderBase.get_stats()`)
+        """
+        rsize = 1.0 / float(self.count)
+        return {
+            src_key: {
+                "min": self._mins[src_key],
+                "max": self._maxs[src_key],
+                "mean": rsize * self._sums[src_key],
+                "std": np.sqrt(
+                    rsize * self._sqsums[src_key] - np.square(
+                        rsize * self._sums[src_key]
+                    )
+                )
+            }
+            for src_key in self._sums
+        }
+
 
 class PatchesImagesReader(PatchesReaderBase):
     """
@@ -158,7 +315,9 @@ class PatchesImagesReader(PatchesReaderBase):
             self,
             filenames_dict: Dict[str, List[str]],
             use_streaming: bool = False,
-            scalar_dict: Dict[str, List[Any]] = None
+            scalar_dict: Dict[str, List[Any]] = None,
+            cache: otbtf.utils.BlockCache = None,
+            block_size: int = 256
     ):
         """
         Params:
@@ -186,12 +345,19 @@ class PatchesImagesReader(PatchesReaderBase):
                     ...
                     scalar_nameM: [value1, ..., valueN]
                 }
+            cache: Optional, block cache used when streaming is used, e.g. an
+                `otbtf.utils.DiskBlockCache` to decode heavily compressed
+                patches-images (JPEG2000...) only once over all the epochs.
+                The patches-images are then read by blocks of patches (see
+                `otbtf.utils.CachedRaster`).
+            block_size: size of the cached blocks, in rows of pixels
 
         """
 
         assert len(filenames_dict.values()) > 0
 
         # gdal_ds dict
+        self.filenames_dict = filenames_dict
         self.gdal_ds = {
             key: [otbtf.utils.gdal_open(src_fn) for src_fn in src_fns]
             for key, src_fns in filenames_dict.items()
@@ -199,6 +365,9 @@ class PatchesImagesReader(PatchesReaderBase):
 
         # streaming on/off
         self.use_streaming = use_streaming
+        self.cache = cache if use_streaming else None
+        self.block_size = block_size
+        self.rasters = self._open_cached_rasters()
 
         # Scalar dict (e.g. for metadata)
         # If the scalars are not numpy.ndarray, convert them
@@ -258,6 +427,51 @@ class PatchesImagesReader(PatchesReaderBase):
                 for src_key, src_ds in self.gdal_ds.items()
             }
 
+    def reopen(self):
+        """
+        Re-open the GDAL datasets. Only needed when streaming is used, since
+        the patches are otherwise already in memory.
+        """
+        if self.use_streaming:
+            self.gdal_ds = {
+                key: [otbtf.utils.gdal_open(src_fn) for src_fn in src_fns]
+                for key, src_fns in self.filenames_dict.items()
+            }
+            self.rasters = self._open_cached_rasters()
+
+    def _open_cached_rasters(self):
+        """
+        Returns the cached rasters of the patches-images, or None when no
+        block cache is used
+        """
+        if self.cache is None:
+            return None
+        return {
+            key: [
+                otbtf.utils.CachedRaster(
+                    src_fn, cache=self.cache, block_size=self.block_size
+                )
+                for src_fn in src_fns
+            ]
+            for key, src_fns in self.filenames_dict.items()
+        }
+
+    def _read_extracts(self, src_key, i, offset, count):
+        """
+        Read `count` consecutive patches of the patches-image `i` of one
+        source, through the block cache when it is used
+        """
+        if self.rasters is None:
+            return self._read_extracts_as_np_arr(
+                self.gdal_ds[src_key][i], offset, count
+            )
+        raster = self.rasters[src_key][i]
+        psz = raster.width
+        buffer = raster.read(
+            otbtf.utils.Window(0, offset * psz, psz, count * psz)
+        )
+        return buffer.reshape((count, psz, psz, buffer.shape[2]))
+
     def _get_ds_and_offset_from_index(self, index):
         offset = index
         idx = None
@@ -284,6 +498,20 @@ class PatchesImagesReader(PatchesReaderBase):
             return np.transpose(buffer, axes=(1, 2, 0))
         return np.expand_dims(buffer, axis=2)
 
+    @staticmethod
+    def _read_extracts_as_np_arr(gdal_ds, offset, count):
+        assert gdal_ds is not None
+        psz = gdal_ds.RasterXSize
+        yoff = int(offset * psz)
+        assert yoff + count * psz <= gdal_ds.RasterYSize
+        buffer = gdal_ds.ReadAsArray(0, yoff, psz, count * psz)
+        if len(buffer.shape) == 3:
+            # multi-band raster
+            buffer = np.transpose(buffer, axes=(1, 2, 0))
+        else:
+            buffer = np.expand_dims(buffer, axis=2)
+        return buffer.reshape((count, psz, psz, buffer.shape[2]))
+
     def get_sample(self, index: int) -> Dict[str, np.array]:
         """
         Return one sample of the dataset.
@@ -314,6 +542,11 @@ class PatchesImagesReader(PatchesReaderBase):
                 src_key: arr[index, :, :, :]
                 for src_key, arr in self.patches_buffer.items()
             })
+        elif self.rasters is not None:
+            res.update({
+                src_key: self._read_extracts(src_key, i, offset, 1)[0]
+                for src_key in self.gdal_ds
+            })
         else:
             res.update({
                 src_key: self._read_extract_as_np_arr(
@@ -323,6 +556,50 @@ class PatchesImagesReader(PatchesReaderBase):
             })
         return res
 
+    def get_samples(self, indices: Sequence[int]) -> List[Dict[str, np.array]]:
+        """
+        Return multiple samples of the dataset. When streaming is used, the
+        runs of consecutive indices that belong to the same patches image
+        are read in one single block.
+
+        Params:
+            indices: the samples indices. Must be in the [0, self.size)
+                range.
+
+        Returns:
+            list of samples (see `get_sample()`), in the order of `indices`
+
+        """
+        if not self.use_streaming:
+            return super().get_samples(indices=indices)
+
+        indices = [int(index) for index in indices]
+        samples = []
+        pos = 0
+        while pos < len(indices):
+            assert 0 <= indices[pos] < self.size
+            i, offset = self._get_ds_and_offset_from_index(indices[pos])
+            count = 1
+            while pos + count < len(indices) and \
+                    indices[pos + count] == indices[pos] + count and \
+                    offset + count < self.ds_sizes[i]:
+                count += 1
+            blocks = {
+                src_key: self._read_extracts(src_key, i, offset, count)
+                for src_key in self.gdal_ds
+            }
+            for j in range(count):
+                sample = {
+                    src_key: scalar[i]
+                    for src_key, scalar in self.scalar_dict.items()
+                }
+                sample.update({
+                    src_key: block[j] for src_key, block in blocks.items()
+                })
+                samples.append(sample)
+            pos += count
+        return samples
+
     def get_stats(self) -> Dict[str, List[float]]:
         """
         Compute some statistics for each source.
@@ -345,51 +622,27 @@ class PatchesImagesReader(PatchesReaderBase):
                 for src_key, patches_buffer in self.patches_buffer.items()
             }
         else:
-            axis = (0, 1)  # (row, col)
-
-            def _filled(value):
-                return {
-                    src_key: value * np.ones((self.nb_of_channels[src_key]))
-                    for src_key in self.gdal_ds}
-
-            _maxs = _filled(0.0)
-            _mins = _filled(float("inf"))
-            _sums = _filled(0.0)
-            _sqsums = _filled(0.0)
-            for index in range(self.size):
-                sample = self.get_sample(index=index)
-                for src_key, np_arr in sample.items():
-                    rnumel = 1.0 / float(np_arr.shape[0] * np_arr.shape[1])
-                    _mins[src_key] = np.minimum(
-                        np.amin(np_arr, axis=axis).flatten(), _mins[src_key]
-                    )
-                    _maxs[src_key] = np.maximum(
-                        np.amax(np_arr, axis=axis).flatten(), _maxs[src_key]
-                    )
-                    _sums[src_key] += rnumel * np.sum(
-                        np_arr, axis=axis
-                    ).flatten()
-                    _sqsums[src_key] += rnumel * np.sum(
-                        np.square(np_arr), axis=axis
-                    ).flatten()
-
-            rsize = 1.0 / float(self.size)
-            stats = {
-                src_key: {
-                    "min": _mins[src_key],
-                    "max": _maxs[src_key],
-                    "mean": rsize * _sums[src_key],
-                    "std": np.sqrt(
-                        rsize * _sqsums[src_key] - np.square(
-                            rsize * _sums[src_key]
-                        )
-                    )
-                }
-                for src_key in self.gdal_ds
-            }
+            stats = self._get_stats_sample_by_sample(keys=list(self.gdal_ds))
         logging.info("Stats: %s", stats)
         return stats
 
+    def get_identity(self) -> Any:
+        """
+        Returns:
+            the identity of the samples: the signatures of the
+            patches-images, and the checksum of the scalars
+        """
+        return {
+            "files": {
+                src_key: [
+                    [src_fn, otbtf.utils.file_signature(src_fn)]
+                    for src_fn in src_fns
+                ]
+                for src_key, src_fns in self.filenames_dict.items()
+            },
+            "scalars_crc32": _samples_crc32([self.scalar_dict])
+        }
+
     def get_size(self) -> int:
         """
         Returns:
@@ -398,145 +651,1240 @@ class PatchesImagesReader(PatchesReaderBase):
         return self.size
 
 
-class IteratorBase(ABC):
-    """
-    Base class for iterators
+class ArrayPatchesReader(PatchesReaderBase):
     """
+    This class provides a read access to patches stored in numpy arrays, for
+    instance extracted in memory from full rasters with
+    `otbtf.utils.extract_patches()` or `otbtf.utils.read_patches()`, without
+    writing patches images.
 
-    @abstractmethod
-    def __init__(self, patches_reader: PatchesReaderBase):
-        pass
-
+    See `PatchesReaderBase`.
 
-class RandomIterator(IteratorBase):
-    """
-    Pick a random number in the [0, handler.size) range.
     """
 
-    def __init__(self, patches_reader: PatchesReaderBase):
+    def __init__(self, arrays_dict: Dict[str, np.ndarray]):
         """
         Params:
-            patches_reader: patches reader
+            arrays_dict: A dict of arrays of patches, of shape
+                (n, psz_y, psz_x, nb_channels), with the same number of
+                patches n for each source:
+                {
+                    src_name1: np.array((n, psz_y_1, psz_x_1, nb_ch_1)),
+                    ...
+                    src_nameM: np.array((n, psz_y_M, psz_x_M, nb_ch_M))
+                }
+
         """
-        super().__init__(patches_reader=patches_reader)
-        self.indices = np.arange(0, patches_reader.get_size())
-        self._shuffle()
-        self.count = 0
+        assert len(arrays_dict) > 0
+        nb_of_patches = {
+            src_key: len(arr) for src_key, arr in arrays_dict.items()
+        }
+        if len(set(nb_of_patches.values())) != 1:
+            raise Exception(
+                "Sources must have the same number of patches! "
+                f"Number of patches: {nb_of_patches}"
+            )
+        self.patches_buffer = arrays_dict
+        self.size = len(next(iter(arrays_dict.values())))
 
-    def __iter__(self):
-        return self
+    def get_sample(self, index: int) -> Dict[str, np.array]:
+        """
+        Return one sample of the dataset.
 
-    def __next__(self):
-        current_index = self.indices[self.count]
-        if self.count < len(self.indices) - 1:
-            self.count += 1
-        else:
-            self._shuffle()
-            self.count = 0
-        return current_index
+        Params:
+            index: the sample index. Must be in the [0, self.size) range.
 
-    def _shuffle(self):
-        np.random.shuffle(self.indices)
+        Returns:
+            The sample (see `PatchesImagesReader.get_sample()`)
 
+        """
+        assert 0 <= index < self.size
+        return {
+            src_key: arr[index] for src_key, arr in self.patches_buffer.items()
+        }
 
-class Dataset:
-    """
-    Handles the "mining" of patches.
-    This class has a thread that extract tuples from the readers, while
-    ensuring the access of already gathered tuples.
+    def get_samples(self, indices: Sequence[int]) -> List[Dict[str, np.array]]:
+        """
+        Return multiple samples of the dataset, gathered at once from the
+        arrays.
 
-    See `PatchesReaderBase` and `Buffer`
+        Params:
+            indices: the samples indices
 
-    """
+        Returns:
+            list of samples, in the order of `indices`
 
-    def __init__(
-            self,
-            patches_reader: PatchesReaderBase = None,
-            buffer_length: int = 128,
-            iterator_cls: Type[IteratorBase] = RandomIterator,
-            max_nb_of_samples: int = None
-    ):
         """
-        Params:
-            patches_reader: The patches reader instance
-            buffer_length: The number of samples that are stored in the
-                buffer
-            iterator_cls: The iterator class used to generate the sequence of
-                patches indices.
-            max_nb_of_samples: Optional, max number of samples to consider
+        indices = np.asarray(indices, dtype=np.int64)
+        blocks = {
+            src_key: arr[indices]
+            for src_key, arr in self.patches_buffer.items()
+        }
+        return [
+            {src_key: block[j] for src_key, block in blocks.items()}
+            for j in range(len(indices))
+        ]
 
+    def get_stats(self) -> Dict[str, List[float]]:
         """
-        # patches reader
-        self.patches_reader = patches_reader
+        Compute some statistics for each source, directly in memory.
 
-        # If necessary, limit the nb of samples
-        logging.info('Number of samples: %s', self.patches_reader.get_size())
-        if max_nb_of_samples and \
-                self.patches_reader.get_size() > max_nb_of_samples:
-            logging.info('Reducing number of samples to %s', max_nb_of_samples)
-            self.size = max_nb_of_samples
-        else:
-            self.size = self.patches_reader.get_size()
+        Returns:
+             statistics dict
+        """
+        logging.info("Computing stats")
+        axis = (0, 1, 2)  # (row, col)
+        stats = {
+            src_key: {
+                "min": np.amin(patches_buffer, axis=axis),
+                "max": np.amax(patches_buffer, axis=axis),
+                "mean": np.mean(patches_buffer, axis=axis),
+                "std": np.std(patches_buffer, axis=axis)
+            }
+            for src_key, patches_buffer in self.patches_buffer.items()
+        }
+        logging.info("Stats: %s", stats)
+        return stats
 
-        # iterator
-        self.iterator = iterator_cls(patches_reader=self.patches_reader)
+    def get_identity(self) -> Any:
+        """
+        Returns:
+            the identity of the samples: the checksum of the arrays
+        """
+        return _samples_crc32([self.patches_buffer])
 
-        # Get patches sizes and type, of the first sample of the first tile
-        self.output_types = {}
-        self.output_shapes = {}
-        one_sample = self.patches_reader.get_sample(index=0)
-        for src_key, np_arr in one_sample.items():
-            self.output_shapes[src_key] = np_arr.shape
-            self.output_types[src_key] = tf.dtypes.as_dtype(np_arr.dtype)
+    def get_size(self) -> int:
+        """
+        Returns:
+            size
+        """
+        return self.size
 
-        logging.info("output_types: %s", self.output_types)
-        logging.info("output_shapes: %s", self.output_shapes)
 
-        # buffers
-        if self.size <= buffer_length:
-            buffer_length = self.size
-        self.miner_buffer = Buffer(buffer_length)
-        self.mining_lock = multiprocessing.Lock()
-        self.consumer_buffer = Buffer(buffer_length)
-        self.consumer_buffer_pos = 0
-        self.tot_wait = 0
-        self.miner_thread = self._summon_miner_thread()
-        self.read_lock = multiprocessing.Lock()
-        self._dump()
+class ScenePatchesReader(PatchesReaderBase):
+    """
+    This class provides a read access to patches read on the fly from full
+    scenes, at given geographic positions (e.g. the points produced by the
+    OTBTF "PatchesSelection" application), without extracting patches
+    images.
+
+    Each source is one raster, and the sources can have different
+    resolutions: the patches of all sources are centered on the same
+    geographic position, like the patches of the "PatchesExtraction"
+    application (see `otbtf.utils.CachedRaster.patches_origins()`). The
+    rasters are read by blocks aligned on their native blocks layout,
+    through a block cache shared by all sources (see
+    `otbtf.utils.CachedRaster`), so that neighbouring patches are decoded
+    only once.
 
-        # Prepare tf dataset for one epoch
-        self.tf_dataset = tf.data.Dataset.from_generator(
-            self._generator,
-            output_types=self.output_types,
-            output_shapes=self.output_shapes
-        ).repeat(1)
+    See `PatchesReaderBase`.
 
-    def to_tfrecords(
+    """
+
+    def __init__(
             self,
-            output_dir: str,
-            n_samples_per_shard: int = 100,
-            drop_remainder: bool = True
+            filenames_dict: Dict[str, str],
+            positions: np.ndarray,
+            patches_sizes: Dict[str, int],
+            scalar_dict: Dict[str, Sequence[Any]] = None,
+            cache: otbtf.utils.BlockCache = None,
+            block_size: int = 256
     ):
         """
-        Save the dataset into TFRecord files
-
         Params:
-            output_dir: output directory
-            n_samples_per_shard: number of samples per TFRecord file
-            drop_remainder: drop remaining samples
-
-        """
-        tfrecord = otbtf.tfrecords.TFRecords(output_dir)
-        tfrecord.ds2tfrecord(
-            self,
-            n_samples_per_shard=n_samples_per_shard,
-            drop_remainder=drop_remainder
-        )
+            filenames_dict: raster of each source, e.g.
+                {"xs_10m": "s2_10m.tif", "xs_20m": "s2_20m.tif"}
+            positions: positions of the patches centers, as an array of
+                shape (n, 2) of (x, y) coordinates in the coordinate
+                reference system of the rasters (see
+                `otbtf.utils.read_points()`)
+            patches_sizes: patch size of each source, in pixels, e.g.
+                {"xs_10m": 64, "xs_20m": 32}
+            scalar_dict: (optional) a dict of scalars, with one value per
+                position, e.g. the class of each point
+            cache: Optional, block cache shared by the sources (e.g. an
+                `otbtf.utils.DiskBlockCache`). When not set, a new in-memory
+                cache is created.
+            block_size: size of the cached blocks, in pixels
+
+        Positions for which the patch of one source is not entirely inside
+        its raster are discarded.
 
-    def get_stats(self) -> Dict[str, List[float]]:
         """
-        Compute dataset statistics
-
+        assert len(filenames_dict) > 0
+        self.cache = cache if cache is not None else otbtf.utils.BlockCache()
+        self.rasters = {
+            src_key: otbtf.utils.CachedRaster(
+                filename, cache=self.cache, block_size=block_size
+            )
+            for src_key, filename in filenames_dict.items()
+        }
+        self.patches_sizes = patches_sizes
+
+        # Upper-left pixel of the patches, for each source
+        self.origins = {}
+        valid = np.ones(len(positions), dtype=bool)
+        for src_key, raster in self.rasters.items():
+            psz = patches_sizes[src_key]
+            origins = raster.patches_origins(positions, psz)
+            valid &= np.all(origins >= 0, axis=1) & \
+                (origins[:, 0] <= raster.height - psz) & \
+                (origins[:, 1] <= raster.width - psz)
+            self.origins[src_key] = origins
+        if not np.all(valid):
+            logging.warning(
+                "%s positions are discarded, since their patches are not "
+                "entirely inside the rasters", np.count_nonzero(~valid)
+            )
+        self.origins = {
+            src_key: origins[valid]
+            for src_key, origins in self.origins.items()
+        }
+        self.scalar_dict = {
+            key: np.asarray(scalars)[valid]
+            for key, scalars in scalar_dict.items()
+        } if scalar_dict else {}
+        self.size = int(np.count_nonzero(valid))
+
+        # Block of the first source containing each patch, used to group
+        # the reads
+        src_key_0 = list(self.rasters)[0]  # first key
+        raster_0 = self.rasters[src_key_0]
+        self.blocks_ids = raster_0.block_id(
+            self.origins[src_key_0][:, 0], self.origins[src_key_0][:, 1]
+        )
+
+    def reopen(self):
+        """
+        Re-open the GDAL datasets of the sources
+        """
+        for raster in self.rasters.values():
+            raster.reopen()
+
+    def get_sample(self, index: int) -> Dict[str, np.array]:
+        """
+        Return one sample of the dataset.
+
+        Params:
+            index: the sample index. Must be in the [0, self.size) range.
+
+        Returns:
+            The sample (see `PatchesImagesReader.get_sample()`)
+
+        """
+        assert 0 <= index < self.size
+        sample = {
+            key: scalars[index] for key, scalars in self.scalar_dict.items()
+        }
+        for src_key, raster in self.rasters.items():
+            row, col = self.origins[src_key][index]
+            psz = self.patches_sizes[src_key]
+            sample[src_key] = raster.read(
+                otbtf.utils.Window(int(col), int(row), psz, psz)
+            )
+        return sample
+
+    def get_samples(self, indices: Sequence[int]) -> List[Dict[str, np.array]]:
+        """
+        Return multiple samples of the dataset. The samples are read grouped
+        by blocks, to maximize the block cache hits.
+
+        Params:
+            indices: the samples indices
+
+        Returns:
+            list of samples, in the order of `indices`
+
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        order = np.argsort(self.blocks_ids[indices], kind="stable")
+        samples = [None] * len(indices)
+        for pos in order:
+            samples[pos] = self.get_sample(index=int(indices[pos]))
+        return samples
+
+    def get_stats(self) -> Dict[str, List[float]]:
+        """
+        Compute some statistics for each source, sample by sample.
+
+        Returns:
+             statistics dict
+        """
+        logging.info("Computing stats")
+        stats = self._get_stats_sample_by_sample(keys=list(self.rasters))
+        logging.info("Stats: %s", stats)
+        return stats
+
+    def get_identity(self) -> Any:
+        """
+        Returns:
+            the identity of the samples: the signatures of the rasters, the
+            patches sizes, and the checksums of the patches origins and of
+            the scalars
+        """
+        return {
+            "files": {
+                src_key: [
+                    raster.filename,
+                    otbtf.utils.file_signature(raster.filename)
+                ]
+                for src_key, raster in self.rasters.items()
+            },
+            "patches_sizes": self.patches_sizes,
+            "origins_crc32": _samples_crc32([self.origins]),
+            "scalars_crc32": _samples_crc32([self.scalar_dict])
+        }
+
+    def get_size(self) -> int:
+        """
+        Returns:
+            size
+        """
+        return self.size
+
+
+class MaskedWindowsReader(PatchesReaderBase):
+    """
+    This class provides an unlimited number of patches, drawn at random
+    positions in full scenes wherever a mask is valid (e.g. for
+    self-supervised pretraining), without precomputing any position.
+
+    The mask is indexed once, block by block: the index only stores the
+    number of valid pixels of each block of the mask, hence it stays small
+    for very large scenes. The center of the patches is then drawn
+    uniformly among the valid pixels of the mask, and the pixel of the
+    sample `index` is always the same for a given `seed`: any non-negative
+    index is a valid one (see `InfiniteIterator`).
+
+    Like in `ScenePatchesReader`, the sources can have different
+    resolutions and are read through a shared block cache.
+
+    See `PatchesReaderBase`.
+
+    """
+
+    def __init__(
+            self,
+            filenames_dict: Dict[str, str],
+            mask_filename: str,
+            patches_sizes: Dict[str, int],
+            samples_per_epoch: int = 10000,
+            seed: int = None,
+            max_attempts: int = 100,
+            cache: otbtf.utils.BlockCache = None,
+            block_size: int = 256
+    ):
+        """
+        Params:
+            filenames_dict: raster of each source, e.g.
+                {"xs_10m": "s2_10m.tif", "xs_20m": "s2_20m.tif"}
+            mask_filename: mask raster. The pixels of its first band that
+                are not 0 are valid patches centers.
+            patches_sizes: patch size of each source, in pixels, e.g.
+                {"xs_10m": 64, "xs_20m": 32}
+            samples_per_epoch: number of samples returned by `get_size()`,
+                i.e. the number of samples of one epoch of `Dataset`
+            seed: Optional, seed of the random positions. When not set, a
+                random seed is used.
+            max_attempts: maximum number of positions drawn for one sample.
+                Positions for which the patch of one source is not entirely
+                inside its raster are drawn again.
+            cache: Optional, block cache shared by the sources and the mask
+                (e.g. an `otbtf.utils.DiskBlockCache`). When not set, a new
+                in-memory cache is created.
+            block_size: size of the cached blocks, in pixels
+
+        """
+        assert len(filenames_dict) > 0
+        assert samples_per_epoch > 0
+        self.cache = cache if cache is not None else otbtf.utils.BlockCache()
+        self.rasters = {
+            src_key: otbtf.utils.CachedRaster(
+                filename, cache=self.cache, block_size=block_size
+            )
+            for src_key, filename in filenames_dict.items()
+        }
+        self.mask = otbtf.utils.CachedRaster(
+            mask_filename, cache=self.cache, block_size=block_size
+        )
+        self.patches_sizes = patches_sizes
+        self.samples_per_epoch = samples_per_epoch
+        self.seed = seed if seed is not None else \
+            np.random.SeedSequence().entropy
+        self.max_attempts = max_attempts
+
+        # Index of the mask: number of valid pixels of each block
+        logging.info("Indexing mask %s", mask_filename)
+        blocks_ids, counts = [], []
+        for core, _, np_arr in otbtf.utils.read_windows(
+                self.mask.gdal_ds, block_size=block_size
+        ):
+            count = np.count_nonzero(np_arr[:, :, 0])
+            if count:
+                blocks_ids.append(self.mask.block_id(core.y_off, core.x_off))
+                counts.append(count)
+        if not counts:
+            raise Exception(f"The mask {mask_filename} has no valid pixel")
+        self.blocks_ids = np.asarray(blocks_ids, dtype=np.int64)
+        self.cum_counts = np.cumsum(counts, dtype=np.int64)
+        logging.info(
+            "%s valid pixels in %s blocks", self.cum_counts[-1],
+            len(self.blocks_ids)
+        )
+
+    def reopen(self):
+        """
+        Re-open the GDAL datasets of the sources and of the mask
+        """
+        for raster in [self.mask, *self.rasters.values()]:
+            raster.reopen()
+
+    def _draw(self, rng: np.random.Generator) -> Tuple[int, int]:
+        """
+        Draw one valid pixel of the mask, uniformly
+
+        Returns:
+            the mask block index of the pixel, and its rank among the valid
+            pixels of the block
+        """
+        rank = rng.integers(self.cum_counts[-1])
+        pos = int(np.searchsorted(self.cum_counts, rank, side="right"))
+        if pos > 0:
+            rank -= self.cum_counts[pos - 1]
+        return pos, int(rank)
+
+    def _rng(self, index: int) -> np.random.Generator:
+        """
+        Returns the random generator of one sample
+        """
+        return np.random.default_rng([self.seed, index])
+
+    def _windows(
+            self,
+            index: int
+    ) -> Tuple[int, Dict[str, otbtf.utils.Window]]:
+        """
+        Draw the position of one sample
+
+        Params:
+            index: the sample index. Any non-negative integer.
+
+        Returns:
+            the mask block containing the center of the sample, used to
+            group the reads, and the window of the patch of each source
+
+        """
+        assert index >= 0
+        rng = self._rng(index)
+        for _ in range(self.max_attempts):
+            pos, rank = self._draw(rng)
+            block_id = int(self.blocks_ids[pos])
+            block_row, block_col = divmod(block_id, self.mask.n_blocks_cols)
+            block = self.mask.get_block(block_row, block_col)
+            row, col = divmod(
+                int(np.flatnonzero(block[:, :, 0])[rank]), block.shape[1]
+            )
+            center = self.mask.pixel_to_geo([
+                block_row * self.mask.step_y + row + .5,
+                block_col * self.mask.step_x + col + .5
+            ])
+            windows = {}
+            for src_key, raster in self.rasters.items():
+                psz = self.patches_sizes[src_key]
+                y_off, x_off = raster.patches_origins(center, psz)[0]
+                if x_off < 0 or y_off < 0 or x_off > raster.width - psz \
+                        or y_off > raster.height - psz:
+                    break
+                windows[src_key] = otbtf.utils.Window(
+                    int(x_off), int(y_off), psz, psz
+                )
+            else:
+                return block_id, windows
+        raise Exception(
+            f"No patch entirely inside the rasters has been found after "
+            f"{self.max_attempts} attempts for sample {index}"
+        )
+
+    def _read(
+            self,
+            windows: Dict[str, otbtf.utils.Window]
+    ) -> Dict[str, np.array]:
+        """
+        Returns the sample of the given windows (see `_windows()`)
+        """
+        return {
+            src_key: self.rasters[src_key].read(window)
+            for src_key, window in windows.items()
+        }
+
+    def get_sample(self, index: int) -> Dict[str, np.array]:
+        """
+        Return one sample.
+
+        Params:
+            index: the sample index. Any non-negative integer.
+
+        Returns:
+            The sample (see `PatchesImagesReader.get_sample()`)
+
+        """
+        return self._read(self._windows(index)[1])
+
+    def get_samples(self, indices: Sequence[int]) -> List[Dict[str, np.array]]:
+        """
+        Return multiple samples. The positions of the samples are drawn
+        once, then the samples are read grouped by blocks, to maximize the
+        block cache hits.
+
+        Params:
+            indices: the samples indices
+
+        Returns:
+            list of samples, in the order of `indices`
+
+        """
+        drawn = [self._windows(int(index)) for index in indices]
+        order = np.argsort(
+            [block_id for block_id, _ in drawn], kind="stable"
+        )
+        samples = [None] * len(drawn)
+        for pos in order:
+            samples[pos] = self._read(drawn[pos][1])
+        return samples
+
+    def get_stats(self) -> Dict[str, List[float]]:
+        """
+        Compute some statistics for each source, over the samples of one
+        epoch (i.e. indices in the [0, samples_per_epoch) range).
+
+        Returns:
+             statistics dict
+        """
+        logging.info("Computing stats")
+        stats = self._get_stats_sample_by_sample(keys=list(self.rasters))
+        logging.info("Stats: %s", stats)
+        return stats
+
+    def get_identity(self) -> Any:
+        """
+        Returns:
+            the identity of the samples: the signatures of the rasters and
+            of the mask, the patches sizes, and the seed
+        """
+        return {
+            "files": {
+                src_key: [
+                    raster.filename,
+                    otbtf.utils.file_signature(raster.filename)
+                ]
+                for src_key, raster in self.rasters.items()
+            },
+            "mask": [
+                self.mask.filename,
+                otbtf.utils.file_signature(self.mask.filename)
+            ],
+            "patches_sizes": self.patches_sizes,
+            "seed": self.seed,
+            "max_attempts": self.max_attempts
+        }
+
+    def get_size(self) -> int:
+        """
+        Returns:
+            number of samples of one epoch
+        """
+        return self.samples_per_epoch
+
+
+# Locks of the patches readers read through views, re-created in the forked
+# child processes (see `PatchesReaderView`)
+_READERS_LOCKS = weakref.WeakKeyDictionary()
+
+
+def _reset_readers_locks():
+    """
+    Re-create the locks of the patches readers, in a forked child process
+    """
+    for patches_reader in list(_READERS_LOCKS):
+        _READERS_LOCKS[patches_reader] = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_readers_locks)
+
+
+class PatchesReaderView(PatchesReaderBase):
+    """
+    This class provides a read access to a subset of the samples of another
+    patches reader.
+
+    The view does not copy any data: `get_sample(index)` simply returns the
+    sample `indices[index]` of the underlying reader. Hence, several views
+    (e.g. training, validation and test subsets) can share the same
+    `PatchesImagesReader` and its in-memory buffer.
+
+    The views of one reader can be read concurrently (e.g. by the miner
+    threads of several `Dataset`), and the streaming readers are not
+    thread-safe (GDAL datasets...). Hence, the reads go through a lock owned
+    by the underlying reader, and shared by all its views.
+
+    See `PatchesReaderBase`.
+
+    """
+
+    def __init__(
+            self,
+            patches_reader: PatchesReaderBase,
+            indices: Sequence[int]
+    ):
+        """
+        Params:
+            patches_reader: the underlying patches reader
+            indices: indices of the samples of `patches_reader` that are
+                visible through the view. Must be in the
+                [0, patches_reader.get_size()) range.
+
+        """
+        self.patches_reader = patches_reader
+        self.indices = np.asarray(indices, dtype=np.int64)
+        if self.indices.ndim != 1 or self.indices.size == 0:
+            raise Exception("indices must be a non-empty list of integers")
+        if self.indices.min() < 0 or \
+                self.indices.max() >= patches_reader.get_size():
+            raise Exception(
+                "indices must be in the [0, "
+                f"{patches_reader.get_size()}) range"
+            )
+        if patches_reader not in _READERS_LOCKS:
+            _READERS_LOCKS[patches_reader] = threading.Lock()
+
+    @property
+    def lock(self) -> threading.Lock:
+        """
+        Returns:
+            the lock of the underlying patches reader, shared by its views
+        """
+        return _READERS_LOCKS[self.patches_reader]
+
+    def get_sample(self, index: int) -> Any:
+        """
+        Return one sample of the view.
+
+        Params:
+            index: the sample index. Must be in the [0, self.get_size())
+                range.
+
+        Returns:
+            The sample `indices[index]` of the underlying patches reader
+
+        """
+        with self.lock:
+            return self.patches_reader.get_sample(
+                index=int(self.indices[index])
+            )
+
+    def get_samples(self, indices: Sequence[int]) -> List[Any]:
+        """
+        Return multiple samples of the view.
+
+        Params:
+            indices: the samples indices. Must be in the [0, self.get_size())
+                range.
+
+        Returns:
+            The samples `indices[...]` of the underlying patches reader
+
+        """
+        with self.lock:
+            return self.patches_reader.get_samples(
+                indices=self.indices[np.asarray(indices, dtype=np.int64)]
+            )
+
+    def reopen(self):
+        """
+        Re-open the resources of the underlying patches reader
+        """
+        self.patches_reader.reopen()
+
+    def get_cache_hit_rate(self) -> float:
+        """
+        Returns:
+            the block cache hit rate of the underlying patches reader
+        """
+        return self.patches_reader.get_cache_hit_rate()
+
+    def get_identity(self) -> Any:
+        """
+        Returns:
+            the identity of the samples: the identity of the underlying
+            patches reader, and the checksum of the indices
+        """
+        with self.lock:
+            identity = self.patches_reader.get_identity()
+        return {
+            "reader": type(self.patches_reader).__name__,
+            "identity": identity,
+            "indices_crc32": zlib.crc32(self.indices.tobytes())
+        }
+
+    def get_stats(self) -> Dict[str, List[float]]:
+        """
+        Compute some statistics for each source of the view, sample by
+        sample. Only the sources delivering arrays of patches (i.e. having a
+        3 dimensional shape) are considered.
+
+        Returns:
+             statistics dict
+        """
+        logging.info("Computing stats")
+        keys = [
+            src_key for src_key, np_arr in self.get_sample(index=0).items()
+            if np.ndim(np_arr) == 3
+        ]
+        stats = self._get_stats_sample_by_sample(keys=keys)
+        logging.info("Stats: %s", stats)
+        return stats
+
+    def get_size(self) -> int:
+        """
+        Returns:
+            size
+        """
+        return len(self.indices)
+
+
+class TFRecordsReader(PatchesReaderBase):
+    """
+    This class provides a random read access to the samples of a TFRecords
+    directory written with `otbtf.tfrecords.TFRecords`.
+
+    It relies on the manifest of the directory and on the records offsets
+    indexes written next to each shard. Hence, the TFRecords must be
+    uncompressed. `get_sample(index)` reads and decodes one single record,
+    and `get_samples(indices)` reads the adjacent records of one shard in
+    one single read. The same TFRecords directory can then be used for
+    `tf.data` streaming (see `otbtf.tfrecords.TFRecords.read()`) and with
+    `otbtf.Dataset`.
+
+    See `PatchesReaderBase`.
+
+    """
+
+    def __init__(self, path: str):
+        """
+        Params:
+            path: TFRecords directory
+
+        """
+        self.tfrecords = otbtf.tfrecords.TFRecords(path)
+        if not self.tfrecords.manifest:
+            raise Exception(
+                f"The file {self.tfrecords.manifest_file} is missing!"
+            )
+        if self.tfrecords.compression_type:
+            raise Exception(
+                "Compressed TFRecords can't be randomly accessed"
+            )
+        self.shards = self.tfrecords.manifest["shards"]
+        if any("index" not in shard for shard in self.shards):
+            raise Exception(
+                f"Some records offsets indexes are missing in {path}"
+            )
+
+        # Records offsets, and cumulated number of samples, for each shard
+        self.offsets = [
+            np.fromfile(os.path.join(path, shard["index"]), dtype="<u8")
+            for shard in self.shards
+        ]
+        self.shards_ends = np.cumsum(
+            [shard["n_samples"] for shard in self.shards]
+        )
+        self.size = int(self.shards_ends[-1])
+        self.files = {}
+
+    def _get_file(self, shard_idx: int):
+        """
+        Returns the (lazily opened) file of one shard
+        """
+        if shard_idx not in self.files:
+            filepath = os.path.join(
+                self.tfrecords.dirpath, self.shards[shard_idx]["filename"]
+            )
+            self.files[shard_idx] = open(  # pylint: disable=R1732
+                filepath, "rb"
+            )
+        return self.files[shard_idx]
+
+    def _locate(self, index: int):
+        """
+        Returns the shard index, the record index in the shard, and the
+        position of the sample in the record, of one sample
+        """
+        assert 0 <= index < self.size
+        shard_idx = int(np.searchsorted(self.shards_ends, index, side="right"))
+        offset = index - (int(self.shards_ends[shard_idx - 1])
+                          if shard_idx > 0 else 0)
+        samples_per_example = self.tfrecords.samples_per_example
+        return (shard_idx, offset // samples_per_example,
+                offset % samples_per_example)
+
+    def _read_records(self, shard_idx: int, first: int, last: int):
+        """
+        Read the consecutive records [first, last] of one shard, in one
+        single read, and returns their data
+        """
+        offsets = self.offsets[shard_idx]
+        start = int(offsets[first])
+        buffer = os.pread(
+            self._get_file(shard_idx).fileno(),
+            int(offsets[last + 1]) - start,
+            start
+        )
+        records = []
+        for record in range(first, last + 1):
+            pos = int(offsets[record]) - start
+            length, = struct.unpack_from("<Q", buffer, pos)
+            records.append(buffer[pos + 12:pos + 12 + length])
+        return records
+
+    def get_sample(self, index: int) -> Dict[str, np.array]:
+        """
+        Return one sample of the dataset.
+
+        Params:
+            index: the sample index. Must be in the [0, self.size) range.
+
+        Returns:
+            The sample, as a dict of numpy arrays
+
+        """
+        return self.get_samples(indices=[index])[0]
+
+    def get_samples(self, indices: Sequence[int]) -> List[Dict[str, np.array]]:
+        """
+        Return multiple samples of the dataset. The adjacent records of one
+        shard are read together.
+
+        Params:
+            indices: the samples indices. Must be in the [0, self.size)
+                range.
+
+        Returns:
+            list of samples, in the order of `indices`
+
+        """
+        locations = [self._locate(int(index)) for index in indices]
+        records = sorted({(shard, record) for shard, record, _ in locations})
+        decoded = {}
+        pos = 0
+        while pos < len(records):
+            shard_idx, first = records[pos]
+            count = 1
+            while pos + count < len(records) and \
+                    records[pos + count] == (shard_idx, first + count):
+                count += 1
+            for record, data in enumerate(
+                    self._read_records(shard_idx, first, first + count - 1),
+                    start=first
+            ):
+                decoded[(shard_idx, record)] = \
+                    self.tfrecords.decode_example_as_np_arr(data)
+            pos += count
+
+        if self.tfrecords.samples_per_example == 1:
+            return [decoded[(shard, record)]
+                    for shard, record, _ in locations]
+        return [
+            {key: arr[sample] for key, arr in decoded[(shard, record)].items()}
+            for shard, record, sample in locations
+        ]
+
+    def reopen(self):
+        """
+        Close the opened files, which are lazily re-opened
+        """
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+    def get_stats(self) -> Dict[str, List[float]]:
+        """
+        Compute some statistics for each source, sample by sample. Only the
+        sources delivering arrays of patches (i.e. having a 3 dimensional
+        shape) are considered. When the statistics have been saved with the
+        TFRecords (see `otbtf.tfrecords.TFRecords.save_stats()`), they are
+        returned without reading the samples.
+
+        Returns:
+             statistics dict
+        """
+        stats = self.tfrecords.load_stats()
+        if stats is not None:
+            return stats
+        logging.info("Computing stats")
+        keys = [
+            key for key, shape in self.tfrecords.output_shapes.items()
+            if len(shape) == 3
+        ]
+        stats = self._get_stats_sample_by_sample(keys=keys)
+        logging.info("Stats: %s", stats)
+        return stats
+
+    def get_identity(self) -> Any:
+        """
+        Returns:
+            the identity of the samples: the names and checksums of the
+            shards (see `otbtf.tfrecords.TFRecords._save_manifest()`)
+        """
+        return [[shard["filename"], shard["crc32"]] for shard in self.shards]
+
+    def get_size(self) -> int:
+        """
+        Returns:
+            size
+        """
+        return self.size
+
+
+class IteratorBase(ABC):
+    """
+    Base class for iterators
+    """
+
+    @abstractmethod
+    def __init__(self, patches_reader: PatchesReaderBase):
+        pass
+
+
+class RandomIterator(IteratorBase):
+    """
+    Pick a random number in the [0, handler.size) range.
+    """
+
+    def __init__(self, patches_reader: PatchesReaderBase):
+        """
+        Params:
+            patches_reader: patches reader
+        """
+        super().__init__(patches_reader=patches_reader)
+        self.indices = np.arange(0, patches_reader.get_size())
+        self._shuffle()
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        current_index = self.indices[self.count]
+        if self.count < len(self.indices) - 1:
+            self.count += 1
+        else:
+            self._shuffle()
+            self.count = 0
+        return current_index
+
+    def _shuffle(self):
+        np.random.shuffle(self.indices)
+
+
+class InfiniteIterator(IteratorBase):
+    """
+    Yield the 0, 1, 2, ... indices, without end. Used with readers that
+    accept any non-negative index (e.g. `MaskedWindowsReader`), each epoch
+    of `Dataset` then delivers new samples.
+    """
+
+    def __init__(self, patches_reader: PatchesReaderBase):
+        """
+        Params:
+            patches_reader: patches reader
+        """
+        super().__init__(patches_reader=patches_reader)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        current_index = self.count
+        self.count += 1
+        return current_index
+
+
+class Dataset:
+    """
+    Handles the "mining" of patches.
+    This class has a thread that extract tuples from the readers, while
+    ensuring the access of already gathered tuples.
+
+    See `PatchesReaderBase` and `Buffer`
+
+    """
+
+    def __init__(
+            self,
+            patches_reader: PatchesReaderBase = None,
+            buffer_length: int = 128,
+            iterator_cls: Type[IteratorBase] = RandomIterator,
+            max_nb_of_samples: int = None,
+            indices: Sequence[int] = None
+    ):
+        """
+        Params:
+            patches_reader: The patches reader instance
+            buffer_length: The number of samples that are stored in the
+                buffer
+            iterator_cls: The iterator class used to generate the sequence of
+                patches indices.
+            max_nb_of_samples: Optional, max number of samples to consider.
+                Only the first `max_nb_of_samples` samples are then delivered
+                by the iterator.
+            indices: Optional, indices of the samples of `patches_reader` to
+                use. This enables to build several datasets (e.g. training
+                and validation datasets) over one single patches reader,
+                without duplicating the data in memory. Each dataset has its
+                own iterator and buffers, and the reads of the shared reader
+                are serialized by its lock. See `PatchesReaderView`.
+
+        """
+        # If necessary, limit the nb of samples
+        logging.info('Number of samples: %s', patches_reader.get_size())
+        if indices is None and max_nb_of_samples and \
+                patches_reader.get_size() > max_nb_of_samples:
+            indices = np.arange(max_nb_of_samples)
+        elif indices is not None and max_nb_of_samples:
+            indices = indices[:max_nb_of_samples]
+
+        # patches reader
+        if indices is not None:
+            patches_reader = PatchesReaderView(
+                patches_reader=patches_reader,
+                indices=indices
+            )
+            logging.info(
+                'Reducing number of samples to %s', patches_reader.get_size()
+            )
+        self.patches_reader = patches_reader
+        self.size = self.patches_reader.get_size()
+
+        # iterator
+        self.iterator = iterator_cls(patches_reader=self.patches_reader)
+
+        # Get patches sizes and type, of the first sample of the first tile
+        self.output_types = {}
+        self.output_shapes = {}
+        one_sample = self.patches_reader.get_sample(index=0)
+        for src_key, np_arr in one_sample.items():
+            self.output_shapes[src_key] = np_arr.shape
+            self.output_types[src_key] = tf.dtypes.as_dtype(np_arr.dtype)
+
+        logging.info("output_types: %s", self.output_types)
+        logging.info("output_shapes: %s", self.output_shapes)
+
+        # buffers
+        if self.size <= buffer_length:
+            buffer_length = self.size
+        self.miner_buffer = Buffer(buffer_length)
+        self.mining_lock = multiprocessing.Lock()
+        self.consumer_buffer = Buffer(buffer_length)
+        self.consumer_buffer_pos = 0
+        self.tot_wait = 0
+        self.miner_thread = self._summon_miner_thread()
+        self.read_lock = multiprocessing.Lock()
+        self._dump()
+
+        # Prepare tf dataset for one epoch
+        self.tf_dataset = tf.data.Dataset.from_generator(
+            self._generator,
+            output_types=self.output_types,
+            output_shapes=self.output_shapes
+        ).repeat(1)
+
+    def to_tfrecords(
+            self,
+            output_dir: str,
+            n_samples_per_shard: int = 100,
+            drop_remainder: bool = True,
+            **kwargs
+    ):
+        """
+        Save the dataset into TFRecord files
+
+        Params:
+            output_dir: output directory
+            n_samples_per_shard: number of samples per TFRecord file
+            drop_remainder: drop remaining samples
+            kwargs: other options of
+                `otbtf.tfrecords.TFRecords.ds2tfrecord()`, e.g.
+                `n_processes`, `from_reader`, `shuffle`, `encoding`,
+                `compression_type`, `samples_per_example`
+
+        """
+        tfrecord = otbtf.tfrecords.TFRecords(output_dir)
+        tfrecord.ds2tfrecord(
+            self,
+            n_samples_per_shard=n_samples_per_shard,
+            drop_remainder=drop_remainder,
+            **kwargs
+        )
+
+    def to_split_tfrecords(
+            self,
+            output_dirs: Dict[str, str],
+            ratios: Dict[str, float] = None,
+            predicate: Callable[[int, Dict[str, Any]], str] = None,
+            shuffle: bool = False,
+            seed: int = None,
+            n_samples_per_shard: int = 100,
+            drop_remainder: bool = True,
+            block_size: int = 256,
+            queue_size: int = 1024,
+            **kwargs
+    ) -> Dict[str, int]:
+        """
+        Split the samples of the dataset into several TFRecords directories
+        (e.g. training, validation and test datasets), in one single pass
+        over the patches reader: each sample is read exactly once, then
+        routed to one of the outputs. Each output is written by its own
+        thread, and gets its own metadata, manifest and statistics of the
+        samples routed to it (see `otbtf.tfrecords.TFRecords.save_stats()`).
+
+        Params:
+            output_dirs: output directories, e.g. {"train": "/data/train",
+                "valid": "/data/valid"}
+            ratios: Optional, fractions of the samples routed to each output,
+                e.g. {"train": 0.8, "valid": 0.2}. The fractions are
+                normalized by their sum. The samples are assigned with a
+                random permutation (see `seed`).
+            predicate: Optional, function returning the output key of one
+                sample, from its index and the sample itself (e.g. based on
+                its location or its label). When it returns None, the sample
+                is not written. Exactly one of `ratios` and `predicate` must
+                be provided.
+            shuffle: If True, the samples are read and written in a random
+                order, so that the shards are already shuffled
+            seed: Optional, seed of the random assignment (`ratios`) and of
+                the random order (`shuffle`)
+            n_samples_per_shard: number of samples per TFRecord file
+            drop_remainder: drop remaining samples of each output
+            block_size: number of samples read at once from the reader
+                (see `PatchesReaderBase.get_samples()`)
+            queue_size: max number of samples waiting to be written, for
+                each output
+            kwargs: options of the TFRecords files (see
+                `otbtf.tfrecords.TFRecords.ds2tfrecord()`)
+
+        Returns:
+            the number of written samples of each output
+
+        """
+        if (ratios is None) == (predicate is None):
+            raise Exception("Either ratios or predicate must be provided")
+        if ratios is not None and set(ratios) != set(output_dirs):
+            raise Exception(
+                f"The keys of the ratios {list(ratios)} don't match the "
+                f"outputs {list(output_dirs)}"
+            )
+        rng = np.random.default_rng(seed)
+        indices = rng.permutation(self.size) if shuffle \
+            else np.arange(self.size)
+        if ratios is not None:
+            keys = list(ratios)
+            fractions = np.cumsum([ratios[key] for key in keys])
+            if fractions[-1] <= 0 or any(ratios[key] < 0 for key in keys):
+                raise Exception(f"Invalid ratios {ratios}")
+            cuts = np.round(fractions / fractions[-1] * self.size)
+            assignment = np.searchsorted(
+                cuts, rng.permutation(self.size), side="right"
+            )
+
+            def _route_by_ratios(index: int, _) -> str:
+                return keys[assignment[index]]
+
+            route = _route_by_ratios
+        else:
+            route = predicate
+
+        # One writer thread and one bounded queue per output
+        queues = {
+            key: queue.Queue(maxsize=queue_size) for key in output_dirs
+        }
+        results, errors = {}, {}
+
+        def _write(key: str):
+            try:
+                results[key] = otbtf.tfrecords.TFRecords(
+                    output_dirs[key]
+                ).write_stream(
+                    iter(queues[key].get, None),
+                    n_samples_per_shard=n_samples_per_shard,
+                    drop_remainder=drop_remainder,
+                    **kwargs
+                )
+            except Exception as err:  # pylint: disable=W0718
+                errors[key] = err
+
+        writers = {
+            key: threading.Thread(target=_write, args=(key,))
+            for key in output_dirs
+        }
+        for writer in writers.values():
+            writer.start()
+
+        def _put(key: str, item: Any) -> bool:
+            # Returns False when the writer of the output has failed
+            while writers[key].is_alive():
+                try:
+                    queues[key].put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        stats_keys = [
+            key for key, shape in self.output_shapes.items()
+            if len(shape) == 3
+        ]
+        accumulators = {
+            key: StatsAccumulator(keys=stats_keys) for key in output_dirs
+        }
+        try:
+            # The miner thread must not read the patches reader meanwhile
+            with self.mining_lock:
+                for index, sample in zip(
+                        indices,
+                        otbtf.tfrecords.read_samples_by_blocks(
+                            self.patches_reader, indices=indices,
+                            block_size=block_size
+                        )
+                ):
+                    key = route(int(index), sample)
+                    if key is None:
+                        continue
+                    if key not in output_dirs:
+                        raise Exception(f"Unknown output {key}")
+                    accumulators[key].add(sample)
+                    if not _put(key, sample):
+                        break
+        finally:
+            for key, writer in writers.items():
+                _put(key, None)
+                writer.join()
+        if errors:
+            raise Exception(f"Writing of the outputs failed: {errors}")
+
+        for key, accumulator in accumulators.items():
+            if accumulator.count:
+                otbtf.tfrecords.TFRecords(
+                    output_dirs[key]
+                ).save_stats(accumulator.get_stats())
+        logging.info("Written samples: %s", results)
+        return results
+
+    def get_stats(self) -> Dict[str, List[float]]:
+        """
+        Compute dataset statistics
+
         Return:
             the dataset statistics, computed by the patches reader
 
@@ -591,12 +1939,18 @@ class Dataset:
         It is threaded by the miner_thread.
 
         """
-        # Fill the miner_container until it's full
+        # Fill the miner_container until it's full. The samples are read
+        # together, so that the readers can group their reads (e.g. by
+        # blocks)
         while not self.miner_buffer.is_complete():
-            index = next(self.iterator)
+            indices = [
+                next(self.iterator) for _ in range(
+                    self.miner_buffer.max_length - self.miner_buffer.size()
+                )
+            ]
             with self.mining_lock:
-                new_sample = self.patches_reader.get_sample(index=index)
-                self.miner_buffer.add(new_sample)
+                for new_sample in self.patches_reader.get_samples(indices):
+                    self.miner_buffer.add(new_sample)
 
     def _summon_miner_thread(self) -> threading.Thread:
         """
@@ -612,13 +1966,19 @@ class Dataset:
         """
         for _ in range(self.size):
             yield self.read_one_sample()
+        hit_rate = self.patches_reader.get_cache_hit_rate()
+        if hit_rate is not None:
+            logging.info("Block cache hit rate: %.3f", hit_rate)
 
     def get_tf_dataset(
             self,
             batch_size: int,
             drop_remainder: bool = True,
             preprocessing_fn: Callable = None,
-            targets_keys: List[str] = None
+            targets_keys: List[str] = None,
+            cache: str = None,
+            augment: bool = False,
+            augment_exclude_keys: List[str] = None
     ) -> tf.data.Dataset:
         """
         Returns a TF dataset, ready to be used with the provided batch size
@@ -645,6 +2005,18 @@ class Dataset:
             targets_keys: Optional. When provided, the dataset returns a tuple
                 of dicts (inputs_dict, target_dict) so it can be
                 straightforwardly used with keras models objects.
+            cache: Optional, caches the preprocessed samples of the first
+                epoch, in memory (`otbtf.tfrecords.CACHE_MEMORY`) or in a
+                local directory (see `otbtf.tfrecords.cache_dataset()`). The
+                next epochs don't read nor preprocess the samples again: the
+                cached samples are shuffled with a buffer as large as the
+                dataset buffers. The cache files are specific to the
+                patches reader and to the `preprocessing_fn` code.
+            augment: if True, a random flip/rotation is applied to each
+                sample, after the batching (see
+                `otbtf.ops.dihedral_augmentation()`)
+            augment_exclude_keys: Optional, keys of the tensors that are not
+                augmented (e.g. scalar inputs)
 
         Returns:
              The TF dataset
@@ -674,7 +2046,52 @@ class Dataset:
 
             tf_ds = tf_ds.map(_split_input_and_target)
 
-        return tf_ds.batch(batch_size, drop_remainder=drop_remainder)
+        if cache:
+            tf_ds = otbtf.tfrecords.cache_dataset(
+                tf_ds, cache, self._cache_identity(
+                    preprocessing_fn=preprocessing_fn,
+                    targets_keys=targets_keys
+                )
+            )
+            tf_ds = tf_ds.shuffle(buffer_size=self.miner_buffer.max_length)
+
+        tf_ds = tf_ds.batch(batch_size, drop_remainder=drop_remainder)
+        if augment:
+            tf_ds = tf_ds.map(partial(
+                otbtf.ops.dihedral_augmentation,
+                exclude_keys=augment_exclude_keys
+            ))
+        return tf_ds
+
+    def _cache_identity(
+            self,
+            preprocessing_fn: Callable = None,
+            targets_keys: List[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Returns the identity of the preprocessed samples, used to name the
+        cache files (see `otbtf.tfrecords.cache_dataset()`). The patches
+        reader is identified by its class, its size, the shapes and types of
+        the samples, and the identity of its source (see
+        `PatchesReaderBase.get_identity()`).
+        """
+        with self.mining_lock:
+            reader_identity = self.patches_reader.get_identity()
+        return {
+            "reader": type(self.patches_reader).__name__,
+            "size": self.size,
+            "output_shapes": {
+                key: list(shape) for key, shape in self.output_shapes.items()
+            },
+            "output_types": {
+                key: dtype.name for key, dtype in self.output_types.items()
+            },
+            "source": reader_identity,
+            "preprocessing_fn": otbtf.tfrecords.function_identity(
+                preprocessing_fn
+            ),
+            "targets_keys": targets_keys
+        }
 
     def get_total_wait_in_seconds(self) -> int:
         """
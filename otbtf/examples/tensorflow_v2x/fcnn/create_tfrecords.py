@@ -30,6 +30,11 @@ parser.add_argument(
     required=True,
     help="Output dir for TFRecords files"
 )
+parser.add_argument(
+    "--shuffle",
+    action="store_true",
+    help="Shuffle the samples once, when they are written"
+)
 
 
 def create_tfrecords(params):
@@ -57,8 +62,14 @@ def create_tfrecords(params):
         }
     )
 
-    # Convert the dataset into TFRecords
-    dataset.to_tfrecords(output_dir=params.outdir, drop_remainder=False)
+    # Convert the dataset into TFRecords. Samples are read directly from the
+    # patches reader, and optionally shuffled once at write time.
+    dataset.to_tfrecords(
+        output_dir=params.outdir,
+        drop_remainder=False,
+        from_reader=True,
+        shuffle=params.shuffle
+    )
 
 
 if __name__ == "__main__":
@@ -22,9 +22,9 @@
 tree/master/otbtf/ops.py){ .md-button }
 
 The utils module provides some useful Tensorflow ad keras operators to build
-and train deep nets.
+and train deep nets, and to augment the training data.
 """
-from typing import List, Tuple, Any
+from typing import List, Tuple, Dict, Any
 import tensorflow as tf
 
 
@@ -46,3 +46,71 @@ def one_hot(labels: Tensor, nb_classes: int):
     """
     labels_xy = tf.squeeze(tf.cast(labels, tf.int32), axis=-1)  # shape [x, y]
     return tf.one_hot(labels_xy, depth=nb_classes)  # shape [x, y, nb_classes]
+
+
+def dihedral_augmentation(
+        *dicts: Dict[str, Tensor],
+        exclude_keys: List[str] = None,
+        seed: int = None
+) -> Any:
+    """
+    Applies one random transform of the dihedral group (flips and rotations
+    by multiples of 90 degrees) to each sample of a batch. The same
+    transform is applied to all the spatial tensors of one sample, i.e. the
+    tensors of shape [batch, rows, cols, channels], so that inputs and
+    targets stay aligned. The transforms are vectorized over the batch.
+
+    Rotations by 90 and 270 degrees (and the corresponding flips) are only
+    applied when all spatial tensors are square, with statically known
+    sizes: otherwise, only horizontal and vertical flips are used.
+
+    Params:
+        dicts: one or multiple dicts of tensors (e.g. inputs and targets),
+            with the batch dimension first. This enables to map the function
+            over datasets of dicts, or of tuples of dicts.
+        exclude_keys: Optional, keys of the tensors that are not transformed
+            (e.g. scalar inputs)
+        seed: Optional, random seed
+
+    Returns:
+        the transformed dict, or tuple of dicts when multiple dicts are
+        provided
+
+    """
+    exclude_keys = exclude_keys or []
+    spatial_keys = [
+        key for dic in dicts for key, value in dic.items()
+        if key not in exclude_keys and value.shape.rank == 4
+    ]
+    if not spatial_keys:
+        return dicts if len(dicts) > 1 else dicts[0]
+    values = {key: value for dic in dicts for key, value in dic.items()}
+    square = all(
+        values[key].shape[1] is not None and
+        values[key].shape[1] == values[key].shape[2]
+        for key in spatial_keys
+    )
+
+    # One random (flip rows, flip cols, transpose) triplet per sample
+    batch_size = tf.shape(values[spatial_keys[0]])[0]
+    transforms = tf.random.uniform(
+        [3, batch_size, 1, 1, 1], maxval=2, dtype=tf.int32, seed=seed
+    ) > 0
+
+    def _transform(value: Tensor) -> Tensor:
+        value = tf.where(transforms[0], tf.reverse(value, axis=[1]), value)
+        value = tf.where(transforms[1], tf.reverse(value, axis=[2]), value)
+        if square:
+            value = tf.where(
+                transforms[2], tf.transpose(value, perm=[0, 2, 1, 3]), value
+            )
+        return value
+
+    transformed = tuple(
+        {
+            key: _transform(value) if key in spatial_keys else value
+            for key, value in dic.items()
+        }
+        for dic in dicts
+    )
+    return transformed if len(transformed) > 1 else transformed[0]
@@ -22,18 +22,401 @@
 tree/master/otbtf/tfrecords.py){ .md-button }
 
 The tfrecords module provides an implementation for the TFRecords files
-read/write
+read/write, and for the datasets saved in the TensorFlow native format
 """
 import glob
+import hashlib
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import struct
+import sys
+import sysconfig
+import types
+import zlib
 from functools import partial
 
-from typing import Any, List, Dict, Callable
+from typing import Any, List, Dict, Callable, Iterable, Iterator, Tuple
+import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
 
+from otbtf import ops
+
+# `TensorProto` message class, from the public API (`tf.make_tensor_proto()`
+# builds the protocol buffer only, without any TensorFlow op)
+_TENSOR_PROTO = type(tf.make_tensor_proto(0))
+
+# Version of the TFRecords directory layout, stored in the metadata file.
+# Directories without metadata file are considered as version 1.
+FORMAT_VERSION = 2
+
+# Encodings of the tensors in the TFRecords:
+#  - "tensor": serialized `TensorProto`, decoded with `tf.io.parse_tensor`
+#  - "raw": raw contiguous bytes (little endian), decoded with
+#    `tf.io.decode_raw` then reshaped using the shapes in the metadata
+ENCODINGS = ("tensor", "raw")
+
+# Compression types of the TFRecords files ("" means no compression), and
+# default size (in bytes) of the read buffers for each compression type.
+# Compressed records are decoded through zlib streams that benefit from
+# larger input buffers.
+COMPRESSION_TYPES = ("", "GZIP", "ZLIB")
+READ_BUFFER_SIZES = {"": 256 * 1024, "GZIP": 4 * 1024 ** 2,
+                     "ZLIB": 4 * 1024 ** 2}
+
+# Size (in bytes) of the framing of one record in TFRecords files: length
+# (8 bytes), CRC of the length (4 bytes) and CRC of the data (4 bytes)
+RECORD_FRAMING_SIZE = 16
+
+# Value of the `cache` option of the datasets to cache the samples in memory
+# (any other value is a directory where the cache files are written)
+CACHE_MEMORY = "memory"
+
+# Patches reader and shard writing function used in the child processes of
+# the parallel TFRecords writer. They are inherited from the parent process
+# when the child processes are forked, hence the patches are never copied
+# nor pickled.
+_WORKER_PATCHES_READER = None
+_WORKER_WRITE_FN = None
+
+
+def _init_writer_process(patches_reader: Any, write_fn: Callable):
+    """
+    Initialize one child process of the parallel TFRecords writer.
+
+    Params:
+        patches_reader: the patches reader (`otbtf.dataset.PatchesReaderBase`)
+        write_fn: the function used to write one shard from a filepath and
+            an iterable of samples
+
+    """
+    global _WORKER_PATCHES_READER  # pylint: disable=global-statement
+    global _WORKER_WRITE_FN  # pylint: disable=global-statement
+    _WORKER_PATCHES_READER = patches_reader
+    _WORKER_WRITE_FN = write_fn
+    _WORKER_PATCHES_READER.reopen()
+
+
+def _write_shard_from_reader(
+        shard: Tuple[str, np.ndarray, int]
+) -> Dict[str, Any]:
+    """
+    Write one TFRecord file from samples of the patches reader of the current
+    child process.
+
+    Params:
+        shard: a tuple (filepath, indices, block_size) where indices are the
+            indices of the samples to write, read by blocks of block_size
+            samples
+
+    Returns:
+        the description of the written shard (see `TFRecords._write_shard()`)
+
+    """
+    filepath, indices, block_size = shard
+    samples = read_samples_by_blocks(
+        _WORKER_PATCHES_READER, indices=indices, block_size=block_size
+    )
+    return _WORKER_WRITE_FN(filepath, samples)
+
+
+def read_samples_by_blocks(
+        patches_reader: Any,
+        indices: np.ndarray,
+        block_size: int
+) -> Iterator[Dict[str, Any]]:
+    """
+    Read samples from a patches reader by blocks. In each block, the samples
+    are read in increasing order of indices (so that the reader can coalesce
+    the consecutive ones), then delivered in the order of `indices`.
+
+    Params:
+        patches_reader: the patches reader (`otbtf.dataset.PatchesReaderBase`)
+        indices: indices of the samples to read
+        block_size: number of samples read in each block
+
+    Yields:
+        the samples, in the order of `indices`
+
+    """
+    for start in range(0, len(indices), block_size):
+        block = np.asarray(indices[start:start + block_size])
+        order = np.argsort(block, kind="stable")
+        samples = [None] * len(block)
+        for pos, sample in zip(
+                order, patches_reader.get_samples(indices=block[order])
+        ):
+            samples[pos] = sample
+        yield from samples
+
+
+def dominant_classes(
+        patches_reader: Any,
+        key: str,
+        block_size: int = 256
+) -> np.ndarray:
+    """
+    Compute the dominant class of each sample, i.e. the most frequent value
+    of its label patch, in one single pass over the patches reader.
+
+    Params:
+        patches_reader: the patches reader (`otbtf.dataset.PatchesReaderBase`)
+        key: key of the label patches
+        block_size: number of samples read at once from the reader
+
+    Returns:
+        the dominant class of each sample
+
+    """
+    size = patches_reader.get_size()
+    classes = []
+    for sample in read_samples_by_blocks(
+            patches_reader, indices=np.arange(size), block_size=block_size
+    ):
+        values, counts = np.unique(
+            np.asarray(sample[key]), return_counts=True
+        )
+        classes.append(values[np.argmax(counts)])
+    histogram = dict(zip(*np.unique(classes, return_counts=True)))
+    logging.info("Dominant classes histogram: %s", histogram)
+    return np.asarray(classes)
+
+
+def stratify(indices: np.ndarray, classes: np.ndarray) -> np.ndarray:
+    """
+    Reorder samples so that any range of consecutive samples has nearly the
+    same classes proportions as the whole set. Each sample is placed at the
+    relative position of its rank among the samples of its class, and the
+    order of the samples of each class is preserved.
+
+    Params:
+        indices: indices of the samples
+        classes: class of each sample of `indices`
+
+    Returns:
+        the reordered indices
+
+    """
+    _, inverse, counts = np.unique(
+        classes, return_inverse=True, return_counts=True
+    )
+    ranks = np.empty(len(indices))
+    for class_idx, count in enumerate(counts):
+        positions = np.flatnonzero(inverse == class_idx)
+        ranks[positions] = (np.arange(count) + 0.5) / count
+    return np.asarray(indices)[np.argsort(ranks, kind="stable")]
+
+
+def file_crc32(filepath: str, chunk_size: int = 4 * 1024 ** 2) -> int:
+    """
+    Compute the CRC32 checksum of a file.
+
+    Params:
+        filepath: file
+        chunk_size: size of the chunks read from the file
+
+    Returns:
+        the CRC32 checksum
+
+    """
+    crc = 0
+    with open(filepath, "rb") as file:
+        for chunk in iter(partial(file.read, chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def count_records(filepath: str) -> int:
+    """
+    Count the records of an uncompressed TFRecord file. Only the framing of
+    the records is read (see `RECORD_FRAMING_SIZE`), the data is skipped.
+
+    Params:
+        filepath: TFRecord file
+
+    Returns:
+        the number of records
+
+    """
+    n_records = 0
+    with open(filepath, "rb") as file:
+        header = file.read(8)
+        while header:
+            if len(header) < 8:
+                raise Exception(f"The file {filepath} is truncated")
+            length, = struct.unpack("<Q", header)
+            # masked CRC of the length, data, masked CRC of the data
+            file.seek(length + RECORD_FRAMING_SIZE - 8, os.SEEK_CUR)
+            n_records += 1
+            header = file.read(8)
+    return n_records
+
+
+def stack_samples(samples: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """
+    Stack the arrays of multiple samples along a new first axis.
+
+    Params:
+        samples: list of samples (dicts of arrays sharing the same keys)
+
+    Returns:
+        one dict of stacked arrays
+
+    """
+    return {
+        key: np.stack([np.asarray(sample[key]) for sample in samples])
+        for key in samples[0]
+    }
+
+
+def _code_identity(code: Any) -> List[str]:
+    """
+    Returns the identity of a code object: its bytecode and constants,
+    including those of the nested code objects (e.g. lambdas)
+    """
+    return [code.co_code.hex()] + [
+        _code_identity(const) if hasattr(const, "co_code") else repr(const)
+        for const in code.co_consts
+    ]
+
+
+def _code_names(code: Any) -> List[str]:
+    """
+    Returns the global and attribute names used by a code object, including
+    those of the nested code objects
+    """
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            names += _code_names(const)
+    return names
+
+
+# Installation directories of the python standard library and packages
+_LIBRARY_PATHS = tuple({
+    os.path.abspath(path) for name, path in sysconfig.get_paths().items()
+    if name in ("stdlib", "platstdlib", "purelib", "platlib")
+})
+
+
+def _is_library(function: Callable) -> bool:
+    """
+    Returns True when a function comes from the standard library or an
+    installed package (e.g. TensorFlow), rather than from the user code
+    """
+    module = sys.modules.get(getattr(function, "__module__", None) or "")
+    filename = getattr(module, "__file__", None)
+    return filename is None or \
+        os.path.abspath(filename).startswith(_LIBRARY_PATHS)
+
+
+def _value_identity(value: Any, names: List[str], seen: set) -> Any:
+    """
+    Returns the identity of a value referenced by a function (global
+    variable, closure cell or partial argument). For modules, the
+    attributes named in `names` are resolved.
+    """
+    if isinstance(value, types.ModuleType):
+        return [value.__name__, {
+            name: _value_identity(getattr(value, name), [], seen)
+            for name in sorted(set(names)) if hasattr(value, name)
+        }]
+    if isinstance(value, np.ndarray):
+        return [str(value.dtype), list(value.shape), hashlib.sha1(
+            np.ascontiguousarray(value).tobytes()
+        ).hexdigest()]
+    if callable(value):
+        return function_identity(value, _seen=seen)
+    return repr(value)
+
+
+def function_identity(function: Callable, _seen: set = None) -> Any:
+    """
+    Returns the identity of a function, which changes when the function is
+    renamed, when its code changes, or when the values it references
+    change: global variables (including the attributes of modules, e.g.
+    `fcnn_model.N_CLASSES`), closure cells and arguments of partial
+    functions. The functions of the user code it references are identified
+    recursively. The functions of the standard library and of installed
+    packages are only identified by their name and code.
+
+    Params:
+        function: function, or partial function
+
+    Returns:
+        a JSON serializable identity
+
+    """
+    if function is None:
+        return None
+    seen = set() if _seen is None else _seen
+    if isinstance(function, partial):
+        return [function_identity(function.func, _seen=seen)] + [
+            [name, _value_identity(value, [], seen)]
+            for name, value in [*enumerate(function.args),
+                                *sorted(function.keywords.items())]
+        ]
+    identity = [
+        getattr(function, "__module__", None),
+        getattr(function, "__qualname__", repr(function))
+    ]
+    code = getattr(function, "__code__", None)
+    if code is None:
+        return identity
+    identity.append(_code_identity(code))
+    if _is_library(function) or id(function) in seen:
+        return identity
+    seen.add(id(function))
+    names = _code_names(code)
+    fn_globals = getattr(function, "__globals__", {})
+    identity.append({
+        name: _value_identity(fn_globals[name], names, seen)
+        for name in sorted(set(names)) if name in fn_globals
+    })
+    cells = []
+    for cell in getattr(function, "__closure__", None) or ():
+        try:
+            cells.append(_value_identity(cell.cell_contents, names, seen))
+        except ValueError:  # empty cell
+            cells.append(None)
+    identity.append(cells)
+    return identity
+
+
+def cache_dataset(
+        dataset: tf.data.Dataset,
+        cache: str,
+        identity: Any
+) -> tf.data.Dataset:
+    """
+    Cache the elements of a dataset, in memory or in files. The cache files
+    are named after a fingerprint of the identity of the elements (i.e. the
+    source data and the processing applied), so that a cache is never used
+    when the source data or the processing changes.
+
+    Params:
+        dataset: the dataset to cache
+        cache: `CACHE_MEMORY`, or directory of the cache files
+        identity: JSON serializable identity of the elements
+
+    Returns:
+        the cached dataset
+
+    """
+    if cache == CACHE_MEMORY:
+        return dataset.cache()
+    os.makedirs(cache, exist_ok=True)
+    fingerprint = hashlib.sha1(
+        json.dumps(identity, sort_keys=True, default=repr).encode()
+    ).hexdigest()
+    filename = os.path.join(cache, f"otbtf_cache_{fingerprint}")
+    logging.info("Caching dataset in %s", filename)
+    return dataset.cache(filename)
+
 
 class TFRecords:
     """
@@ -58,91 +441,1004 @@ class TFRecords:
             if os.path.exists(self.output_shapes_file) else None
         self.output_types = self.load(self.output_types_file) \
             if os.path.exists(self.output_types_file) else None
+        self.metadata_file = os.path.join(self.dirpath, "metadata.json")
+        self.metadata = self.load(self.metadata_file) \
+            if os.path.exists(self.metadata_file) else {"format_version": 1}
+        self.manifest_file = os.path.join(self.dirpath, "manifest.json")
+        self.manifest = self.load(self.manifest_file) \
+            if os.path.exists(self.manifest_file) else None
+        self.stats_file = os.path.join(self.dirpath, "stats.json")
+
+    @staticmethod
+    def _bytes_feature(value):
+        """
+        Convert a value to a type compatible with tf.train.Example.
+
+        Params:
+            value: value
+
+        Returns:
+            a bytes_list from a string / byte.
+        """
+        if not isinstance(value, (bytes, np.ndarray)):
+            value = value.numpy()  # BytesList won't unpack a string from
+            # an EagerTensor.
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+    @property
+    def encoding(self) -> str:
+        """
+        Returns:
+            the encoding of the tensors in the TFRecords ("tensor" or "raw")
+        """
+        return self.metadata.get("encoding", "tensor")
+
+    @property
+    def compression_type(self) -> str:
+        """
+        Returns:
+            the compression type of the TFRecords files ("", "GZIP" or
+            "ZLIB")
+        """
+        return self.metadata.get("compression_type", "")
+
+    @property
+    def samples_per_example(self) -> int:
+        """
+        Returns:
+            the (maximum) number of samples stacked in one `tf.train.Example`
+        """
+        return self.metadata.get("samples_per_example", 1)
+
+    @property
+    def num_samples(self) -> int:
+        """
+        Returns:
+            the number of samples of the TFRecords, from the manifest (None
+            when the directory has no manifest)
+        """
+        return self.manifest["n_samples"] if self.manifest else None
+
+    def _workers_shards(self, n_workers: int) -> List[List[Dict[str, Any]]]:
+        """
+        Distribute all the shards among `n_workers` workers, so that the
+        workers have about the same number of samples. The shards are
+        assigned from the largest to the smallest, each one to the worker
+        having the fewest samples, and each worker gets the same number of
+        shards, up to one. The workers are sorted by decreasing number of
+        shards, so that the shard k of the worker w is at position
+        `k * n_workers + w` of the interleaved shards (see `_read_shards()`),
+        which is the shard read by worker w with file-based auto-sharding.
+
+        Params:
+            n_workers: number of workers
+
+        Returns:
+            the shards of each worker, in the order of the shards numbers
+
+        """
+        shards = self.manifest["shards"]
+        if len(shards) < n_workers:
+            raise Exception(
+                f"At least one worker has no TFRecord file in {self.dirpath}."
+                " Please ensure that the number of TFRecord files is greater "
+                "or equal than the number of workers!"
+            )
+        base, extra = divmod(len(shards), n_workers)
+        workers = [[] for _ in range(n_workers)]
+        n_samples = [0] * n_workers
+        for shard in sorted(shards, key=lambda shard: -shard["n_samples"]):
+            n_extra = sum(len(worker) > base for worker in workers)
+            worker = min(
+                (
+                    idx for idx, worker in enumerate(workers)
+                    if len(worker) < base or
+                    (len(worker) == base and n_extra < extra)
+                ),
+                key=lambda idx: n_samples[idx]
+            )
+            workers[worker].append(shard)
+            n_samples[worker] += shard["n_samples"]
+        workers.sort(key=len, reverse=True)
+        return [
+            sorted(
+                worker,
+                key=lambda shard: self._shard_number(shard["filename"])
+            )
+            for worker in workers
+        ]
+
+    def _read_shards(self, n_workers: int) -> List[Dict[str, Any]]:
+        """
+        Returns all the shards, interleaved so that file-based auto-sharding
+        among `n_workers` workers gives the balanced shards of
+        `_workers_shards()`
+        """
+        workers = self._workers_shards(n_workers)
+        return [
+            worker[k] for k in range(len(workers[0]))
+            for worker in workers if k < len(worker)
+        ]
+
+    def steps(
+            self,
+            batch_size: int,
+            n_workers: int = 1,
+            drop_remainder: bool = True
+    ) -> int:
+        """
+        Compute the number of steps of one epoch, i.e. the number of batches
+        delivered to each worker by `read()`. When the workers have different
+        numbers of samples, the smallest one is used (see
+        `_workers_shards()`).
+
+        Params:
+            batch_size: size of the batches
+            n_workers: number of workers
+            drop_remainder: whether the last incomplete batch is dropped
+
+        Returns:
+            the number of steps
+
+        """
+        n_samples = self._worker_samples(n_workers)
+        return n_samples // batch_size if drop_remainder \
+            else math.ceil(n_samples / batch_size)
+
+    def _worker_samples(self, n_workers: int) -> int:
+        """
+        Returns the number of samples read by each worker, i.e. the smallest
+        number of samples of the workers shards
+        """
+        if not self.manifest:
+            raise Exception(
+                f"The file {self.manifest_file} is missing!"
+            )
+        return min(
+            sum(shard["n_samples"] for shard in worker_shards)
+            for worker_shards in self._workers_shards(n_workers)
+        )
+
+    @staticmethod
+    def _encode_tensor(value: Any, encoding: str = "tensor") -> bytes:
+        """
+        Encode one tensor in bytes.
+
+        Params:
+            value: numpy array
+            encoding: "tensor" to serialize the array as a `TensorProto`
+                (like `tf.io.serialize_tensor` does), or "raw" to store only
+                the contiguous bytes of the array
+
+        Returns:
+            the encoded tensor
+
+        """
+        value = np.asarray(value)
+        if encoding == "raw":
+            if value.dtype.kind not in "biufc":
+                raise Exception(
+                    f"Data type {value.dtype} can't be stored with the raw "
+                    "encoding"
+                )
+            return np.ascontiguousarray(
+                value, dtype=value.dtype.newbyteorder("<")
+            ).tobytes()
+        return tf.make_tensor_proto(value).SerializeToString()
+
+    @staticmethod
+    def serialize_sample(
+            sample: Dict[str, Any],
+            encoding: str = "tensor"
+    ) -> bytes:
+        """
+        Serialize one sample into a `tf.train.Example` string. Only
+        protocol buffers are built: the TensorFlow runtime (eager context,
+        ops) is never used, so that this function can be safely used in
+        forked processes.
+
+        Params:
+            sample: dict of numpy arrays
+            encoding: encoding of the tensors ("tensor" or "raw", see
+                `ENCODINGS`)
+
+        Returns:
+            the serialized example
+
+        """
+        features = {
+            name: TFRecords._bytes_feature(
+                TFRecords._encode_tensor(fea, encoding=encoding)
+            )
+            for name, fea in sample.items()
+        }
+        tf_features = tf.train.Features(feature=features)
+        example = tf.train.Example(features=tf_features)
+        return example.SerializeToString()
+
+    @staticmethod
+    def _write_shard(
+            filepath: str,
+            samples: Iterable[Dict[str, Any]],
+            serialize_fn: Callable,
+            options: tf.io.TFRecordOptions = None,
+            samples_per_example: int = 1,
+            write_index: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Write one TFRecord file.
+
+        Params:
+            filepath: output file
+            samples: samples to write
+            serialize_fn: function used to serialize one sample
+            options: TFRecords options (e.g. compression)
+            samples_per_example: number of samples stacked in each example.
+                When greater than 1, the arrays of `samples_per_example`
+                consecutive samples are stacked along a new first axis,
+                for each key. The last example of the file can contain
+                fewer samples.
+            write_index: if True, the offsets of the records in the file are
+                written in an index file (`filepath` + ".index"), as little
+                endian uint64 values: the start of each record, then the end
+                of the file. Only valid for uncompressed files.
+
+        The file is first written with a temporary name, then renamed, so
+        that an interrupted writing never leaves a partial shard.
+
+        Returns:
+            the description of the shard, i.e. a dict with the file name
+            ("filename"), the number of samples ("n_samples"), the file size
+            ("n_bytes"), the CRC32 checksum of the file ("crc32"), and the
+            file name of the index ("index") when `write_index` is True
+
+        """
+        n_samples = 0
+        offsets = [0]
+        tmp_filepath = f"{filepath}.tmp"
+        with tf.io.TFRecordWriter(tmp_filepath, options=options) as writer:
+
+            def _write(example: bytes):
+                writer.write(example)
+                offsets.append(
+                    offsets[-1] + len(example) + RECORD_FRAMING_SIZE
+                )
+
+            if samples_per_example == 1:
+                for sample in samples:
+                    _write(serialize_fn(sample))
+                    n_samples += 1
+            else:
+                pending = []
+                for sample in samples:
+                    pending.append(sample)
+                    if len(pending) == samples_per_example:
+                        _write(serialize_fn(stack_samples(pending)))
+                        n_samples += len(pending)
+                        pending = []
+                if pending:
+                    _write(serialize_fn(stack_samples(pending)))
+                    n_samples += len(pending)
+        shard = {
+            "filename": os.path.basename(filepath),
+            "n_samples": n_samples,
+            "n_bytes": os.path.getsize(tmp_filepath),
+            "crc32": file_crc32(tmp_filepath)
+        }
+        if write_index:
+            np.asarray(offsets, dtype="<u8").tofile(f"{tmp_filepath}.index")
+            os.replace(f"{tmp_filepath}.index", f"{filepath}.index")
+            shard["index"] = f"{shard['filename']}.index"
+        os.replace(tmp_filepath, filepath)
+        return shard
+
+    @staticmethod
+    def _shard_number(filename: str) -> int:
+        """
+        Returns the number of a shard from its file name (e.g. "12.records")
+        """
+        return int(filename.split(".")[0])
+
+    def _save_manifest(
+            self,
+            shards: List[Dict[str, Any]],
+            session: Dict[str, Any] = None
+    ):
+        """
+        Save the manifest of the TFRecords, i.e. the list of shards with
+        their number of samples, size and checksum. The manifest enables to
+        know the number of samples without reading the TFRecords files.
+
+        Params:
+            shards: list of shards descriptions (see `_write_shard()`)
+            session: parameters of the last writing session (see
+                `_start_session()`)
+
+        """
+        shards = sorted(
+            shards, key=lambda shard: self._shard_number(shard["filename"])
+        )
+        self.manifest = {
+            "n_samples": sum(shard["n_samples"] for shard in shards),
+            "n_bytes": sum(shard["n_bytes"] for shard in shards),
+            "shards": shards
+        }
+        if session:
+            self.manifest["session"] = session
+        self.save(self.manifest, self.manifest_file)
+
+    def _add_to_manifest(self, shard: Dict[str, Any]):
+        """
+        Add one written shard in the manifest, and save it.
+
+        Params:
+            shard: shard description (see `_write_shard()`)
+
+        """
+        self._save_manifest(
+            shards=[
+                other for other in self.manifest["shards"]
+                if other["filename"] != shard["filename"]
+            ] + [shard],
+            session=self.manifest.get("session")
+        )
+
+    def _scan_shards(self) -> List[Dict[str, Any]]:
+        """
+        Describe the shards of a directory that has no manifest (e.g.
+        written by a former version of otbtf), from the TFRecord files found
+        on the disk. The records of each file are counted.
+
+        Returns:
+            list of shards descriptions (see `_write_shard()`)
+
+        """
+        if self.compression_type or self.samples_per_example > 1:
+            raise Exception(
+                f"Unable to append to {self.dirpath} without the file "
+                f"{self.manifest_file}, since its samples can't be counted"
+            )
+        shards = []
+        for filepath in glob.glob(os.path.join(self.dirpath, "*.records")):
+            filename = os.path.basename(filepath)
+            if not filename.split(".")[0].isdigit():
+                raise Exception(
+                    f"Unable to append to {self.dirpath} without the file "
+                    f"{self.manifest_file}, since the file {filename} is not "
+                    "a numbered shard"
+                )
+            shards.append({
+                "filename": filename,
+                "n_samples": count_records(filepath),
+                "n_bytes": os.path.getsize(filepath),
+                "crc32": file_crc32(filepath)
+            })
+        logging.info(
+            "No manifest: %s shards found in %s", len(shards), self.dirpath
+        )
+        return shards
+
+    def _start_session(
+            self,
+            size: int,
+            n_samples_per_shard: int,
+            drop_remainder: bool,
+            shuffle: bool = False,
+            seed: int = None,
+            append: bool = False,
+            resume: bool = False,
+            stratify_key: str = None
+    ) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Start a new writing session, or resume the last one. The parameters
+        of the session are saved in the manifest, so that an interrupted
+        session can be resumed with exactly the same shards.
+
+        Params:
+            size: number of samples to write (None when unknown, e.g. when
+                writing a stream of samples)
+            n_samples_per_shard: number of samples per shard
+            drop_remainder: whether the remaining samples are dropped
+            shuffle: whether the samples are randomly permuted
+            seed: seed of the random permutation. When `shuffle` is True and
+                no seed is provided, a random seed is drawn and saved.
+            append: if True, the existing shards are kept, and the new
+                shards are numbered after them. When the directory has no
+                manifest, the shards are found on the disk (see
+                `_scan_shards()`).
+            resume: if True, resume the last session of the manifest
+            stratify_key: key of the labels used to stratify the shards
+
+        Returns:
+            the session parameters, and the list of the files names of the
+            shards that are already written
+
+        """
+        if resume:
+            if not self.manifest or "session" not in self.manifest:
+                raise Exception(
+                    f"There is no writing session to resume in {self.dirpath}"
+                )
+            session = self.manifest["session"]
+            if session["size"] != size:
+                raise Exception(
+                    f"Unable to resume writing {size} samples, since the "
+                    f"interrupted session was writing {session['size']} "
+                    "samples"
+                )
+            done = [
+                shard["filename"] for shard in self.manifest["shards"]
+                if os.path.exists(
+                    os.path.join(self.dirpath, shard["filename"])
+                )
+            ]
+            logging.info("Resuming session: %s shards found", len(done))
+            return session, done
+
+        shards = []
+        if append:
+            shards = self.manifest["shards"] if self.manifest \
+                else self._scan_shards()
+        if shuffle and seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        session = {
+            "size": size,
+            "n_samples_per_shard": n_samples_per_shard,
+            "drop_remainder": drop_remainder,
+            "shuffle": shuffle,
+            "seed": seed,
+            "stratify_key": stratify_key,
+            "first_shard": 1 + max(
+                (self._shard_number(shard["filename"]) for shard in shards),
+                default=-1
+            )
+        }
+        self._save_manifest(shards, session)
+        return session, []
+
+    def _n_samples_per_shard_from_size(
+            self,
+            one_sample: Dict[str, Any],
+            shard_size_bytes: int
+    ) -> int:
+        """
+        Estimate the number of samples per shard, so that the shards have
+        roughly the given size. The estimation is made from the size of one
+        serialized sample, with the encoding and the number of samples per
+        example of the metadata. Note that compression is not taken into
+        account, hence compressed shards are smaller than the target size.
+
+        Params:
+            one_sample: one sample
+            shard_size_bytes: target size of the shards, in bytes
+
+        Returns:
+            number of samples per shard
+
+        """
+        samples_per_example = self.samples_per_example
+        example = self.serialize_sample(
+            stack_samples([one_sample] * samples_per_example)
+            if samples_per_example > 1 else one_sample,
+            encoding=self.encoding
+        )
+        sample_size = (len(example) + RECORD_FRAMING_SIZE) / \
+            samples_per_example
+        n_samples_per_shard = max(1, int(shard_size_bytes / sample_size))
+        logging.info(
+            "Estimated size of one sample: %s bytes. Using %s samples per "
+            "shard", sample_size, n_samples_per_shard
+        )
+        return n_samples_per_shard
+
+    def decode_example_as_np_arr(self, example: bytes) -> Dict[str, Any]:
+        """
+        Decode one serialized example into numpy arrays, without using any
+        TensorFlow op. When the examples contain multiple samples (see
+        `samples_per_example`), the returned arrays have an additional first
+        dimension, the number of samples.
+
+        Params:
+            example: serialized example
+
+        Returns:
+            dict of numpy arrays
+
+        """
+        features = tf.train.Example.FromString(example).features.feature
+        decoded = {}
+        for key, out_type in self.output_types.items():
+            value = features[key].bytes_list.value[0]
+            if self.encoding == "raw":
+                dtype = np.dtype(tf.dtypes.as_dtype(out_type).as_numpy_dtype)
+                shape = list(self.output_shapes[key])
+                if self.samples_per_example > 1:
+                    shape = [-1] + shape
+                decoded[key] = np.frombuffer(
+                    value, dtype=dtype.newbyteorder("<")
+                ).reshape(shape)
+            else:
+                decoded[key] = tf.make_ndarray(_TENSOR_PROTO.FromString(value))
+        return decoded
+
+    @staticmethod
+    def _output_specs(one_sample: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Returns the shapes and the names of the data types of the tensors
+        of one sample, as keyword arguments of `_prepare_output()`
+        """
+        return {
+            "output_shapes": {
+                key: np.shape(np_arr) for key, np_arr in one_sample.items()
+            },
+            "output_types": {
+                key: tf.dtypes.as_dtype(np.asarray(np_arr).dtype).name
+                for key, np_arr in one_sample.items()
+            }
+        }
+
+    def _prepare_output(
+            self,
+            output_shapes: Dict[str, Any],
+            output_types: Dict[str, str],
+            append: bool = False,
+            encoding: str = None,
+            compression_type: str = None,
+            compression_level: int = None,
+            samples_per_example: int = None
+    ) -> Callable:
+        """
+        Save the metadata files of the TFRecords, and return the function
+        used to write one shard.
+
+        Params:
+            output_shapes: shapes of the tensors
+            output_types: names of the tensors data types
+            append: if True and the metadata files exist, they are kept, and
+                the shapes, types and options must match the existing ones.
+                Options that are not set are taken from the existing
+                metadata.
+            encoding: see `ds2tfrecord()`
+            compression_type: see `ds2tfrecord()`
+            compression_level: see `ds2tfrecord()`
+            samples_per_example: see `ds2tfrecord()`
+
+        Returns:
+            a function that writes one TFRecord file from a filepath and an
+            iterable of samples, and returns the description of the shard
+
+        """
+        append = append and self.output_shapes is not None
+        options = {
+            "encoding": (encoding, self.encoding, "tensor"),
+            "compression_type": (
+                compression_type, self.compression_type, ""
+            ),
+            "samples_per_example": (
+                samples_per_example, self.samples_per_example, 1
+            )
+        }
+        if append:
+            if {key: list(shape) for key, shape in output_shapes.items()} != \
+                    {key: list(shape)
+                     for key, shape in self.output_shapes.items()}:
+                raise Exception(
+                    f"Shapes {output_shapes} don't match the existing shapes "
+                    f"{self.output_shapes}"
+                )
+            if output_types != self.output_types:
+                raise Exception(
+                    f"Types {output_types} don't match the existing types "
+                    f"{self.output_types}"
+                )
+            for key, (value, existing, _) in options.items():
+                if value is not None and value != existing:
+                    raise Exception(
+                        f"Option {key}={value} doesn't match the existing "
+                        f"value {existing}"
+                    )
+        encoding, compression_type, samples_per_example = (
+            value if value is not None else existing if append else default
+            for value, existing, default in options.values()
+        )
+
+        if encoding not in ENCODINGS:
+            raise Exception(
+                f"Unknown encoding {encoding}. Must be one of {ENCODINGS}"
+            )
+        if compression_type not in COMPRESSION_TYPES:
+            raise Exception(
+                f"Unknown compression type {compression_type}. Must be one "
+                f"of {COMPRESSION_TYPES}"
+            )
+
+        if not append:
+            self.output_shapes = output_shapes
+            self.save(self.output_shapes, self.output_shapes_file)
+            self.output_types = output_types
+            self.save(self.output_types, self.output_types_file)
+            self.metadata = {
+                "format_version": FORMAT_VERSION,
+                "encoding": encoding,
+                "compression_type": compression_type,
+                "samples_per_example": samples_per_example
+            }
+            self.save(self.metadata, self.metadata_file)
+
+        return partial(
+            self._write_shard,
+            serialize_fn=partial(self.serialize_sample, encoding=encoding),
+            options=tf.io.TFRecordOptions(
+                compression_type=compression_type,
+                compression_level=compression_level
+            ),
+            samples_per_example=samples_per_example,
+            write_index=not compression_type
+        )
+
+    def _shards_ranges(
+            self,
+            size: int,
+            n_samples_per_shard: int,
+            drop_remainder: bool,
+            first_shard: int = 0
+    ) -> List[Tuple[str, int, int]]:
+        """
+        Split the samples into shards.
+
+        Params:
+            size: total number of samples
+            n_samples_per_shard: number of samples per shard
+            drop_remainder: whether the remaining samples should be dropped
+            first_shard: number of the first shard
+
+        Returns:
+            a list of (filepath, start, stop) tuples
+
+        """
+        nb_shards = size // n_samples_per_shard
+        if not drop_remainder and size % n_samples_per_shard > 0:
+            nb_shards += 1
+        return [
+            (
+                os.path.join(self.dirpath, f"{first_shard + i}.records"),
+                i * n_samples_per_shard,
+                min((i + 1) * n_samples_per_shard, size)
+            )
+            for i in range(nb_shards)
+        ]
+
+    def ds2tfrecord(
+            self,
+            dataset: Any,
+            n_samples_per_shard: int = 100,
+            drop_remainder: bool = True,
+            from_reader: bool = False,
+            shard_size_bytes: int = None,
+            append: bool = False,
+            **kwargs
+    ):
+        """
+        Convert and save samples from dataset object to tfrecord files.
+
+        Params:
+            dataset: Dataset object to convert into a set of tfrecords
+            n_samples_per_shard: Number of samples per shard
+            drop_remainder: Whether additional samples should be dropped.
+                Advisable if using multiworkers training. If True, all
+                TFRecords will have `n_samples_per_shard` samples
+            from_reader: If True, the samples are read directly from the
+                `dataset.patches_reader`, rather than from the dataset
+                iterator and buffers (see `reader2tfrecord()`). Each sample
+                is then written exactly once, and the miner thread of the
+                dataset is paused during the export. The `n_processes`,
+                `shuffle`, `seed`, `block_size`, `resume` and `stratify_key`
+                options are only valid in this mode.
+            shard_size_bytes: Optional, target size of the shards in bytes.
+                When set, `n_samples_per_shard` is ignored, and the number of
+                samples per shard is estimated from the size of one
+                serialized sample. This keeps the shards sizes homogeneous
+                across datasets with different patches sizes or bands
+                counts.
+            append: If True, the new shards are added to the existing ones
+                of the directory. The shapes and types of the samples, and
+                the options of the TFRecords files, must match the existing
+                metadata.
+            kwargs: options of the TFRecords files:
+                encoding: encoding of the tensors. "tensor" (default) stores
+                    serialized `TensorProto`, "raw" stores only the
+                    contiguous bytes of the arrays, which are cheaper to
+                    decode at read time.
+                compression_type: compression of the TFRecords files: ""
+                    (default, no compression), "GZIP" or "ZLIB". Compression
+                    reduces the size of the files at the cost of CPU time,
+                    which is useful when the storage is the bottleneck.
+                compression_level: Optional, compression level, from 0 to 9
+                samples_per_example: number of samples stacked in each
+                    `tf.train.Example` (default 1). For small patches,
+                    packing several samples in each example amortizes the
+                    per-record overhead (framing, checksum, parsing). The
+                    samples are unbatched by `read()`.
+                The options are saved in the metadata file and automatically
+                used by `read()`. Options of `reader2tfrecord()` can also be
+                used when `from_reader` is True.
+
+        """
+        reader_options = (
+            "n_processes", "shuffle", "seed", "block_size", "resume",
+            "stratify_key"
+        )
+        if from_reader:
+            # The miner thread of the dataset must not read the patches
+            # reader meanwhile, nor when the writers processes are forked
+            with dataset.mining_lock:
+                self.reader2tfrecord(
+                    dataset.patches_reader,
+                    n_samples_per_shard=n_samples_per_shard,
+                    drop_remainder=drop_remainder,
+                    shard_size_bytes=shard_size_bytes,
+                    append=append,
+                    **kwargs
+                )
+            return
+        invalid_options = [key for key in reader_options if key in kwargs]
+        if invalid_options:
+            raise Exception(
+                f"Options {invalid_options} are only valid with "
+                "from_reader=True"
+            )
+
+        logging.info("%s samples", dataset.size)
+        write_fn = self._prepare_output(
+            output_shapes=dict(dataset.output_shapes.items()),
+            output_types={
+                key: output_type.name
+                for key, output_type in dataset.output_types.items()
+            },
+            append=append,
+            **kwargs
+        )
+        if shard_size_bytes:
+            with dataset.mining_lock:
+                one_sample = dataset.patches_reader.get_sample(index=0)
+            n_samples_per_shard = self._n_samples_per_shard_from_size(
+                one_sample, shard_size_bytes
+            )
+        session, _ = self._start_session(
+            dataset.size, n_samples_per_shard, drop_remainder, append=append
+        )
+        for filepath, start, stop in tqdm(self._shards_ranges(
+                dataset.size, n_samples_per_shard, drop_remainder,
+                first_shard=session["first_shard"]
+        )):
+            self._add_to_manifest(write_fn(
+                filepath,
+                (dataset.read_one_sample() for _ in range(stop - start))
+            ))
 
-    @staticmethod
-    def _bytes_feature(value):
+    def reader2tfrecord(
+            self,
+            patches_reader: Any,
+            n_samples_per_shard: int = 100,
+            drop_remainder: bool = True,
+            n_processes: int = 1,
+            shuffle: bool = False,
+            seed: int = None,
+            block_size: int = 256,
+            shard_size_bytes: int = None,
+            append: bool = False,
+            resume: bool = False,
+            stratify_key: str = None,
+            **kwargs
+    ):
         """
-        Convert a value to a type compatible with tf.train.Example.
+        Convert and save all samples of a patches reader to tfrecord files.
+        The samples are streamed directly from the patches reader, by blocks,
+        and each sample is written exactly once.
 
         Params:
-            value: value
+            patches_reader: the patches reader
+                (`otbtf.dataset.PatchesReaderBase`)
+            n_samples_per_shard: Number of samples per shard
+            drop_remainder: Whether additional samples should be dropped
+            n_processes: Number of processes used to write the shards. When
+                greater than 1, the shards are written by a pool of forked
+                processes, each one writing whole shards from disjoint sets
+                of samples indices.
+            shuffle: If False, the samples are written in the order of the
+                patches reader. If True, one single global random permutation
+                of the samples is applied, so that the shards are already
+                shuffled, and only a small shuffle buffer is needed at read
+                time.
+            seed: Optional, seed of the random permutation
+            block_size: number of samples read at once from the reader
+                (see `otbtf.dataset.PatchesReaderBase.get_samples()`)
+            shard_size_bytes: Optional, target size of the shards in bytes
+                (see `ds2tfrecord()`)
+            append: If True, the new shards are added to the existing ones
+                (see `ds2tfrecord()`)
+            resume: If True, resume an interrupted writing: the shards
+                already written (i.e. listed in the manifest) are skipped.
+                The shards partition and the random permutation are those of
+                the interrupted writing, so the same patches reader must be
+                used.
+            stratify_key: Optional, key of the label patches used to
+                compose the shards with a near-constant classes mix. The
+                dominant class of each sample is computed in a first pass
+                over the patches reader, then the samples are ordered so
+                that each shard has about the same classes proportions as
+                the whole dataset. Small shuffle buffers are then enough at
+                read time to get well-mixed batches.
+            kwargs: options of the TFRecords files (see `ds2tfrecord()`)
+
+        The shards are written atomically, and added to the manifest as soon
+        as they are complete.
 
-        Returns:
-            a bytes_list from a string / byte.
         """
-        if isinstance(value, type(tf.constant(0))):
-            value = value.numpy()  # BytesList won't unpack a string from
-            # an EagerTensor.
-        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+        size = patches_reader.get_size()
+        logging.info("%s samples", size)
+        one_sample = patches_reader.get_sample(index=0)
+        write_fn = self._prepare_output(
+            **self._output_specs(one_sample),
+            append=append or resume,
+            **kwargs
+        )
+        if shard_size_bytes:
+            n_samples_per_shard = self._n_samples_per_shard_from_size(
+                one_sample, shard_size_bytes
+            )
 
-    def ds2tfrecord(
+        session, done = self._start_session(
+            size, n_samples_per_shard, drop_remainder, shuffle=shuffle,
+            seed=seed, append=append, resume=resume,
+            stratify_key=stratify_key
+        )
+        indices = np.random.default_rng(session["seed"]).permutation(size) \
+            if session["shuffle"] else np.arange(size)
+        if session.get("stratify_key"):
+            classes = dominant_classes(
+                patches_reader, session["stratify_key"], block_size
+            )
+            indices = stratify(indices, classes[indices])
+        shards = [
+            (filepath, indices[start:stop], block_size)
+            for filepath, start, stop in self._shards_ranges(
+                size, session["n_samples_per_shard"],
+                session["drop_remainder"], first_shard=session["first_shard"]
+            )
+            if os.path.basename(filepath) not in done
+        ]
+
+        if n_processes > 1:
+            logging.info("Writing TFRecords with %s processes", n_processes)
+            with multiprocessing.get_context("fork").Pool(
+                    processes=n_processes,
+                    initializer=_init_writer_process,
+                    initargs=(patches_reader, write_fn)
+            ) as pool:
+                for shard in tqdm(
+                        pool.imap_unordered(_write_shard_from_reader, shards),
+                        total=len(shards)
+                ):
+                    self._add_to_manifest(shard)
+            return
+
+        for filepath, shard_indices, _ in tqdm(shards):
+            self._add_to_manifest(write_fn(
+                filepath,
+                read_samples_by_blocks(
+                    patches_reader, indices=shard_indices,
+                    block_size=block_size
+                )
+            ))
+
+    def write_stream(
             self,
-            dataset: Any,
+            samples: Iterable[Dict[str, Any]],
             n_samples_per_shard: int = 100,
-            drop_remainder: bool = True
-    ):
+            drop_remainder: bool = True,
+            append: bool = False,
+            **kwargs
+    ) -> int:
         """
-        Convert and save samples from dataset object to tfrecord files.
+        Save samples from any iterable (e.g. a generator) to tfrecord files.
+        The number of samples doesn't need to be known in advance: the
+        samples of each shard are gathered, then the shard is written and
+        added to the manifest. Only the samples of one shard are kept in
+        memory.
 
         Params:
-            dataset: Dataset object to convert into a set of tfrecords
+            samples: iterable of samples (dicts of numpy arrays)
             n_samples_per_shard: Number of samples per shard
-            drop_remainder: Whether additional samples should be dropped.
-                Advisable if using multiworkers training. If True, all
-                TFRecords will have `n_samples_per_shard` samples
+            drop_remainder: Whether additional samples should be dropped
+            append: If True, the new shards are added to the existing ones
+                (see `ds2tfrecord()`)
+            kwargs: options of the TFRecords files (see `ds2tfrecord()`)
 
-        """
-        logging.info("%s samples", dataset.size)
+        Returns:
+            the number of written samples
 
-        nb_shards = dataset.size // n_samples_per_shard
-        if not drop_remainder and dataset.size % n_samples_per_shard > 0:
-            nb_shards += 1
+        """
+        samples = iter(samples)
+        one_sample = next(samples, None)
+        if one_sample is None:
+            logging.warning("No sample to write in %s", self.dirpath)
+            return 0
+        write_fn = self._prepare_output(
+            **self._output_specs(one_sample), append=append, **kwargs
+        )
+        session, _ = self._start_session(
+            None, n_samples_per_shard, drop_remainder, append=append
+        )
+        samples = itertools.chain([one_sample], samples)
+        n_samples = 0
+        for shard_number in itertools.count(session["first_shard"]):
+            shard_samples = list(
+                itertools.islice(samples, n_samples_per_shard)
+            )
+            if not shard_samples or drop_remainder and \
+                    len(shard_samples) < n_samples_per_shard:
+                break
+            shard = write_fn(
+                os.path.join(self.dirpath, f"{shard_number}.records"),
+                shard_samples
+            )
+            self._add_to_manifest(shard)
+            n_samples += shard["n_samples"]
+        logging.info("%s samples written in %s", n_samples, self.dirpath)
+        return n_samples
 
-        output_shapes = dict(dataset.output_shapes.items())
-        self.save(output_shapes, self.output_shapes_file)
+    def save_stats(self, stats: Dict[str, Dict[str, Any]]):
+        """
+        Save the statistics of the samples in the stats file of the
+        directory.
 
-        output_types = {
-            key: output_type.name
-            for key, output_type in dataset.output_types.items()
-        }
-        self.save(output_types, self.output_types_file)
+        Params:
+            stats: statistics dict (see
+                `otbtf.dataset.PatchesReaderBase.get_stats()`)
 
-        for i in tqdm(range(nb_shards)):
+        """
+        self.save(
+            {
+                src_key: {
+                    name: np.asarray(value).tolist()
+                    for name, value in src_stats.items()
+                }
+                for src_key, src_stats in stats.items()
+            },
+            self.stats_file
+        )
 
-            if (i + 1) * n_samples_per_shard <= dataset.size:
-                nb_sample = n_samples_per_shard
-            else:
-                nb_sample = dataset.size - i * n_samples_per_shard
-
-            filepath = os.path.join(self.dirpath, f"{i}.records")
-            with tf.io.TFRecordWriter(filepath) as writer:
-                for _ in range(nb_sample):
-                    sample = dataset.read_one_sample()
-                    serialized_sample = {
-                        name: tf.io.serialize_tensor(fea)
-                        for name, fea in sample.items()
-                    }
-                    features = {
-                        name: self._bytes_feature(serialized_tensor)
-                        for name, serialized_tensor in
-                        serialized_sample.items()
-                    }
-                    tf_features = tf.train.Features(feature=features)
-                    example = tf.train.Example(features=tf_features)
-                    writer.write(example.SerializeToString())
+    def load_stats(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Returns:
+            the statistics saved with `save_stats()`, as numpy arrays, or
+            None when the stats file doesn't exist
+        """
+        if not os.path.exists(self.stats_file):
+            return None
+        return {
+            src_key: {
+                name: np.asarray(value)
+                for name, value in src_stats.items()
+            }
+            for src_key, src_stats in self.load(self.stats_file).items()
+        }
 
     @staticmethod
     def save(data: Dict[str, Any], filepath: str):
         """
-        Save data to JSON format.
+        Save data to JSON format. The file is written with a temporary name,
+        then renamed.
 
         Params:
             data: Data to save json format
             filepath: Output file name
 
         """
-        with open(filepath, 'w') as file:
+        with open(f"{filepath}.tmp", 'w') as file:
             json.dump(data, file, indent=4)
+        os.replace(f"{filepath}.tmp", filepath)
 
     @staticmethod
     def load(filepath: str):
@@ -156,40 +1452,159 @@ class TFRecords:
         with open(filepath, 'r') as file:
             return json.load(file)
 
-    def parse_tfrecord(
+    def _read_features(
+            self,
+            keys: List[str] = None
+    ) -> Dict[str, tf.io.FixedLenFeature]:
+        """
+        Returns the features to parse, for the given keys (all keys when not
+        set)
+        """
+        keys = list(self.output_types) if keys is None else keys
+        unknown = [key for key in keys if key not in self.output_types]
+        if unknown:
+            raise Exception(
+                f"Unknown keys {unknown}. Available keys are "
+                f"{list(self.output_types)}"
+            )
+        return {
+            key: tf.io.FixedLenFeature([], dtype=tf.string) for key in keys
+        }
+
+    def decode_example(
             self,
             example: Any,
+            keys: List[str] = None
+    ) -> Dict[str, tf.Tensor]:
+        """
+        Parse and decode the tensors of one example. When the examples
+        contain multiple samples (see `samples_per_example`), the returned
+        tensors have an additional first dimension, the number of samples.
+
+        Params:
+            example: Example object to parse
+            keys: Optional, keys of the tensors to parse and decode. The
+                other tensors are skipped. When not set, all tensors are
+                decoded.
+
+        Returns:
+            dict of tensors
+
+        """
+        example_parsed = tf.io.parse_single_example(
+            example, self._read_features(keys)
+        )
+        return self._decode_tensors(
+            example_parsed, batched=self.samples_per_example > 1
+        )
+
+    def decode_examples(
+            self,
+            examples: Any,
+            keys: List[str] = None
+    ) -> Dict[str, tf.Tensor]:
+        """
+        Parse and decode the tensors of a batch of examples at once, with
+        one single `tf.io.parse_example` call. With the "raw" encoding, the
+        tensors of the whole batch are also decoded at once, while with the
+        "tensor" encoding they are decoded one by one. The examples must
+        contain one single sample each.
+
+        Params:
+            examples: 1D tensor of serialized examples
+            keys: Optional, keys of the tensors to parse and decode (see
+                `decode_example()`)
+
+        Returns:
+            dict of tensors, with the batch dimension first
+
+        """
+        examples_parsed = tf.io.parse_example(
+            examples, self._read_features(keys)
+        )
+        return self._decode_tensors(examples_parsed, batched=True)
+
+    def _decode_tensors(
+            self,
+            parsed: Dict[str, tf.Tensor],
+            batched: bool = False
+    ) -> Dict[str, tf.Tensor]:
+        """
+        Decode the serialized tensors of parsed examples.
+
+        Params:
+            parsed: dict of serialized tensors, for all or some of the keys
+            batched: whether the tensors have an additional first dimension,
+                i.e. the samples are stacked in each example, or the
+                examples are parsed by batch
+
+        Returns:
+            dict of tensors
+
+        """
+        output_shapes = {
+            key: [None] + list(self.output_shapes[key]) if batched
+            else self.output_shapes[key]
+            for key in parsed
+        }
+
+        # Tensor with right data type
+        decoded = {}
+        for key in parsed:
+            out_type = self.output_types[key]
+            if self.encoding == "raw":
+                decoded[key] = tf.reshape(
+                    tf.io.decode_raw(
+                        parsed[key],
+                        out_type=out_type,
+                        little_endian=True
+                    ),
+                    [-1 if dim is None else dim for dim in output_shapes[key]]
+                )
+            elif parsed[key].shape.rank == 1:
+                # Batch of serialized tensors
+                decoded[key] = tf.map_fn(
+                    partial(tf.io.parse_tensor, out_type=out_type),
+                    parsed[key],
+                    fn_output_signature=tf.TensorSpec(
+                        self.output_shapes[key], out_type
+                    )
+                )
+            else:
+                decoded[key] = tf.io.parse_tensor(
+                    parsed[key],
+                    out_type=out_type
+                )
+
+        # Ensure shape
+        for key, shape in output_shapes.items():
+            decoded[key] = tf.ensure_shape(decoded[key], shape)
+
+        return decoded
+
+    @staticmethod
+    def prepare_sample(
+            sample: Dict[str, tf.Tensor],
             target_keys: List[str],
             preprocessing_fn: Callable = None,
             **kwargs
     ):
         """
-        Parse example object to sample dict.
+        Apply the preprocessing function to one sample, and split it into
+        inputs and targets.
 
         Params:
-            example: Example object to parse
+            sample: dict of tensors
             target_keys: list of keys of the targets
             preprocessing_fn: Optional. A preprocessing function that process
                 the input example
             kwargs: some keywords arguments for preprocessing_fn
 
-        """
-        read_features = {
-            key: tf.io.FixedLenFeature([], dtype=tf.string)
-            for key in self.output_types
-        }
-        example_parsed = tf.io.parse_single_example(example, read_features)
-
-        # Tensor with right data type
-        for key, out_type in self.output_types.items():
-            example_parsed[key] = tf.io.parse_tensor(
-                example_parsed[key],
-                out_type=out_type
-            )
+        Returns:
+            a tuple of dicts (inputs, targets)
 
-        # Ensure shape
-        for key, shape in self.output_shapes.items():
-            example_parsed[key] = tf.ensure_shape(example_parsed[key], shape)
+        """
+        example_parsed = sample
 
         # Preprocessing
         example_parsed_prep = preprocessing_fn(
@@ -208,6 +1623,54 @@ class TFRecords:
 
         return input_parsed, target_parsed
 
+    @staticmethod
+    def _vectorized_preprocessing(
+            batch: Dict[str, tf.Tensor],
+            preprocessing_fn: Callable,
+            **kwargs
+    ) -> Dict[str, tf.Tensor]:
+        """
+        Apply a preprocessing function written for one single sample to a
+        batch of samples, using `tf.vectorized_map`.
+
+        Params:
+            batch: dict of tensors, with the batch dimension first
+            preprocessing_fn: preprocessing function of one sample
+            kwargs: some keywords arguments for preprocessing_fn
+
+        Returns:
+            dict of preprocessed tensors
+
+        """
+        return tf.vectorized_map(partial(preprocessing_fn, **kwargs), batch)
+
+    def parse_tfrecord(
+            self,
+            example: Any,
+            target_keys: List[str],
+            preprocessing_fn: Callable = None,
+            **kwargs
+    ):
+        """
+        Parse example object to sample dict.
+
+        Params:
+            example: Example object to parse
+            target_keys: list of keys of the targets
+            preprocessing_fn: Optional. A preprocessing function that process
+                the input example
+            kwargs: some keywords arguments for preprocessing_fn
+
+        """
+        assert self.samples_per_example == 1, \
+            "Examples with multiple samples must be unbatched first"
+        return self.prepare_sample(
+            self.decode_example(example),
+            target_keys=target_keys,
+            preprocessing_fn=preprocessing_fn,
+            **kwargs
+        )
+
     def read(
             self,
             batch_size: int,
@@ -219,6 +1682,19 @@ class TFRecords:
             shard_policy=tf.data.experimental.AutoShardPolicy.AUTO,
             prefetch_buffer_size: int = tf.data.experimental.AUTOTUNE,
             num_parallel_calls: int = tf.data.experimental.AUTOTUNE,
+            read_buffer_size: int = None,
+            cycle_length: int = None,
+            block_length: int = 1,
+            shuffle_files: bool = False,
+            deterministic: bool = None,
+            seed: int = None,
+            batch_parsing: bool = False,
+            batch_preprocessing: bool = False,
+            keys: List[str] = None,
+            input_context: tf.distribute.InputContext = None,
+            cache: str = None,
+            augment: bool = False,
+            augment_exclude_keys: List[str] = None,
             **kwargs
     ):
         """
@@ -256,8 +1732,75 @@ class TFRecords:
             prefetch_buffer_size: buffer size for the prefetch operation
             num_parallel_calls: number of parallel calls for the parsing +
                 preprocessing step
+            read_buffer_size: Optional, size in bytes of the read buffer of
+                each TFRecords file. When not set, the size is chosen from
+                the compression type stored in the metadata (see
+                `READ_BUFFER_SIZES`)
+            cycle_length: Optional, number of TFRecords files read
+                concurrently. When not set, the files are read one after the
+                other. Reading several files concurrently is useful when the
+                files are on a network storage, with a high latency.
+            block_length: number of consecutive records read from each file
+                before switching to the next one, when `cycle_length` is set
+            shuffle_files: if True, the order of the TFRecords files is
+                shuffled at each epoch
+            deterministic: Optional, whether the elements are delivered in a
+                deterministic order. When False, the elements of the files
+                read concurrently are delivered as soon as they are
+                available, which avoids waiting for slow reads. When not set,
+                the order is non-deterministic only if `shuffle_buffer_size`
+                is set.
+            seed: Optional, seed of the files shuffling
+            batch_parsing: if True, the serialized records are batched
+                first, then each batch is parsed and decoded at once (see
+                `decode_examples()`). With the "raw" encoding, this removes
+                the per-example overhead of the parsing and decoding. With
+                the "tensor" encoding, the tensors are still decoded one by
+                one, which is slower: batch parsing is intended for the
+                "raw" encoding. Not available when the examples contain
+                multiple samples.
+            batch_preprocessing: if True, `preprocessing_fn` is applied to
+                whole batches rather than to single samples. Only used with
+                `batch_parsing`: otherwise, `preprocessing_fn` is vectorized
+                over the batch with `tf.vectorized_map`.
+            keys: Optional, keys of the tensors to read. The other tensors
+                are not parsed nor decoded, which saves CPU time and memory
+                bandwidth when the model uses only some of the sources. When
+                not set, all tensors are read.
+            input_context: Optional, input context of the worker, when the
+                datasets are created by each worker (see
+                `tf.distribute.Strategy.distribute_datasets_from_function`).
+                The dataset of the worker then contains only its own shards,
+                and is limited to `steps()` batches, so that all workers
+                deliver the same number of batches. `n_workers` and
+                `shard_policy` are ignored.
+            cache: Optional, caches the parsed and preprocessed samples at
+                the first epoch, so that the next epochs don't parse and
+                preprocess them again. `CACHE_MEMORY` ("memory") keeps them
+                in memory, any other value is a local directory where the
+                cache files are written. The cache files are specific to the
+                TFRecords files, the metadata, the `preprocessing_fn` code
+                and the reading options, hence a stale cache is never used.
+                The shuffling is applied after the cache.
+            augment: if True, a random flip/rotation is applied to each
+                sample, after the batching (see
+                `otbtf.ops.dihedral_augmentation()`)
+            augment_exclude_keys: Optional, keys of the tensors that are not
+                augmented (e.g. scalar inputs)
             kwargs: some keywords arguments for `preprocessing_fn`
 
+        When the directory has a manifest, all shards are used: they are
+        distributed among the workers according to their numbers of samples
+        (see `_workers_shards()`), rather than truncated to a multiple of the
+        number of workers. With file-based auto-sharding, the balance holds
+        as long as `shuffle_files` is False: use `input_context` to keep
+        balanced workers while shuffling the files. The cardinality of the
+        returned dataset is asserted when there is only one worker or when
+        `input_context` is set, and `steps()` gives the number of steps of
+        each worker. With several workers and no `input_context`, the
+        dataset is sharded afterwards by the distribution strategy, hence
+        its cardinality is unknown and a warning is logged.
+
         """
         for dic, file in zip([self.output_types,
                               self.output_shapes],
@@ -266,25 +1809,72 @@ class TFRecords:
             assert dic, f"The file {file} is missing!"
 
         options = tf.data.Options()
-        if shuffle_buffer_size:
+        if deterministic is not None:
+            options.experimental_deterministic = deterministic
+        elif shuffle_buffer_size:
             # disable order, increase speed
             options.experimental_deterministic = False
         # for multiworker
+        if input_context:
+            n_workers = input_context.num_input_pipelines
+            shard_policy = tf.data.experimental.AutoShardPolicy.OFF
         options.experimental_distribute.auto_shard_policy = shard_policy
-        parse = partial(
-            self.parse_tfrecord,
+        self._read_features(keys)  # raises if some keys are unknown
+        if batch_parsing and self.samples_per_example > 1:
+            raise Exception(
+                "Batch parsing is not available for examples containing "
+                "multiple samples"
+            )
+        if batch_parsing and preprocessing_fn and not batch_preprocessing:
+            preprocessing_fn = partial(
+                self._vectorized_preprocessing,
+                preprocessing_fn=preprocessing_fn
+            )
+
+        prepare = partial(
+            self.prepare_sample,
             target_keys=target_keys,
             preprocessing_fn=preprocessing_fn,
             **kwargs
         )
 
-        # 1/ num_parallel_reads useful ? I/O bottleneck of not ?
-        # 2/ num_parallel_calls=tf.data.experimental.AUTOTUNE useful ?
         tfrecords_pattern_path = os.path.join(self.dirpath, "*.records")
-        matching_files = glob.glob(tfrecords_pattern_path)
-        logging.info('Searching TFRecords in %s...', tfrecords_pattern_path)
-        logging.info('Number of matching TFRecords: %s', len(matching_files))
-        matching_files = matching_files[:n_workers * (
+        n_batches = None
+        n_worker_samples = None
+        if self.manifest:
+            shards = self._workers_shards(n_workers)[
+                input_context.input_pipeline_id
+            ] if input_context else self._read_shards(n_workers)
+            matching_files = [
+                os.path.join(self.dirpath, shard["filename"])
+                for shard in shards
+            ]
+            if input_context or n_workers == 1:
+                # The cardinality is known from the manifest
+                n_batches = self.steps(
+                    batch_size, n_workers, drop_remainder=drop_remainder
+                )
+            else:
+                # The dataset is sharded afterwards, by the distribution
+                # strategy: its cardinality can't be asserted here
+                logging.warning(
+                    "The cardinality of the dataset is unknown with %s "
+                    "workers: use input_context to get datasets of exactly "
+                    "steps() batches", n_workers
+                )
+            if input_context:
+                # The workers with more samples are truncated, before the
+                # cache so that it is completed at the end of each epoch
+                n_worker_samples = self._worker_samples(n_workers)
+        else:
+            matching_files = glob.glob(tfrecords_pattern_path)
+            logging.info(
+                'Searching TFRecords in %s...', tfrecords_pattern_path
+            )
+            logging.info(
+                'Number of matching TFRecords: %s', len(matching_files)
+            )
+            matching_files = matching_files[:n_workers * (
                 len(matching_files) // n_workers)]  # files multiple of workers
         nb_matching_files = len(matching_files)
         if nb_matching_files == 0:
@@ -294,16 +1884,314 @@ class TFRecords:
                 "TFRecord files is greater or equal than the number of "
                 "workers!"
             )
-        logging.info('Reducing number of records to : %s', nb_matching_files)
-        dataset = tf.data.TFRecordDataset(
-            matching_files
-        )  # , num_parallel_reads=2)  # interleaves reads from xxx files
+        logging.info('Number of records: %s', nb_matching_files)
+        files = tf.data.Dataset.from_tensor_slices(matching_files)
+        if shuffle_files:
+            files = files.shuffle(
+                buffer_size=nb_matching_files, seed=seed,
+                reshuffle_each_iteration=True
+            )
+        records = partial(
+            tf.data.TFRecordDataset,
+            compression_type=self.compression_type,
+            buffer_size=read_buffer_size or READ_BUFFER_SIZES[
+                self.compression_type
+            ]
+        )
+        if cycle_length:
+            # interleaves reads from `cycle_length` files
+            dataset = files.interleave(
+                records,
+                cycle_length=cycle_length,
+                block_length=block_length,
+                num_parallel_calls=num_parallel_calls,
+                deterministic=deterministic
+            )
+        else:
+            dataset = records(files)
         # uses data as soon as it streams in, rather than in its original order
         dataset = dataset.with_options(options)
-        dataset = dataset.map(parse, num_parallel_calls=num_parallel_calls)
-        if shuffle_buffer_size:
-            dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
-        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+        cache_identity = {
+            "files": [
+                [shard["filename"], shard["crc32"]] for shard in shards
+            ] if self.manifest else [
+                [filepath, os.path.getsize(filepath),
+                 os.path.getmtime(filepath)]
+                for filepath in matching_files
+            ],
+            "metadata": self.metadata,
+            "output_shapes": self.output_shapes,
+            "output_types": self.output_types,
+            "keys": keys,
+            "target_keys": target_keys,
+            "batch_parsing": batch_parsing,
+            "batch_size": batch_size if batch_parsing else None,
+            "preprocessing_fn": function_identity(preprocessing_fn),
+            "kwargs": kwargs
+        }
+        if batch_parsing:
+            # The serialized records are shuffled, then batched. When the
+            # batches are cached, they are unbatched then shuffled again.
+            rebatch = cache and shuffle_buffer_size
+            if n_worker_samples is not None:
+                dataset = dataset.take(n_worker_samples)
+            if shuffle_buffer_size:
+                dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+            dataset = dataset.batch(
+                batch_size, drop_remainder=drop_remainder and not rebatch
+            )
+            dataset = dataset.map(
+                partial(self.decode_examples, keys=keys),
+                num_parallel_calls=num_parallel_calls
+            )
+            dataset = dataset.map(
+                prepare, num_parallel_calls=num_parallel_calls
+            )
+            if cache:
+                dataset = cache_dataset(dataset, cache, cache_identity)
+            if rebatch:
+                dataset = dataset.unbatch()
+                dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+                dataset = dataset.batch(
+                    batch_size, drop_remainder=drop_remainder
+                )
+        else:
+            dataset = dataset.map(
+                partial(self.decode_example, keys=keys),
+                num_parallel_calls=num_parallel_calls
+            )
+            if self.samples_per_example > 1:
+                dataset = dataset.unbatch()
+            if n_worker_samples is not None:
+                dataset = dataset.take(n_worker_samples)
+            dataset = dataset.map(
+                prepare, num_parallel_calls=num_parallel_calls
+            )
+            if cache:
+                dataset = cache_dataset(dataset, cache, cache_identity)
+            if shuffle_buffer_size:
+                dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+            dataset = dataset.batch(
+                batch_size, drop_remainder=drop_remainder
+            )
+        if augment:
+            dataset = dataset.map(
+                partial(
+                    ops.dihedral_augmentation,
+                    exclude_keys=augment_exclude_keys
+                ),
+                num_parallel_calls=num_parallel_calls
+            )
+        if n_batches is not None:
+            dataset = dataset.apply(
+                tf.data.experimental.assert_cardinality(n_batches)
+            )
         dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
 
         return dataset
+
+
+class SavedDataset:
+    """
+    This class allows to save samples in the TensorFlow native format of
+    `tf.data.Dataset.save()`, and to load them as a TF dataset. The tensors
+    are stored without protobuf serialization, and the shards are read in
+    parallel. The shapes and types of the tensors are stored in the same
+    metadata files as the TFRecords (see `TFRecords`).
+    """
+
+    def __init__(self, path: str):
+        """
+        Params:
+            path: directory where the dataset must be saved/loaded
+        """
+        self.dirpath = path
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.data_dirpath = os.path.join(self.dirpath, "data")
+        self.output_types_file = os.path.join(
+            self.dirpath, "output_types.json"
+        )
+        self.output_shapes_file = os.path.join(
+            self.dirpath, "output_shapes.json"
+        )
+        self.metadata_file = os.path.join(self.dirpath, "metadata.json")
+        self.output_shapes = TFRecords.load(self.output_shapes_file) \
+            if os.path.exists(self.output_shapes_file) else None
+        self.output_types = TFRecords.load(self.output_types_file) \
+            if os.path.exists(self.output_types_file) else None
+        self.metadata = TFRecords.load(self.metadata_file) \
+            if os.path.exists(self.metadata_file) else None
+
+    @property
+    def num_samples(self) -> int:
+        """
+        Returns:
+            the number of saved samples (None when nothing is saved)
+        """
+        return self.metadata["n_samples"] if self.metadata else None
+
+    def _element_spec(self) -> Tuple[tf.TensorSpec, Dict[str, tf.TensorSpec]]:
+        """
+        Returns the element spec of the saved dataset, i.e. the index of the
+        sample and the sample
+        """
+        return (
+            tf.TensorSpec([], tf.int64),
+            {
+                key: tf.TensorSpec(self.output_shapes[key], out_type)
+                for key, out_type in self.output_types.items()
+            }
+        )
+
+    def write(
+            self,
+            patches_reader: Any,
+            n_shards: int = 8,
+            compression: str = None,
+            shard_func: Callable = None,
+            shuffle: bool = False,
+            seed: int = None,
+            block_size: int = 256
+    ):
+        """
+        Save all samples of a patches reader. The samples are streamed from
+        the patches reader, by blocks, and each sample is written exactly
+        once.
+
+        Params:
+            patches_reader: the patches reader
+                (`otbtf.dataset.PatchesReaderBase`)
+            n_shards: number of shards, used when `shard_func` is not set.
+                The samples are assigned to the shards in a round-robin
+                fashion.
+            compression: Optional, "GZIP" or "SNAPPY"
+            shard_func: Optional, function returning the shard (int64 scalar
+                tensor) of one sample, from the index of the sample and the
+                sample itself (dict of tensors)
+            shuffle: If True, one single global random permutation of the
+                samples is applied
+            seed: Optional, seed of the random permutation
+            block_size: number of samples read at once from the reader
+                (see `otbtf.dataset.PatchesReaderBase.get_samples()`)
+
+        """
+        size = patches_reader.get_size()
+        logging.info("%s samples", size)
+        specs = TFRecords._output_specs(  # pylint: disable=W0212
+            patches_reader.get_sample(index=0)
+        )
+        self.output_shapes = specs["output_shapes"]
+        self.output_types = specs["output_types"]
+        indices = np.random.default_rng(seed).permutation(size) \
+            if shuffle else np.arange(size)
+
+        def _generator():
+            yield from enumerate(read_samples_by_blocks(
+                patches_reader, indices=indices, block_size=block_size
+            ))
+
+        dataset = tf.data.Dataset.from_generator(
+            _generator, output_signature=self._element_spec()
+        )
+        dataset.save(
+            self.data_dirpath,
+            compression=compression,
+            shard_func=shard_func or (
+                lambda index, _: index % n_shards
+            )
+        )
+        TFRecords.save(self.output_shapes, self.output_shapes_file)
+        TFRecords.save(self.output_types, self.output_types_file)
+        self.metadata = {
+            "format": "tf.data.Dataset.save",
+            "compression": compression,
+            "n_samples": size
+        }
+        TFRecords.save(self.metadata, self.metadata_file)
+
+    def read(
+            self,
+            batch_size: int,
+            target_keys: List[str],
+            drop_remainder: bool = True,
+            shuffle_buffer_size: int = None,
+            preprocessing_fn: Callable = None,
+            prefetch_buffer_size: int = tf.data.experimental.AUTOTUNE,
+            num_parallel_calls: int = tf.data.experimental.AUTOTUNE,
+            shuffle_shards: bool = False,
+            deterministic: bool = None,
+            keys: List[str] = None,
+            **kwargs
+    ) -> tf.data.Dataset:
+        """
+        Load the saved samples as a TF dataset. The shards are read in
+        parallel.
+
+        Params:
+            batch_size: Size of tensorflow batch
+            target_keys: Keys of the target, e.g. ['s2_out']
+            drop_remainder: whether the last batch should be dropped in the
+                case it has fewer than `batch_size` elements
+            shuffle_buffer_size: if None, shuffle is not used. Else, blocks of
+                shuffle_buffer_size elements are shuffled using uniform random.
+            preprocessing_fn: Optional. A preprocessing function that takes
+                input examples as args and returns the preprocessed input
+                examples (see `TFRecords.read()`)
+            prefetch_buffer_size: buffer size for the prefetch operation
+            num_parallel_calls: number of shards read in parallel, and of
+                parallel calls for the preprocessing step
+            shuffle_shards: if True, the order of the shards is shuffled at
+                each epoch
+            deterministic: Optional, whether the elements are delivered in a
+                deterministic order (see `TFRecords.read()`)
+            keys: Optional, keys of the tensors to read. The other tensors
+                are discarded.
+            kwargs: some keywords arguments for `preprocessing_fn`
+
+        Returns:
+            the TF dataset
+
+        """
+        if not self.metadata:
+            raise Exception(f"The file {self.metadata_file} is missing!")
+        keys = list(self.output_types) if keys is None else keys
+        unknown = [key for key in keys if key not in self.output_types]
+        if unknown:
+            raise Exception(
+                f"Unknown keys {unknown}. Available keys are "
+                f"{list(self.output_types)}"
+            )
+
+        def _reader_func(shards: tf.data.Dataset) -> tf.data.Dataset:
+            if shuffle_shards:
+                shards = shards.shuffle(buffer_size=1024)
+            return shards.interleave(
+                lambda shard: shard,
+                num_parallel_calls=num_parallel_calls,
+                deterministic=deterministic
+            )
+
+        dataset = tf.data.Dataset.load(
+            self.data_dirpath,
+            element_spec=self._element_spec(),
+            compression=self.metadata["compression"],
+            reader_func=_reader_func
+        )
+        prepare = partial(
+            TFRecords.prepare_sample,
+            target_keys=target_keys,
+            preprocessing_fn=preprocessing_fn,
+            **kwargs
+        )
+        dataset = dataset.map(
+            lambda _, sample: prepare({key: sample[key] for key in keys}),
+            num_parallel_calls=num_parallel_calls
+        )
+        if shuffle_buffer_size:
+            dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(
+            self.num_samples // batch_size if drop_remainder
+            else math.ceil(self.num_samples / batch_size)
+        ))
+        return dataset.prefetch(buffer_size=prefetch_buffer_size)
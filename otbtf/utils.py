@@ -23,9 +23,23 @@ tree/master/otbtf/utils.py){ .md-button }
 
 The utils module provides some helpers to read patches using gdal
 """
-from osgeo import gdal
+import hashlib
+import io
+import logging
+import os
+import queue
+import threading
+import weakref
+import zlib
+from collections import namedtuple, OrderedDict
+from typing import Any, Dict, Iterator, List, Tuple
+
+from osgeo import gdal, gdal_array, ogr
 import numpy as np
 
+# Region of a raster, in pixels
+Window = namedtuple("Window", ["x_off", "y_off", "x_size", "y_size"])
+
 
 def gdal_open(filename: str):
     """
@@ -49,7 +63,8 @@ def read_as_np_arr(
         dtype: np.dtype = None
 ) -> np.ndarray:
     """
-    Read a GDAL raster as numpy array
+    Read a GDAL raster as numpy array. The whole raster is read in memory:
+    use `read_windows()` for large rasters.
 
     Params:
         gdal_ds: a GDAL dataset instance
@@ -79,3 +94,871 @@ def read_as_np_arr(
         buffer = buffer.astype(dtype)
 
     return buffer
+
+
+def _aligned_size(size: int, native_size: int, raster_size: int) -> int:
+    """
+    Returns `size` rounded up to a multiple of `native_size`, and capped to
+    `raster_size`
+    """
+    return min(raster_size, -(-size // native_size) * native_size)
+
+
+def iter_windows(
+        gdal_ds,
+        block_size: int = 512,
+        overlap: int = 0
+) -> Iterator[Tuple[Window, Window]]:
+    """
+    Split a GDAL raster into windows aligned on its native blocks layout.
+
+    Params:
+        gdal_ds: a GDAL dataset instance
+        block_size: size of the windows, in pixels. In each dimension, the
+            size is rounded up to a multiple of the native block size of the
+            raster (e.g. the tiles of a tiled GeoTiff, or the rows of a
+            striped one), so that each native block is decoded only once.
+        overlap: number of pixels added on each side of the windows
+            (clipped to the raster extent)
+
+    Yields:
+        (core, window) tuples, where core is the region of the raster
+        covered by the window without overlap, and window the region
+        including the overlap
+
+    """
+    width, height = gdal_ds.RasterXSize, gdal_ds.RasterYSize
+    native_x, native_y = gdal_ds.GetRasterBand(1).GetBlockSize()
+    step_x = _aligned_size(block_size, native_x, width)
+    step_y = _aligned_size(block_size, native_y, height)
+    for y_off in range(0, height, step_y):
+        for x_off in range(0, width, step_x):
+            core = Window(
+                x_off, y_off, min(step_x, width - x_off),
+                min(step_y, height - y_off)
+            )
+            x_start, y_start = max(0, x_off - overlap), max(0, y_off - overlap)
+            window = Window(
+                x_start, y_start,
+                min(width, x_off + core.x_size + overlap) - x_start,
+                min(height, y_off + core.y_size + overlap) - y_start
+            )
+            yield core, window
+
+
+def read_window_as_np_arr(
+        gdal_ds,
+        window: Window,
+        dtype: np.dtype = None
+) -> np.ndarray:
+    """
+    Read one window of a GDAL raster as numpy array
+
+    Params:
+        gdal_ds: a GDAL dataset instance
+        window: region to read
+        dtype: if not None array dtype will be cast to given numpy data type
+
+    Returns:
+        Numpy array of shape (y_size, x_size, nb_channels)
+
+    """
+    buffer = gdal_ds.ReadAsArray(*window)
+    if len(buffer.shape) == 3:
+        buffer = np.transpose(buffer, axes=(1, 2, 0))
+    buffer = buffer.reshape((window.y_size, window.x_size, -1))
+    if dtype is not None:
+        buffer = buffer.astype(dtype)
+    return buffer
+
+
+def read_windows(
+        gdal_ds,
+        block_size: int = 512,
+        overlap: int = 0,
+        dtype: np.dtype = None,
+        read_ahead: int = 2
+) -> Iterator[Tuple[Window, Window, np.ndarray]]:
+    """
+    Read a GDAL raster window by window, e.g. to process rasters that don't
+    fit in memory. The windows are aligned on the native blocks layout of
+    the raster (see `iter_windows()`). The next windows are read in a
+    background thread while the current one is processed, and at most
+    `read_ahead` windows are waiting in memory.
+
+    Params:
+        gdal_ds: a GDAL dataset instance
+        block_size: size of the windows, in pixels (see `iter_windows()`)
+        overlap: number of pixels added on each side of the windows
+        dtype: if not None array dtype will be cast to given numpy data type
+        read_ahead: number of windows read in advance
+
+    Yields:
+        (core, window, np_arr) tuples, where np_arr is the content of the
+        window, of shape (y_size, x_size, nb_channels)
+
+    """
+    windows = queue.Queue(maxsize=max(1, read_ahead))
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                windows.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _read():
+        try:
+            for core, window in iter_windows(gdal_ds, block_size, overlap):
+                if stop.is_set():
+                    return
+                _put((core, window, read_window_as_np_arr(
+                    gdal_ds, window, dtype=dtype
+                )))
+            _put(done)
+        except Exception as err:  # pylint: disable=W0718
+            _put(err)
+
+    reader = threading.Thread(target=_read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = windows.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+
+def grid_positions(
+        height: int,
+        width: int,
+        patch_size: int,
+        stride: int = None
+) -> np.ndarray:
+    """
+    Compute the positions of patches on a regular grid.
+
+    Params:
+        height: number of rows of the raster (or window)
+        width: number of columns of the raster (or window)
+        patch_size: patches size, in pixels
+        stride: Optional, step between two patches, in pixels (defaults to
+            `patch_size`, i.e. non-overlapping patches)
+
+    Returns:
+        positions of the upper-left corners of the patches, as an array of
+        shape (n, 2) of (row, col)
+
+    """
+    stride = stride or patch_size
+    rows, cols = np.meshgrid(
+        np.arange(0, height - patch_size + 1, stride),
+        np.arange(0, width - patch_size + 1, stride),
+        indexing="ij"
+    )
+    return np.stack([rows.ravel(), cols.ravel()], axis=1)
+
+
+def extract_patches(
+        np_arr: np.ndarray,
+        positions: np.ndarray,
+        patch_size: int
+) -> np.ndarray:
+    """
+    Extract patches from an image in memory. The patches are gathered at
+    once from a strided view of the image, without any loop.
+
+    Params:
+        np_arr: image, of shape (rows, cols, nb_channels)
+        positions: positions of the upper-left corners of the patches, as an
+            array of shape (n, 2) of (row, col)
+        patch_size: patches size, in pixels
+
+    Returns:
+        patches, of shape (n, patch_size, patch_size, nb_channels)
+
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape((-1, 2))
+    height, width = np_arr.shape[:2]
+    if np.any(positions < 0) or \
+            np.any(positions[:, 0] > height - patch_size) or \
+            np.any(positions[:, 1] > width - patch_size):
+        raise Exception(
+            f"Some patches of size {patch_size} are outside the image of "
+            f"size {width}x{height}"
+        )
+    windows = np.lib.stride_tricks.sliding_window_view(
+        np_arr, (patch_size, patch_size), axis=(0, 1)
+    )  # shape (rows, cols, nb_channels, patch_size, patch_size)
+    return np.transpose(
+        windows[positions[:, 0], positions[:, 1]], axes=(0, 2, 3, 1)
+    )
+
+
+def read_patches(
+        gdal_ds,
+        positions: np.ndarray,
+        patch_size: int,
+        block_size: int = 512,
+        dtype: np.dtype = None
+) -> np.ndarray:
+    """
+    Extract patches from a GDAL raster, without reading the whole raster in
+    memory. The positions are grouped by windows aligned on the native
+    blocks layout of the raster (see `iter_windows()`), and each window
+    containing at least one patch is read once, then the patches are
+    extracted with `extract_patches()`.
+
+    Params:
+        gdal_ds: a GDAL dataset instance
+        positions: positions of the upper-left corners of the patches, as an
+            array of shape (n, 2) of (row, col)
+        patch_size: patches size, in pixels
+        block_size: size of the windows, in pixels (see `iter_windows()`)
+        dtype: if not None array dtype will be cast to given numpy data type
+
+    Returns:
+        patches, of shape (n, patch_size, patch_size, nb_channels), in the
+        order of `positions`
+
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape((-1, 2))
+    width, height = gdal_ds.RasterXSize, gdal_ds.RasterYSize
+    native_x, native_y = gdal_ds.GetRasterBand(1).GetBlockSize()
+    step_x = _aligned_size(block_size, native_x, width)
+    step_y = _aligned_size(block_size, native_y, height)
+    windows_ids = (positions[:, 0] // step_y) * width + \
+        positions[:, 1] // step_x
+    patches = None
+    for window_id in np.unique(windows_ids):
+        selected = np.flatnonzero(windows_ids == window_id)
+        y_off = int(positions[selected[0], 0] // step_y * step_y)
+        x_off = int(positions[selected[0], 1] // step_x * step_x)
+        window = Window(
+            x_off, y_off,
+            min(step_x + patch_size - 1, width - x_off),
+            min(step_y + patch_size - 1, height - y_off)
+        )
+        window_patches = extract_patches(
+            read_window_as_np_arr(gdal_ds, window, dtype=dtype),
+            positions[selected] - [y_off, x_off],
+            patch_size
+        )
+        if patches is None:
+            patches = np.empty(
+                (len(positions),) + window_patches.shape[1:],
+                dtype=window_patches.dtype
+            )
+        patches[selected] = window_patches
+    if patches is None:
+        patches = np.empty(
+            (0, patch_size, patch_size, gdal_ds.RasterCount), dtype=dtype
+        )
+    return patches
+
+
+def _create_patches_image(
+        filename: str,
+        patch_size: int,
+        n_patches: int,
+        n_channels: int,
+        dtype: np.dtype,
+        compress: str,
+        creation_options: List[str]
+):
+    """
+    Create a GeoTiff patches-image, where each internal block (i.e. strip
+    of `patch_size` rows) is exactly one patch
+
+    Returns:
+        the GDAL dataset instance, opened in write mode
+
+    """
+    gdal_type = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+    if gdal_type is None:
+        raise Exception(f"Data type {dtype} is not supported by GDAL")
+    options = [
+        "INTERLEAVE=PIXEL", f"BLOCKYSIZE={patch_size}",
+        f"COMPRESS={compress}", "BIGTIFF=IF_SAFER"
+    ] + list(creation_options or [])
+    gdal_ds = gdal.GetDriverByName("GTiff").Create(
+        filename, patch_size, n_patches * patch_size, n_channels, gdal_type,
+        options=options
+    )
+    if not gdal_ds:
+        raise Exception(f"Unable to create file {filename}")
+    return gdal_ds
+
+
+def _write_patches(gdal_ds, patches: np.ndarray, first_patch: int):
+    """
+    Write consecutive patches of shape (n, psz, psz, nb_channels) in a
+    patches-image, starting at the patch `first_patch`
+    """
+    patches = np.ascontiguousarray(patches)
+    n_patches, psz, _, n_channels = patches.shape
+    itemsize = patches.dtype.itemsize
+    gdal_ds.WriteRaster(
+        0, first_patch * psz, psz, n_patches * psz, patches.tobytes(),
+        buf_type=gdal_array.NumericTypeCodeToGDALTypeCode(patches.dtype),
+        buf_pixel_space=n_channels * itemsize,
+        buf_line_space=psz * n_channels * itemsize,
+        buf_band_space=itemsize
+    )
+
+
+def write_patches_image(
+        filename: str,
+        patches: np.ndarray,
+        compress: str = "DEFLATE",
+        creation_options: List[str] = None,
+        patches_per_chunk: int = 256
+):
+    """
+    Write patches in a GeoTiff patches-image (patches stacked in rows, like
+    the images produced by the OTBTF "PatchesExtraction" application).
+
+    The internal blocks of the image are exactly one patch: reading one
+    patch (e.g. with `otbtf.PatchesImagesReader`) then decodes one single
+    block.
+
+    Params:
+        filename: output GeoTiff file
+        patches: array of shape (n, psz, psz, nb_channels)
+        compress: GeoTiff codec, e.g. "NONE", "LZW", "DEFLATE", "ZSTD",
+            "LERC"
+        creation_options: Optional, other GeoTiff creation options, e.g.
+            ["PREDICTOR=2", "ZLEVEL=1"]
+        patches_per_chunk: number of patches written at once
+
+    """
+    n_patches, psz, psz_x, n_channels = patches.shape
+    assert psz == psz_x, "Patches must be square"
+    gdal_ds = _create_patches_image(
+        filename, psz, n_patches, n_channels, patches.dtype, compress,
+        creation_options
+    )
+    for first in range(0, n_patches, patches_per_chunk):
+        _write_patches(
+            gdal_ds, patches[first:first + patches_per_chunk], first
+        )
+    gdal_ds.FlushCache()
+
+
+def retile_patches_image(
+        src_filename: str,
+        dst_filename: str,
+        compress: str = "DEFLATE",
+        creation_options: List[str] = None,
+        patches_per_chunk: int = 256
+):
+    """
+    Rewrite an existing patches-image, so that its internal blocks are
+    exactly one patch (see `write_patches_image()`). The patches-images
+    produced by the "PatchesExtraction" application have generic blocks
+    layouts, and reading one patch can decode several blocks.
+
+    The source is read chunk by chunk, hence it can be larger than the
+    memory. The projection, geotransform and no-data values are kept.
+
+    Params:
+        src_filename: source patches-image
+        dst_filename: output GeoTiff file
+        compress: GeoTiff codec (see `write_patches_image()`)
+        creation_options: Optional, other GeoTiff creation options
+        patches_per_chunk: number of patches read and written at once
+
+    """
+    src_ds = gdal_open(src_filename)
+    psz = src_ds.RasterXSize
+    n_patches = src_ds.RasterYSize // psz
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+        src_ds.GetRasterBand(1).DataType
+    )
+    dst_ds = _create_patches_image(
+        dst_filename, psz, n_patches, src_ds.RasterCount, dtype, compress,
+        creation_options
+    )
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    for band_idx in range(1, src_ds.RasterCount + 1):
+        nodata = src_ds.GetRasterBand(band_idx).GetNoDataValue()
+        if nodata is not None:
+            dst_ds.GetRasterBand(band_idx).SetNoDataValue(nodata)
+    for first in range(0, n_patches, patches_per_chunk):
+        count = min(patches_per_chunk, n_patches - first)
+        np_arr = read_window_as_np_arr(
+            src_ds, Window(0, first * psz, psz, count * psz), dtype=dtype
+        )
+        _write_patches(
+            dst_ds, np_arr.reshape((count, psz, psz, -1)), first
+        )
+    dst_ds.FlushCache()
+    logging.info(
+        "%s patches of %s written in %s", n_patches, src_filename,
+        dst_filename
+    )
+
+
+def file_signature(filename: str) -> Tuple[int, int]:
+    """
+    Returns the size and the modification time (in nanoseconds) of a file,
+    which identify its content, or None when the file can't be accessed
+    with `os.stat()` (e.g. GDAL virtual file systems)
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Block caches of the process, whose locks are re-created in the forked
+# child processes (see `BlockCache`)
+_BLOCK_CACHES = weakref.WeakSet()
+
+
+def _reset_block_caches_locks():
+    """
+    Re-create the locks of the block caches, in a forked child process
+    """
+    for cache in list(_BLOCK_CACHES):
+        cache.lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_block_caches_locks)
+
+
+class BlockCache:
+    """
+    Least recently used cache of decoded raster blocks, capped in bytes. One
+    cache can be shared by several rasters (see `CachedRaster`).
+
+    The cache is thread-safe. Its lock is re-created in the forked child
+    processes (e.g. the parallel TFRecords writers), since it could be held
+    by another thread of the parent process (e.g. a read-ahead thread) when
+    the process is forked.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 ** 2):
+        """
+        Params:
+            max_bytes: maximum size of the cached blocks, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        _BLOCK_CACHES.add(self)
+
+    def get(self, key: Any) -> np.ndarray:
+        """
+        Returns the cached block, or None when the block is not cached
+        """
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return block
+
+    def put(self, key: Any, block: np.ndarray):
+        """
+        Add a block in the cache, and evict the least recently used blocks
+        when the cache is full
+        """
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = block
+            self.n_bytes += block.nbytes
+            while self.n_bytes > self.max_bytes and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Returns:
+            the ratio of the requests served from the cache
+        """
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+class DiskBlockCache(BlockCache):
+    """
+    Cache of decoded raster blocks stored in a local directory, e.g. to
+    decode heavily compressed sources (JPEG2000...) only once over all the
+    training epochs. The blocks are stored uncompressed (or with a fast
+    codec), and the least recently used ones are removed when the directory
+    exceeds `max_bytes`. The most recently used blocks are also kept in
+    memory (see `BlockCache`).
+
+    The directory can be re-used by later runs: the blocks already stored
+    are then read instead of decoded. Keys must hence identify the content
+    of the blocks (see `CachedRaster`).
+
+    The cache is used by the readers of rasters blocks based on
+    `CachedRaster` (`otbtf.PatchesImagesReader` in streaming mode,
+    `otbtf.ScenePatchesReader`, `otbtf.MaskedWindowsReader`). The
+    `read_windows()` and `read_patches()` functions read each window once,
+    and don't use any cache.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            max_bytes: int = 8 * 1024 ** 3,
+            compress: bool = False,
+            memory_bytes: int = 64 * 1024 ** 2
+    ):
+        """
+        Params:
+            directory: local directory of the cached blocks
+            max_bytes: maximum size of the cached blocks on disk, in bytes
+            compress: if True, the blocks are compressed with a fast codec
+                (zlib, level 1). Else, they are stored uncompressed.
+            memory_bytes: maximum size of the blocks kept in memory, in bytes
+
+        """
+        super().__init__(max_bytes=memory_bytes)
+        self.directory = directory
+        self.max_disk_bytes = max_bytes
+        self.compress = compress
+        self.suffix = ".npy.z" if compress else ".npy"
+        self.disk_hits = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # Blocks already stored, the least recently modified first
+        self.files = OrderedDict()
+        self.disk_bytes = 0
+        entries = [
+            entry for entry in os.scandir(directory)
+            if entry.is_file() and entry.name.endswith(self.suffix)
+        ]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            n_bytes = entry.stat().st_size
+            self.files[entry.name] = n_bytes
+            self.disk_bytes += n_bytes
+        logging.info(
+            "%s blocks (%s bytes) found in the cache directory %s",
+            len(self.files), self.disk_bytes, directory
+        )
+
+    def _name(self, key: Any) -> str:
+        """
+        Returns the file name of one block
+        """
+        return hashlib.sha1(repr(key).encode()).hexdigest() + self.suffix
+
+    def get(self, key: Any) -> np.ndarray:
+        """
+        Returns the cached block, or None when the block is not cached
+        """
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.hits += 1
+                self.blocks.move_to_end(key)
+                return block
+        name = self._name(key)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as file:
+                data = file.read()
+            if self.compress:
+                data = zlib.decompress(data)
+            block = np.load(io.BytesIO(data))
+        except (OSError, ValueError, zlib.error):
+            # not cached, removed by another process, or partially written
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.disk_hits += 1
+            if name in self.files:
+                self.files.move_to_end(name)
+        super().put(key, block)
+        return block
+
+    def put(self, key: Any, block: np.ndarray):
+        """
+        Add a block in the cache, and remove the least recently used blocks
+        when the cache is full
+        """
+        super().put(key, block)
+        name = self._name(key)
+        with self.lock:
+            if name in self.files:
+                return
+        buffer = io.BytesIO()
+        np.save(buffer, block)
+        data = buffer.getvalue()
+        if self.compress:
+            data = zlib.compress(data, 1)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)  # atomic, for concurrent readers
+        with self.lock:
+            if name in self.files:
+                return
+            self.files[name] = len(data)
+            self.disk_bytes += len(data)
+            while self.disk_bytes > self.max_disk_bytes and \
+                    len(self.files) > 1:
+                evicted, n_bytes = self.files.popitem(last=False)
+                self.disk_bytes -= n_bytes
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except FileNotFoundError:
+                    pass
+
+
+class CachedRaster:
+    """
+    Read access to the windows of a GDAL raster through a cache of decoded
+    blocks. The blocks are aligned on the native blocks layout of the raster
+    (see `iter_windows()`), hence neighbouring windows (e.g. patches) are
+    decoded only once.
+
+    The blocks keys identify the file (name, size and modification time),
+    the blocks layout and the data type, hence a `DiskBlockCache` can be
+    re-used across runs.
+    """
+
+    def __init__(
+            self,
+            filename: str,
+            cache: BlockCache = None,
+            block_size: int = 256,
+            dtype: np.dtype = None
+    ):
+        """
+        Params:
+            filename: raster file
+            cache: Optional, cache of the blocks, that can be shared by
+                several rasters (e.g. a `BlockCache` or a `DiskBlockCache`).
+                When not set, a new in-memory cache is created.
+            block_size: size of the blocks, in pixels (see `iter_windows()`)
+            dtype: if not None array dtype will be cast to given numpy data
+                type
+
+        """
+        self.filename = filename
+        self.cache = cache if cache is not None else BlockCache()
+        self.dtype = dtype
+        self.gdal_ds = gdal_open(filename)
+        self.width = self.gdal_ds.RasterXSize
+        self.height = self.gdal_ds.RasterYSize
+        native_x, native_y = self.gdal_ds.GetRasterBand(1).GetBlockSize()
+        self.step_x = _aligned_size(block_size, native_x, self.width)
+        self.step_y = _aligned_size(block_size, native_y, self.height)
+        self.n_blocks_cols = -(-self.width // self.step_x)
+        self.key = (
+            filename, file_signature(filename), self.step_x, self.step_y,
+            str(dtype)
+        )
+
+    def reopen(self):
+        """
+        Re-open the GDAL dataset (e.g. in a forked process)
+        """
+        self.gdal_ds = gdal_open(self.filename)
+
+    def geo_to_pixel(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Convert geographic coordinates to pixel coordinates (north-up
+        rasters).
+
+        Params:
+            positions: array of shape (n, 2) of (x, y) coordinates, in the
+                coordinate reference system of the raster
+
+        Returns:
+            array of shape (n, 2) of continuous (row, col) coordinates
+
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape((-1, 2))
+        origin_x, res_x, _, origin_y, _, res_y = \
+            self.gdal_ds.GetGeoTransform()
+        return np.stack([
+            (positions[:, 1] - origin_y) / res_y,
+            (positions[:, 0] - origin_x) / res_x
+        ], axis=1)
+
+    def patches_origins(
+            self,
+            positions: np.ndarray,
+            patch_size: int
+    ) -> np.ndarray:
+        """
+        Compute the upper-left pixel of the patches centered on geographic
+        positions, with the convention of the OTBTF applications (e.g.
+        "PatchesExtraction"): the origin is the index of the pixel
+        containing the position, minus `patch_size // 2`. For even sizes,
+        the pixel containing the position is hence at index
+        `patch_size // 2` of the patch.
+
+        Params:
+            positions: array of shape (n, 2) of (x, y) coordinates, in the
+                coordinate reference system of the raster
+            patch_size: patch size, in pixels
+
+        Returns:
+            array of shape (n, 2) of (row, col) integer coordinates
+
+        """
+        return np.floor(self.geo_to_pixel(positions)).astype(np.int64) - \
+            patch_size // 2
+
+    def pixel_to_geo(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Convert continuous pixel coordinates to geographic coordinates
+        (north-up rasters). This is the inverse of `geo_to_pixel()`.
+
+        Params:
+            positions: array of shape (n, 2) of (row, col) coordinates
+
+        Returns:
+            array of shape (n, 2) of (x, y) coordinates, in the coordinate
+            reference system of the raster
+
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape((-1, 2))
+        origin_x, res_x, _, origin_y, _, res_y = \
+            self.gdal_ds.GetGeoTransform()
+        return np.stack([
+            origin_x + positions[:, 1] * res_x,
+            origin_y + positions[:, 0] * res_y
+        ], axis=1)
+
+    def block_of(self, row: int, col: int) -> Tuple[int, int]:
+        """
+        Returns the (row, col) index of the block containing a pixel
+        """
+        return row // self.step_y, col // self.step_x
+
+    def block_id(self, row: int, col: int) -> int:
+        """
+        Returns the flat index of the block containing a pixel, i.e.
+        `block_row * n_blocks_cols + block_col`. Like `block_of()`, also
+        works on arrays of pixels.
+        """
+        block_row, block_col = self.block_of(row, col)
+        return block_row * self.n_blocks_cols + block_col
+
+    def get_block(self, block_row: int, block_col: int) -> np.ndarray:
+        """
+        Returns one block, from the cache or read from the raster
+        """
+        key = (*self.key, block_row, block_col)
+        block = self.cache.get(key)
+        if block is None:
+            x_off, y_off = block_col * self.step_x, block_row * self.step_y
+            block = read_window_as_np_arr(
+                self.gdal_ds,
+                Window(
+                    x_off, y_off, min(self.step_x, self.width - x_off),
+                    min(self.step_y, self.height - y_off)
+                ),
+                dtype=self.dtype
+            )
+            self.cache.put(key, block)
+        return block
+
+    def read(self, window: Window) -> np.ndarray:
+        """
+        Read one window of the raster.
+
+        Params:
+            window: region to read, inside the raster
+
+        Returns:
+            Numpy array of shape (y_size, x_size, nb_channels)
+
+        """
+        x_end, y_end = window.x_off + window.x_size, \
+            window.y_off + window.y_size
+        if window.x_off < 0 or window.y_off < 0 or x_end > self.width or \
+                y_end > self.height:
+            raise Exception(
+                f"Window {window} is outside the raster {self.filename}"
+            )
+        first_row, first_col = self.block_of(window.y_off, window.x_off)
+        last_row, last_col = self.block_of(y_end - 1, x_end - 1)
+        buffer = None
+        for block_row in range(first_row, last_row + 1):
+            for block_col in range(first_col, last_col + 1):
+                block = self.get_block(block_row, block_col)
+                if buffer is None:
+                    buffer = np.empty(
+                        (window.y_size, window.x_size, block.shape[2]),
+                        dtype=block.dtype
+                    )
+                x_off, y_off = block_col * self.step_x, \
+                    block_row * self.step_y
+                x_start, y_start = max(x_off, window.x_off), \
+                    max(y_off, window.y_off)
+                x_stop = min(x_off + block.shape[1], x_end)
+                y_stop = min(y_off + block.shape[0], y_end)
+                buffer[
+                    y_start - window.y_off:y_stop - window.y_off,
+                    x_start - window.x_off:x_stop - window.x_off
+                ] = block[
+                    y_start - y_off:y_stop - y_off,
+                    x_start - x_off:x_stop - x_off
+                ]
+        return buffer
+
+
+def read_points(
+        filename: str,
+        fields: List[str] = None,
+        layer: int = 0
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Read the positions of points from a vector file (e.g. the GeoPackage
+    produced by the OTBTF "PatchesSelection" application).
+
+    Params:
+        filename: vector file
+        fields: Optional, names of the fields to read
+        layer: index of the layer
+
+    Returns:
+        the positions, as an array of shape (n, 2) of (x, y) coordinates in
+        the coordinate reference system of the layer, and a dict of arrays
+        with the values of the fields
+
+    """
+    vector_ds = ogr.Open(filename)
+    if not vector_ds:
+        raise Exception(f"Unable to open file {filename}")
+    positions = []
+    values = {field: [] for field in fields or []}
+    for feature in vector_ds.GetLayer(layer):
+        geometry = feature.GetGeometryRef()
+        positions.append((geometry.GetX(), geometry.GetY()))
+        for field, field_values in values.items():
+            field_values.append(feature.GetField(field))
+    logging.info("%s points read from %s", len(positions), filename)
+    return np.asarray(positions, dtype=np.float64).reshape((-1, 2)), {
+        field: np.asarray(field_values)
+        for field, field_values in values.items()
+    }
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from otbtf.dataset import PatchesImagesReader
+from otbtf.utils import BlockCache, DiskBlockCache
+
+
+def get_block(cache, key, results):
+    """
+    Read one block of the cache, in a child process
+    """
+    results.put(cache.get(key) is not None)
+
+
+class PatchesImage:
+    """
+    Minimal GDAL patches-image of random patches, stored in strips
+    """
+
+    def __init__(self, n_patches, psz=4, n_bands=3, seed=0):
+        self.array = np.random.RandomState(seed).randint(
+            0, 1000, (n_bands, n_patches * psz, psz)
+        )
+        self.RasterCount, self.RasterYSize, self.RasterXSize = \
+            self.array.shape
+
+    def GetRasterBand(self, _):
+        return mock.Mock(GetBlockSize=lambda: (self.RasterXSize, 1))
+
+    def ReadAsArray(self, x_off=0, y_off=0, x_size=None, y_size=None):
+        x_size = self.RasterXSize if x_size is None else x_size
+        y_size = self.RasterYSize if y_size is None else y_size
+        return self.array[:, y_off:y_off + y_size, x_off:x_off + x_size]
+
+
+class BlockCacheTest(unittest.TestCase):
+
+    def test_memory_eviction(self):
+        block = np.zeros((16, 16, 1), dtype=np.uint8)
+        cache = BlockCache(max_bytes=2 * block.nbytes)
+        for key in range(3):
+            cache.put(key, block)
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(2))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_lock_after_fork(self):
+        cache = BlockCache()
+        cache.put("key", np.ones((4, 4, 1)))
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        with cache.lock:  # e.g. held by a read-ahead thread
+            process = context.Process(
+                target=get_block, args=(cache, "key", results)
+            )
+            process.start()
+        process.join(timeout=30)
+        if process.is_alive():  # deadlock
+            process.terminate()
+        self.assertEqual(process.exitcode, 0)
+        self.assertTrue(results.get(timeout=1))
+
+
+class DiskBlockCacheTest(unittest.TestCase):
+
+    def test_reuse_across_instances(self):
+        block = np.arange(64, dtype=np.uint16).reshape((8, 8, 1))
+        for compress in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                DiskBlockCache(tmpdir, compress=compress).put("key", block)
+                cache = DiskBlockCache(tmpdir, compress=compress)
+                np.testing.assert_array_equal(cache.get("key"), block)
+                self.assertEqual(cache.disk_hits, 1)
+                self.assertIsNone(cache.get("other key"))
+                self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_size_cap(self):
+        block = np.zeros((32, 32, 1), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = DiskBlockCache(tmpdir, max_bytes=3 * block.nbytes)
+            for key in range(10):
+                cache.put(key, block)
+            self.assertLessEqual(cache.disk_bytes, 3 * block.nbytes)
+            self.assertEqual(len(os.listdir(tmpdir)), len(cache.files))
+
+
+class PatchesImagesReaderCacheTest(unittest.TestCase):
+
+    def test_streaming_with_cache(self):
+        images = {
+            "a1.tif": PatchesImage(10, seed=1),
+            "a2.tif": PatchesImage(6, seed=2),
+            "b1.tif": PatchesImage(10, psz=2, n_bands=1, seed=3),
+            "b2.tif": PatchesImage(6, psz=2, n_bands=1, seed=4)
+        }
+        filenames = {"a": ["a1.tif", "a2.tif"], "b": ["b1.tif", "b2.tif"]}
+        indices = np.random.RandomState(0).permutation(16)
+        with mock.patch("otbtf.utils.gdal_open", side_effect=images.get):
+            expected = PatchesImagesReader(filenames, use_streaming=True)
+            reader = PatchesImagesReader(
+                filenames, use_streaming=True, cache=BlockCache(),
+                block_size=8
+            )
+            for _ in range(2):
+                hit_rate = reader.get_cache_hit_rate() or 0
+                samples = reader.get_samples(indices)
+                for index, sample in zip(indices, samples):
+                    for key, patch in expected.get_sample(index).items():
+                        np.testing.assert_array_equal(sample[key], patch)
+                        np.testing.assert_array_equal(
+                            reader.get_sample(index)[key], patch
+                        )
+            # the second pass is served from the cache
+            self.assertGreater(reader.get_cache_hit_rate(), hit_rate)
+
+
+if __name__ == '__main__':
+    unittest.main()
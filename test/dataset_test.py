@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from otbtf.dataset import ArrayPatchesReader, Dataset, PatchesReaderView, \
+    MaskedWindowsReader, PatchesImagesReader, ScenePatchesReader, \
+    StatsAccumulator
+from otbtf.tfrecords import TFRecords
+
+
+def make_reader(n_samples=40, dtype=np.uint8):
+    """
+    In-memory patches reader with integer patches and labels
+    """
+    rng = np.random.default_rng(0)
+    return ArrayPatchesReader({
+        "xs": rng.integers(0, 255, (n_samples, 8, 8, 3)).astype(dtype),
+        "labels": np.arange(n_samples).reshape((n_samples, 1, 1, 1))
+    })
+
+
+class InMemoryGdalDataset:
+    """
+    Minimal GDAL dataset of one band. By default, its pixels values are
+    1000 * row + col
+    """
+
+    def __init__(self, array=None, geotransform=(0, 1, 0, 0, 0, -1)):
+        if array is None:
+            rows, cols = np.mgrid[0:100, 0:100]
+            array = 1000 * rows + cols
+        self.array = array
+        self.RasterYSize, self.RasterXSize = array.shape
+        self.RasterCount = 1
+        self.geotransform = geotransform
+
+    def GetRasterBand(self, _):
+        return mock.Mock(GetBlockSize=lambda: (self.RasterXSize, 1))
+
+    def GetGeoTransform(self):
+        return self.geotransform
+
+    def ReadAsArray(self, x_off=0, y_off=0, x_size=None, y_size=None):
+        x_size = self.RasterXSize if x_size is None else x_size
+        y_size = self.RasterYSize if y_size is None else y_size
+        return self.array[y_off:y_off + y_size, x_off:x_off + x_size]
+
+
+def make_patches_image(n_patches=40, psz=4):
+    """
+    In-memory patches-image. The pixels of each patch are its index.
+    """
+    return InMemoryGdalDataset(
+        np.repeat(np.arange(n_patches), psz * psz).reshape((-1, psz))
+    )
+
+
+def read_epoch(dataset):
+    """
+    Returns the indices of the patches of one epoch of a dataset
+    """
+    return [
+        int(sample["xs"][0, 0, 0])
+        for sample in dataset.tf_dataset.as_numpy_iterator()
+    ]
+
+
+class ExclusiveReader(ArrayPatchesReader):
+    """
+    Reader counting the concurrent reads, like a streaming reader whose GDAL
+    datasets must not be read by several threads
+    """
+
+    def __init__(self, arrays_dict):
+        super().__init__(arrays_dict)
+        self.active = 0
+        self.overlaps = 0
+
+    def get_samples(self, indices):
+        self.active += 1
+        self.overlaps += self.active > 1
+        time.sleep(.01)
+        samples = super().get_samples(indices)
+        self.active -= 1
+        return samples
+
+
+class ArrayPatchesReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.arrays = {
+            "a": rng.rand(20, 4, 4, 3),
+            "b": rng.randint(0, 100, (20, 2, 2, 1))
+        }
+        self.reader = ArrayPatchesReader(self.arrays)
+
+    def test_get_samples(self):
+        indices = [5, 0, 19, 5]
+        samples = self.reader.get_samples(indices)
+        self.assertEqual(len(samples), len(indices))
+        for index, sample in zip(indices, samples):
+            for key, arr in self.arrays.items():
+                np.testing.assert_array_equal(sample[key], arr[index])
+                np.testing.assert_array_equal(
+                    sample[key], self.reader.get_sample(index)[key]
+                )
+
+    def test_get_stats(self):
+        stats = self.reader.get_stats()
+        for key, arr in self.arrays.items():
+            pixels = arr.reshape((-1, arr.shape[-1]))
+            np.testing.assert_allclose(stats[key]["min"], pixels.min(0))
+            np.testing.assert_allclose(stats[key]["max"], pixels.max(0))
+            np.testing.assert_allclose(stats[key]["mean"], pixels.mean(0))
+            np.testing.assert_allclose(stats[key]["std"], pixels.std(0))
+
+    def test_sources_must_have_the_same_size(self):
+        with self.assertRaises(Exception):
+            ArrayPatchesReader({
+                "a": np.zeros((3, 2, 2, 1)), "b": np.zeros((4, 2, 2, 1))
+            })
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_accumulator_integer_patches(self):
+        reader = make_reader()
+        accumulator = StatsAccumulator(keys=["xs"])
+        for index in range(reader.get_size()):
+            accumulator.add(reader.get_sample(index))
+        stats = accumulator.get_stats()["xs"]
+        patches = reader.patches_buffer["xs"].astype(np.float64)
+        self.assertFalse(np.any(np.isnan(stats["std"])))
+        np.testing.assert_allclose(stats["std"], patches.std(axis=(0, 1, 2)))
+        np.testing.assert_allclose(
+            stats["mean"], patches.mean(axis=(0, 1, 2))
+        )
+
+    def test_view_stats(self):
+        reader = make_reader()
+        view = PatchesReaderView(reader, indices=np.arange(reader.get_size()))
+        ref_stats = reader.get_stats()
+        view_stats = view.get_stats()
+        for key in ("min", "max", "mean", "std"):
+            np.testing.assert_allclose(
+                view_stats["xs"][key], ref_stats["xs"][key]
+            )
+
+
+class ViewsTest(unittest.TestCase):
+
+    def test_datasets_over_one_reader(self):
+        with mock.patch(
+                "otbtf.utils.gdal_open", return_value=make_patches_image()
+        ):
+            reader = PatchesImagesReader({"xs": ["xs.tif"]})
+        indices = np.random.default_rng(0).permutation(reader.get_size())
+        ds_train = Dataset(reader, buffer_length=8, indices=indices[:30])
+        ds_valid = Dataset(reader, buffer_length=8, indices=indices[30:])
+        for dataset in (ds_train, ds_valid):
+            self.assertIs(dataset.patches_reader.patches_reader, reader)
+        self.assertIsNot(ds_train.iterator, ds_valid.iterator)
+        self.assertIsNot(ds_train.miner_buffer, ds_valid.miner_buffer)
+        self.assertIsNot(ds_train.consumer_buffer, ds_valid.consumer_buffer)
+        # Interleaved epochs: each dataset delivers all its samples, and
+        # only them
+        for _ in range(3):
+            self.assertEqual(
+                sorted(read_epoch(ds_train)), sorted(indices[:30])
+            )
+            self.assertEqual(
+                sorted(read_epoch(ds_valid)), sorted(indices[30:])
+            )
+
+    def test_max_nb_of_samples(self):
+        with mock.patch(
+                "otbtf.utils.gdal_open", return_value=make_patches_image()
+        ):
+            reader = PatchesImagesReader({"xs": ["xs.tif"]})
+        dataset = Dataset(reader, buffer_length=4, max_nb_of_samples=10)
+        self.assertEqual(dataset.size, 10)
+        for _ in range(3):
+            self.assertEqual(sorted(read_epoch(dataset)), list(range(10)))
+        indices = np.arange(40)[::-1]
+        dataset = Dataset(
+            reader, buffer_length=4, indices=indices, max_nb_of_samples=10
+        )
+        for _ in range(3):
+            self.assertEqual(
+                sorted(read_epoch(dataset)), sorted(indices[:10])
+            )
+
+    def test_reads_of_shared_reader_are_serialized(self):
+        reader = ExclusiveReader({
+            "xs": np.arange(40).reshape((40, 1, 1, 1))
+        })
+        datasets = [
+            Dataset(reader, buffer_length=4, indices=np.arange(0, 40, 2)),
+            Dataset(reader, buffer_length=4, indices=np.arange(1, 40, 2))
+        ]
+        self.assertIs(
+            datasets[0].patches_reader.lock, datasets[1].patches_reader.lock
+        )
+        threads = [
+            threading.Thread(target=read_epoch, args=(dataset,))
+            for dataset in datasets
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(reader.overlaps, 0)
+
+
+class SplitTest(unittest.TestCase):
+
+    def test_split_by_ratios(self):
+        dataset = Dataset(make_reader(n_samples=40))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_dirs = {
+                key: os.path.join(tmpdir, key) for key in ("train", "valid")
+            }
+            counts = dataset.to_split_tfrecords(
+                output_dirs, ratios={"train": 0.75, "valid": 0.25}, seed=1,
+                n_samples_per_shard=5
+            )
+            self.assertEqual(counts, {"train": 30, "valid": 10})
+            for key, output_dir in output_dirs.items():
+                tfrecords = TFRecords(output_dir)
+                self.assertEqual(tfrecords.num_samples, counts[key])
+                stats = tfrecords.load_stats()["xs"]
+                for name in ("min", "max", "mean", "std"):
+                    self.assertFalse(np.any(np.isnan(stats[name])))
+
+    def test_split_by_predicate(self):
+        dataset = Dataset(make_reader(n_samples=40))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_dirs = {
+                key: os.path.join(tmpdir, key) for key in ("even", "odd")
+            }
+            counts = dataset.to_split_tfrecords(
+                output_dirs,
+                predicate=lambda index, _: "odd" if index % 2 else "even",
+                n_samples_per_shard=4, drop_remainder=False
+            )
+            self.assertEqual(counts, {"even": 20, "odd": 20})
+
+    def test_split_pauses_the_miner(self):
+        dataset = Dataset(make_reader(n_samples=40))
+        dataset.miner_thread.join()
+        locked = []
+
+        def _route(index, _):
+            locked.append(not dataset.mining_lock.acquire(block=False))
+            return "train"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dataset.to_split_tfrecords(
+                {"train": tmpdir}, predicate=_route, n_samples_per_shard=10
+            )
+        self.assertEqual(locked, [True] * 40)
+
+
+class CacheIdentityTest(unittest.TestCase):
+
+    def test_in_memory_reader(self):
+        reader = make_reader()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for _ in range(2):
+                tf_dataset = Dataset(reader).get_tf_dataset(
+                    batch_size=4, cache=tmpdir
+                )
+                for _ in tf_dataset:
+                    pass
+            self.assertEqual(
+                len(glob.glob(os.path.join(tmpdir, "*.index"))), 1
+            )
+            # Same shapes, types and size, but one middle patch changes
+            reader.patches_buffer["xs"][20, 3, 3, 0] += 1
+            tf_dataset = Dataset(reader).get_tf_dataset(
+                batch_size=4, cache=tmpdir
+            )
+            for _ in tf_dataset:
+                pass
+            self.assertEqual(
+                len(glob.glob(os.path.join(tmpdir, "*.index"))), 2
+            )
+
+    def test_file_reader(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "xs.tif")
+
+            def _identity(content):
+                if content is not None:
+                    with open(filename, "wb") as file:
+                        file.write(content)
+                with mock.patch(
+                        "otbtf.utils.gdal_open",
+                        return_value=make_patches_image()
+                ):
+                    reader = PatchesImagesReader({"xs": [filename]})
+                return Dataset(reader)._cache_identity()
+
+            identity = _identity(b"patches")
+            self.assertEqual(_identity(None), identity)
+            self.assertNotEqual(_identity(b"other patches"), identity)
+
+    def test_views(self):
+        reader = make_reader()
+        identities = [
+            Dataset(reader, indices=indices)._cache_identity()
+            for indices in (np.arange(10), np.arange(10, 20), np.arange(10))
+        ]
+        self.assertNotEqual(identities[0], identities[1])
+        self.assertEqual(identities[0], identities[2])
+
+
+class ScenePatchesReaderTest(unittest.TestCase):
+
+    def test_origins_follow_otb_convention(self):
+        # Positions inside the pixel (row 50, col 40)
+        positions = np.array([[40.5, -50.5], [40.1, -50.9], [40.9, -50.1]])
+        with mock.patch(
+                "otbtf.utils.gdal_open",
+                return_value=InMemoryGdalDataset()
+        ):
+            for psz in (16, 17):
+                reader = ScenePatchesReader(
+                    {"xs": "scene.tif"}, positions, {"xs": psz}
+                )
+                for index in range(len(positions)):
+                    patch = reader.get_sample(index)["xs"]
+                    self.assertEqual(patch.shape, (psz, psz, 1))
+                    # OTB: origin is the pixel index minus psz / 2
+                    self.assertEqual(
+                        patch[0, 0, 0],
+                        1000 * (50 - psz // 2) + (40 - psz // 2)
+                    )
+
+
+class MaskedWindowsReaderTest(unittest.TestCase):
+
+    def test_windows_centered_on_valid_pixels(self):
+        mask = np.zeros((100, 100), dtype=np.uint8)
+        mask[30, 40] = mask[70, 20] = 1
+        datasets = {
+            "scene.tif": InMemoryGdalDataset(),
+            "mask.tif": InMemoryGdalDataset(mask)
+        }
+        with mock.patch("otbtf.utils.gdal_open", side_effect=datasets.get):
+            for psz in (16, 17):
+                reader = MaskedWindowsReader(
+                    {"xs": "scene.tif"}, "mask.tif", {"xs": psz}, seed=0
+                )
+                for index in range(20):
+                    patch = reader.get_sample(index)["xs"]
+                    row, col = divmod(int(patch[psz // 2, psz // 2, 0]), 1000)
+                    self.assertEqual(mask[row, col], 1)
+
+    def test_get_samples_draws_the_positions_once(self):
+        mask = np.zeros((100, 100), dtype=np.uint8)
+        mask[20:80, 10:90] = 1
+        datasets = {
+            "scene.tif": InMemoryGdalDataset(),
+            "mask.tif": InMemoryGdalDataset(mask)
+        }
+        with mock.patch("otbtf.utils.gdal_open", side_effect=datasets.get):
+            reader = MaskedWindowsReader(
+                {"xs": "scene.tif"}, "mask.tif", {"xs": 8}, seed=0,
+                block_size=16
+            )
+            indices = [7, 3, 42, 3, 0]
+            with mock.patch.object(
+                    reader, "_draw", wraps=reader._draw
+            ) as draw:
+                samples = reader.get_samples(indices)
+            self.assertEqual(draw.call_count, len(indices))
+            for index, sample in zip(indices, samples):
+                np.testing.assert_array_equal(
+                    sample["xs"], reader.get_sample(index)["xs"]
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
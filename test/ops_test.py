@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from otbtf.ops import dihedral_augmentation
+
+
+class DihedralAugmentationTest(unittest.TestCase):
+
+    def test_inputs_and_targets_stay_aligned(self):
+        xs = tf.reshape(tf.range(4 * 6 * 6, dtype=tf.float32), [4, 6, 6, 1])
+        inputs, targets = dihedral_augmentation(
+            {"xs": xs, "scalar": tf.ones([4, 1])}, {"labels": 2 * xs},
+            seed=1
+        )
+        np.testing.assert_array_equal(targets["labels"], 2 * inputs["xs"])
+        np.testing.assert_array_equal(inputs["scalar"], tf.ones([4, 1]))
+        for transformed, original in zip(inputs["xs"], xs):
+            self.assertEqual(
+                sorted(transformed.numpy().flatten()),
+                sorted(original.numpy().flatten())
+            )
+
+    def test_unknown_non_square_shapes(self):
+        augment = tf.function(
+            lambda xs: dihedral_augmentation({"xs": xs})["xs"],
+            input_signature=[tf.TensorSpec([None, None, None, 1])]
+        )
+        xs = tf.zeros([8, 6, 4, 1])
+        self.assertEqual(augment(xs).shape, xs.shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,644 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import os
+import tempfile
+import types
+import unittest
+import zlib
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+
+from otbtf.dataset import ArrayPatchesReader, Dataset, TFRecordsReader
+from otbtf.tfrecords import SavedDataset, TFRecords, function_identity
+
+# Module-like configuration, referenced by a preprocessing function
+CONFIG = types.ModuleType("config")
+CONFIG.N_CLASSES = 2
+
+
+def preprocessing_fn(inputs, targets):
+    """
+    Preprocessing function referencing a module attribute
+    """
+    return inputs, {"ids": targets["ids"] % CONFIG.N_CLASSES}
+
+
+def make_reader(n_samples=50):
+    """
+    In-memory patches reader. The "ids" source holds the sample index.
+    """
+    rng = np.random.default_rng(0)
+    return ArrayPatchesReader({
+        "xs": rng.random((n_samples, 8, 8, 3), dtype=np.float32),
+        "ids": np.arange(n_samples, dtype=np.int32).reshape((-1, 1, 1, 1))
+    })
+
+
+class FailingReader(ArrayPatchesReader):
+    """
+    Reader failing after some samples, to simulate an interrupted writing
+    """
+
+    def __init__(self, arrays_dict, n_readable):
+        super().__init__(arrays_dict)
+        self.n_readable = n_readable
+
+    def get_samples(self, indices):
+        samples = []
+        for index in indices:
+            if self.n_readable == 0:
+                raise RuntimeError("Interrupted")
+            self.n_readable -= 1
+            samples.append(self.get_sample(index))
+        return samples
+
+
+def read_order(tfrecords, **kwargs):
+    """
+    Returns the "ids" of all the samples of a TFRecords directory, in the
+    order of the TF dataset
+    """
+    tf_dataset = tfrecords.read(
+        batch_size=1, target_keys=["ids"], drop_remainder=False, **kwargs
+    )
+    return [
+        int(targets["ids"].numpy().flatten()[0])
+        for _, targets in tf_dataset
+    ]
+
+
+def read_ids(tfrecords, **kwargs):
+    """
+    Returns the sorted "ids" of all the samples of a TFRecords directory
+    """
+    return sorted(read_order(tfrecords, **kwargs))
+
+
+class SerializationTest(unittest.TestCase):
+
+    def test_serialize_sample_without_tf_runtime(self):
+        sample = {
+            "xs": np.ones((4, 4, 3), dtype=np.float32),
+            "labels": np.zeros((1, 1, 1), dtype=np.uint8)
+        }
+        with mock.patch.object(
+                tf, "constant", side_effect=AssertionError("tf.constant")
+        ):
+            for encoding in ("tensor", "raw"):
+                self.assertTrue(
+                    TFRecords.serialize_sample(sample, encoding=encoding)
+                )
+
+
+class WriteTest(unittest.TestCase):
+
+    def test_reader_options_need_from_reader(self):
+        dataset = Dataset(make_reader())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(Exception):
+                dataset.to_tfrecords(tmpdir, shuffle=True)
+            dataset.to_tfrecords(
+                tmpdir, n_samples_per_shard=10, from_reader=True,
+                shuffle=True, seed=1
+            )
+            self.assertEqual(read_ids(TFRecords(tmpdir)), list(range(50)))
+
+    def test_export_from_reader_pauses_the_miner(self):
+        dataset = Dataset(make_reader())
+        dataset.miner_thread.join()
+
+        def _check_lock(*args, **kwargs):
+            self.assertFalse(dataset.mining_lock.acquire(block=False))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(
+                    TFRecords, "reader2tfrecord", side_effect=_check_lock
+            ) as reader2tfrecord:
+                dataset.to_tfrecords(tmpdir, from_reader=True)
+        reader2tfrecord.assert_called_once()
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_function_identity(self):
+        identity = function_identity(preprocessing_fn)
+        self.assertEqual(function_identity(preprocessing_fn), identity)
+        CONFIG.N_CLASSES = 3
+        try:
+            self.assertNotEqual(function_identity(preprocessing_fn), identity)
+        finally:
+            CONFIG.N_CLASSES = 2
+
+        def scale(factor):
+            return lambda inputs, targets: (inputs * factor, targets)
+
+        self.assertNotEqual(
+            function_identity(scale(1)), function_identity(scale(2))
+        )
+
+    def test_worker_cache_is_completed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(os.path.join(tmpdir, "records"))
+            tfrecords.reader2tfrecord(
+                make_reader(n_samples=53), n_samples_per_shard=5,
+                drop_remainder=False
+            )
+            for batch_parsing in (False, True):
+                cache_dir = os.path.join(tmpdir, f"cache_{batch_parsing}")
+                tf_dataset = tfrecords.read(
+                    batch_size=4, target_keys=["ids"], cache=cache_dir,
+                    batch_parsing=batch_parsing,
+                    input_context=tf.distribute.InputContext(
+                        num_input_pipelines=2, input_pipeline_id=0
+                    )
+                )
+                for _ in range(2):
+                    self.assertEqual(
+                        sum(1 for _ in tf_dataset), tfrecords.steps(4, 2)
+                    )
+                self.assertTrue(
+                    glob.glob(os.path.join(cache_dir, "*.index"))
+                )
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def assert_round_trip(self, n_samples_per_shard=8, **kwargs):
+        """
+        Write the samples of a reader, then check the samples read back
+        """
+        reader = make_reader()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            TFRecords(tmpdir).reader2tfrecord(
+                reader, n_samples_per_shard=n_samples_per_shard,
+                drop_remainder=False, **kwargs
+            )
+            tf_dataset = TFRecords(tmpdir).read(
+                batch_size=1, target_keys=["ids"], drop_remainder=False
+            )
+            indices = []
+            for inputs, targets in tf_dataset:
+                index = int(targets["ids"].numpy().flatten()[0])
+                np.testing.assert_array_equal(
+                    inputs["xs"][0], reader.get_sample(index)["xs"]
+                )
+                indices.append(index)
+            self.assertEqual(sorted(indices), list(range(reader.get_size())))
+
+    def test_parallel_writers(self):
+        self.assert_round_trip(n_processes=2)
+
+    def test_raw_encoding(self):
+        self.assert_round_trip(encoding="raw")
+        self.assert_round_trip(encoding="tensor")
+
+    def test_compressions(self):
+        self.assert_round_trip(compression_type="GZIP")
+        self.assert_round_trip(compression_type="ZLIB", encoding="raw")
+
+    def test_samples_per_example(self):
+        # 8 samples per shard, hence one incomplete example per shard
+        self.assert_round_trip(samples_per_example=3)
+        self.assert_round_trip(samples_per_example=4, encoding="raw")
+
+
+class RandomAccessTest(unittest.TestCase):
+
+    def test_random_access_reader(self):
+        reader = make_reader()
+        for options in (
+                {"encoding": "tensor"},
+                {"encoding": "raw"},
+                {"samples_per_example": 3}
+        ):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                TFRecords(tmpdir).reader2tfrecord(
+                    reader, n_samples_per_shard=7, drop_remainder=False,
+                    shuffle=True, seed=2, **options
+                )
+                records_reader = TFRecordsReader(tmpdir)
+                self.assertEqual(
+                    records_reader.get_size(), reader.get_size()
+                )
+                for sample in records_reader.get_samples([3, 4, 5, 48, 0]):
+                    index = int(sample["ids"].flatten()[0])
+                    np.testing.assert_array_equal(
+                        sample["xs"], reader.get_sample(index)["xs"]
+                    )
+                self.assertEqual(
+                    sorted(
+                        int(records_reader.get_sample(index)["ids"][0, 0, 0])
+                        for index in range(records_reader.get_size())
+                    ),
+                    list(range(50)),
+                    options
+                )
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_shard_size_bytes(self):
+        shard_size_bytes = 10000
+        with tempfile.TemporaryDirectory() as tmpdir:
+            TFRecords(tmpdir).reader2tfrecord(
+                make_reader(), shard_size_bytes=shard_size_bytes,
+                drop_remainder=False
+            )
+            manifest = TFRecords(tmpdir).manifest
+            shards = manifest["shards"]
+            self.assertGreater(len(shards), 1)
+            # All shards but the last one are full
+            for shard in shards[:-1]:
+                self.assertLessEqual(shard["n_bytes"], shard_size_bytes)
+                self.assertGreater(shard["n_bytes"], 0.9 * shard_size_bytes)
+            for shard in shards:
+                filepath = os.path.join(tmpdir, shard["filename"])
+                with open(filepath, "rb") as file:
+                    data = file.read()
+                self.assertEqual(shard["n_bytes"], len(data))
+                self.assertEqual(shard["crc32"], zlib.crc32(data))
+                self.assertEqual(
+                    shard["n_samples"],
+                    sum(1 for _ in tf.data.TFRecordDataset(filepath))
+                )
+            self.assertEqual(manifest["n_samples"], 50)
+            self.assertEqual(
+                manifest["n_bytes"],
+                sum(shard["n_bytes"] for shard in shards)
+            )
+
+
+class SessionsTest(unittest.TestCase):
+
+    def test_resume(self):
+        reader = make_reader()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(Exception):
+                TFRecords(tmpdir).reader2tfrecord(
+                    FailingReader(reader.patches_buffer, n_readable=23),
+                    n_samples_per_shard=10, shuffle=True, seed=3,
+                    block_size=5
+                )
+            self.assertEqual(TFRecords(tmpdir).num_samples, 20)
+            TFRecords(tmpdir).reader2tfrecord(
+                reader, n_samples_per_shard=10, resume=True, block_size=5
+            )
+            self.assertEqual(read_ids(TFRecords(tmpdir)), list(range(50)))
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            TFRecords(tmpdir).reader2tfrecord(
+                make_reader(), n_samples_per_shard=10
+            )
+            TFRecords(tmpdir).reader2tfrecord(
+                make_reader(n_samples=20), n_samples_per_shard=10,
+                append=True
+            )
+            tfrecords = TFRecords(tmpdir)
+            self.assertEqual(tfrecords.num_samples, 70)
+            self.assertEqual(
+                read_ids(tfrecords), sorted(list(range(50)) + list(range(20)))
+            )
+
+    def test_append_without_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Directory written by a former version: no manifest, no metadata
+            TFRecords(tmpdir).reader2tfrecord(
+                make_reader(n_samples=30), n_samples_per_shard=10
+            )
+            for filename in ("manifest.json", "metadata.json"):
+                os.remove(os.path.join(tmpdir, filename))
+            with open(os.path.join(tmpdir, "2.records"), "rb") as file:
+                shard_2 = file.read()
+            TFRecords(tmpdir).reader2tfrecord(
+                make_reader(n_samples=20), n_samples_per_shard=10,
+                append=True
+            )
+            tfrecords = TFRecords(tmpdir)
+            self.assertEqual(tfrecords.num_samples, 50)
+            self.assertEqual(
+                [shard["filename"] for shard in tfrecords.manifest["shards"]],
+                [f"{i}.records" for i in range(5)]
+            )
+            with open(os.path.join(tmpdir, "2.records"), "rb") as file:
+                self.assertEqual(file.read(), shard_2)
+            self.assertEqual(
+                read_ids(tfrecords), sorted(list(range(30)) + list(range(20)))
+            )
+
+    def test_append_without_manifest_compressed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            TFRecords(tmpdir).reader2tfrecord(
+                make_reader(n_samples=30), n_samples_per_shard=10,
+                compression_type="GZIP"
+            )
+            os.remove(os.path.join(tmpdir, "manifest.json"))
+            with self.assertRaises(Exception):
+                TFRecords(tmpdir).reader2tfrecord(
+                    make_reader(n_samples=20), n_samples_per_shard=10,
+                    append=True
+                )
+            self.assertEqual(
+                sorted(os.listdir(tmpdir)),
+                sorted(
+                    [f"{i}.records" for i in range(3)] +
+                    ["metadata.json", "output_shapes.json",
+                     "output_types.json"]
+                )
+            )
+
+
+class StratifyTest(unittest.TestCase):
+
+    def test_classes_mix_of_shards(self):
+        n_samples = 40
+        labels = np.repeat(np.arange(4), [20, 12, 4, 4]).astype(np.uint8)
+        reader = ArrayPatchesReader({
+            "labels": np.tile(labels[:, None, None, None], (1, 4, 4, 1)),
+            "ids": np.arange(n_samples, dtype=np.int32).reshape(
+                (-1, 1, 1, 1)
+            )
+        })
+        with tempfile.TemporaryDirectory() as tmpdir:
+            TFRecords(tmpdir).reader2tfrecord(
+                reader, n_samples_per_shard=10, stratify_key="labels"
+            )
+            records_reader = TFRecordsReader(tmpdir)
+            for first in range(0, n_samples, 10):
+                shard_labels = [
+                    int(records_reader.get_sample(index)["labels"][0, 0, 0])
+                    for index in range(first, first + 10)
+                ]
+                self.assertEqual(
+                    np.bincount(shard_labels, minlength=4).tolist(),
+                    [5, 3, 1, 1]
+                )
+
+
+class InterleaveTest(unittest.TestCase):
+
+    def test_interleaved_read(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(tmpdir)
+            tfrecords.reader2tfrecord(make_reader(), n_samples_per_shard=5)
+            self.assertEqual(
+                read_ids(tfrecords, cycle_length=4, block_length=2),
+                list(range(50))
+            )
+            self.assertEqual(
+                read_ids(
+                    tfrecords, cycle_length=4, shuffle_files=True,
+                    deterministic=False, shuffle_buffer_size=10
+                ),
+                list(range(50))
+            )
+            # Interleaving without shuffling: 2 records of each of 4 files
+            self.assertEqual(
+                read_order(
+                    tfrecords, cycle_length=4, block_length=2,
+                    deterministic=True
+                )[:8],
+                [0, 1, 5, 6, 10, 11, 15, 16]
+            )
+
+    def test_deterministic_order(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(tmpdir)
+            tfrecords.reader2tfrecord(make_reader(), n_samples_per_shard=5)
+            orders = [
+                read_order(
+                    tfrecords, cycle_length=4, block_length=2,
+                    num_parallel_calls=4, shuffle_files=True,
+                    deterministic=True, seed=seed
+                )
+                for seed in (1, 1, 2)
+            ]
+            self.assertEqual(sorted(orders[0]), list(range(50)))
+            self.assertEqual(orders[0], orders[1])
+            self.assertNotEqual(orders[0], orders[2])
+
+
+class BatchParsingTest(unittest.TestCase):
+
+    def test_batch_parsing(self):
+        reader = make_reader()
+        for encoding in ("raw", "tensor"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                tfrecords = TFRecords(tmpdir)
+                tfrecords.reader2tfrecord(
+                    reader, n_samples_per_shard=10, encoding=encoding
+                )
+                tf_dataset = tfrecords.read(
+                    batch_size=4, target_keys=["ids"], drop_remainder=False,
+                    batch_parsing=True
+                )
+                ids = []
+                for inputs, targets in tf_dataset:
+                    for xs, index in zip(
+                            inputs["xs"].numpy(),
+                            targets["ids"].numpy().flatten()
+                    ):
+                        np.testing.assert_array_equal(
+                            xs, reader.get_sample(int(index))["xs"]
+                        )
+                        ids.append(int(index))
+                self.assertEqual(sorted(ids), list(range(50)))
+
+
+class KeysTest(unittest.TestCase):
+
+    def test_read_subset_of_keys(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(tmpdir)
+            tfrecords.reader2tfrecord(make_reader(), n_samples_per_shard=10)
+            for batch_parsing in (False, True):
+                tf_dataset = tfrecords.read(
+                    batch_size=5, target_keys=["ids"], keys=["ids"],
+                    batch_parsing=batch_parsing
+                )
+                for inputs, targets in tf_dataset:
+                    self.assertEqual(inputs, {})
+                    self.assertEqual(list(targets), ["ids"])
+            example = next(iter(
+                tf.data.TFRecordDataset(os.path.join(tmpdir, "0.records"))
+            ))
+            self.assertEqual(
+                list(tfrecords.decode_example(example, keys=["xs"])), ["xs"]
+            )
+
+    def test_unknown_keys(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(tmpdir)
+            tfrecords.reader2tfrecord(make_reader(), n_samples_per_shard=10)
+            with mock.patch.object(
+                    tf.data.Dataset, "from_tensor_slices"
+            ) as from_tensor_slices:
+                with self.assertRaises(Exception):
+                    tfrecords.read(
+                        batch_size=5, target_keys=["ids"],
+                        keys=["ids", "unknown"]
+                    )
+            from_tensor_slices.assert_not_called()
+
+
+class WorkersTest(unittest.TestCase):
+
+    def test_steps_and_cardinality(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(tmpdir)
+            tfrecords.reader2tfrecord(
+                make_reader(n_samples=53), n_samples_per_shard=5,
+                drop_remainder=False
+            )
+            self.assertEqual(tfrecords.steps(4), 13)
+            self.assertEqual(tfrecords.steps(4, drop_remainder=False), 14)
+            for drop_remainder, n_batches in ((True, 13), (False, 14)):
+                tf_dataset = tfrecords.read(
+                    batch_size=4, target_keys=["ids"],
+                    drop_remainder=drop_remainder
+                )
+                self.assertEqual(int(tf_dataset.cardinality()), n_batches)
+                self.assertEqual(sum(1 for _ in tf_dataset), n_batches)
+            self.assertEqual(tfrecords.steps(4, n_workers=2), 6)
+            tf_dataset = tfrecords.read(
+                batch_size=4, target_keys=["ids"],
+                input_context=tf.distribute.InputContext(
+                    num_input_pipelines=2, input_pipeline_id=1
+                )
+            )
+            self.assertEqual(int(tf_dataset.cardinality()), 6)
+            with self.assertLogs(level="WARNING"):
+                tf_dataset = tfrecords.read(
+                    batch_size=4, target_keys=["ids"], n_workers=2
+                )
+            self.assertEqual(
+                int(tf_dataset.cardinality()),
+                int(tf.data.UNKNOWN_CARDINALITY)
+            )
+
+    def test_balancing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfrecords = TFRecords(tmpdir)
+            tfrecords.reader2tfrecord(
+                make_reader(n_samples=53), n_samples_per_shard=5,
+                drop_remainder=False
+            )
+            workers = tfrecords._workers_shards(2)
+            n_samples = [
+                sum(shard["n_samples"] for shard in worker)
+                for worker in workers
+            ]
+            self.assertEqual(sum(n_samples), 53)
+            self.assertLessEqual(max(n_samples) - min(n_samples), 5)
+            self.assertLessEqual(abs(len(workers[0]) - len(workers[1])), 1)
+            for worker in range(2):
+                tf_dataset = tfrecords.read(
+                    batch_size=4, target_keys=["ids"],
+                    input_context=tf.distribute.InputContext(
+                        num_input_pipelines=2, input_pipeline_id=worker
+                    )
+                )
+                self.assertEqual(sum(1 for _ in tf_dataset), 6)
+
+
+def saved_shards(dirpath):
+    """
+    Returns the shards directories of a `SavedDataset`
+    """
+    return glob.glob(os.path.join(dirpath, "data", "*", "*.shard"))
+
+
+class SavedDatasetTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        reader = make_reader()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            SavedDataset(tmpdir).write(reader, n_shards=3)
+            self.assertEqual(len(saved_shards(tmpdir)), 3)
+            saved_dataset = SavedDataset(tmpdir)
+            self.assertEqual(saved_dataset.num_samples, 50)
+            tf_dataset = saved_dataset.read(
+                batch_size=1, target_keys=["ids"], drop_remainder=False
+            )
+            ids = []
+            for inputs, targets in tf_dataset:
+                index = int(targets["ids"].numpy().flatten()[0])
+                np.testing.assert_array_equal(
+                    inputs["xs"][0], reader.get_sample(index)["xs"]
+                )
+                ids.append(index)
+            self.assertEqual(sorted(ids), list(range(50)))
+
+    def test_shard_func(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            SavedDataset(tmpdir).write(
+                make_reader(),
+                shard_func=lambda _, sample: tf.cast(
+                    sample["ids"][0, 0, 0] % 2, tf.int64
+                )
+            )
+            self.assertEqual(len(saved_shards(tmpdir)), 2)
+            tf_dataset = SavedDataset(tmpdir).read(
+                batch_size=5, target_keys=["ids"]
+            )
+            self.assertEqual(
+                sorted(
+                    int(index) for _, targets in tf_dataset
+                    for index in targets["ids"].numpy().flatten()
+                ),
+                list(range(50))
+            )
+
+    def test_compression(self):
+        reader = ArrayPatchesReader({
+            "xs": np.zeros((50, 32, 32, 4), dtype=np.float32)
+        })
+        sizes = {}
+        for compression in (None, "GZIP"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                SavedDataset(tmpdir).write(reader, compression=compression)
+                saved_dataset = SavedDataset(tmpdir)
+                self.assertEqual(
+                    saved_dataset.metadata["compression"], compression
+                )
+                n_samples = 0
+                for _, targets in saved_dataset.read(
+                        batch_size=10, target_keys=["xs"]
+                ):
+                    self.assertFalse(np.any(targets["xs"].numpy()))
+                    n_samples += len(targets["xs"])
+                self.assertEqual(n_samples, 50)
+                sizes[compression] = sum(
+                    os.path.getsize(os.path.join(root, filename))
+                    for root, _, filenames in os.walk(tmpdir)
+                    for filename in filenames
+                )
+        self.assertLess(sizes["GZIP"], sizes[None] / 10)
+
+    def test_keys_and_cardinality(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            SavedDataset(tmpdir).write(make_reader())
+            saved_dataset = SavedDataset(tmpdir)
+            for drop_remainder, n_batches in ((True, 12), (False, 13)):
+                tf_dataset = saved_dataset.read(
+                    batch_size=4, target_keys=["ids"], keys=["ids"],
+                    drop_remainder=drop_remainder
+                )
+                self.assertEqual(int(tf_dataset.cardinality()), n_batches)
+                n_read = 0
+                for inputs, targets in tf_dataset:
+                    self.assertEqual(inputs, {})
+                    self.assertEqual(list(targets), ["ids"])
+                    n_read += 1
+                self.assertEqual(n_read, n_batches)
+            with self.assertRaises(Exception):
+                saved_dataset.read(
+                    batch_size=4, target_keys=["ids"], keys=["unknown"]
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+from osgeo import gdal
+
+from otbtf.dataset import PatchesImagesReader
+from otbtf.utils import Window, extract_patches, gdal_open, grid_positions, \
+    iter_windows, read_patches, read_windows, retile_patches_image, \
+    write_patches_image
+
+
+class TiledGdalDataset:
+    """
+    Minimal GDAL dataset, with a configurable native blocks layout. The
+    pixels values of the band `b` are 100000 * b + 1000 * row + col
+    """
+
+    def __init__(self, height=70, width=100, n_bands=2, block=(16, 16)):
+        bands, rows, cols = np.mgrid[0:n_bands, 0:height, 0:width]
+        self.array = 100000 * bands + 1000 * rows + cols
+        self.RasterYSize, self.RasterXSize = height, width
+        self.RasterCount = n_bands
+        self.block = block
+        self.reads = []
+
+    def GetRasterBand(self, _):
+        return mock.Mock(GetBlockSize=lambda: self.block)
+
+    def ReadAsArray(self, x_off=0, y_off=0, x_size=None, y_size=None):
+        x_size = self.RasterXSize if x_size is None else x_size
+        y_size = self.RasterYSize if y_size is None else y_size
+        self.reads.append(Window(x_off, y_off, x_size, y_size))
+        return self.array[:, y_off:y_off + y_size, x_off:x_off + x_size]
+
+
+def as_image(gdal_ds, window):
+    """
+    Returns the expected content of a window, of shape (rows, cols, bands)
+    """
+    return np.transpose(gdal_ds.array[
+        :, window.y_off:window.y_off + window.y_size,
+        window.x_off:window.x_off + window.x_size
+    ], axes=(1, 2, 0))
+
+
+class WindowsTest(unittest.TestCase):
+
+    def test_windows_are_aligned_on_native_blocks(self):
+        # 40 pixels are rounded up to 3 tiles of 16 pixels
+        cores = [core for core, _ in iter_windows(
+            TiledGdalDataset(), block_size=40
+        )]
+        self.assertEqual(cores, [
+            Window(0, 0, 48, 48), Window(48, 0, 48, 48),
+            Window(96, 0, 4, 48), Window(0, 48, 48, 22),
+            Window(48, 48, 48, 22), Window(96, 48, 4, 22)
+        ])
+
+    def test_strips_windows_span_the_whole_rows(self):
+        cores = [core for core, _ in iter_windows(
+            TiledGdalDataset(block=(100, 1)), block_size=32
+        )]
+        self.assertEqual(cores, [
+            Window(0, 0, 100, 32), Window(0, 32, 100, 32),
+            Window(0, 64, 100, 6)
+        ])
+
+    def test_cores_tile_the_raster(self):
+        coverage = np.zeros((70, 100), dtype=int)
+        for core, _ in iter_windows(TiledGdalDataset(), 40, overlap=5):
+            coverage[core.y_off:core.y_off + core.y_size,
+                     core.x_off:core.x_off + core.x_size] += 1
+        np.testing.assert_array_equal(coverage, 1)
+
+    def test_overlap_is_clipped_to_the_raster(self):
+        windows = dict(iter_windows(TiledGdalDataset(), 40, overlap=5))
+        self.assertEqual(windows[Window(0, 0, 48, 48)], Window(0, 0, 53, 53))
+        self.assertEqual(
+            windows[Window(48, 0, 48, 48)], Window(43, 0, 57, 53)
+        )
+        self.assertEqual(
+            windows[Window(96, 48, 4, 22)], Window(91, 43, 9, 27)
+        )
+
+    def test_read_windows_content(self):
+        gdal_ds = TiledGdalDataset()
+        results = list(read_windows(
+            gdal_ds, block_size=40, overlap=5, dtype=np.float32
+        ))
+        self.assertEqual(
+            [(core, window) for core, window, _ in results],
+            list(iter_windows(gdal_ds, 40, overlap=5))
+        )
+        for _, window, np_arr in results:
+            self.assertEqual(np_arr.dtype, np.float32)
+            np.testing.assert_array_equal(np_arr, as_image(gdal_ds, window))
+
+    def test_read_error_is_raised_in_the_consumer(self):
+        gdal_ds = TiledGdalDataset()
+        read = gdal_ds.ReadAsArray
+
+        def failing_read(x_off, y_off, x_size, y_size):
+            if len(gdal_ds.reads) == 2:
+                raise RuntimeError("corrupted block")
+            return read(x_off, y_off, x_size, y_size)
+
+        gdal_ds.ReadAsArray = failing_read
+        windows = read_windows(gdal_ds, block_size=40)
+        self.assertEqual(len(list(zip(range(2), windows))), 2)
+        with self.assertRaisesRegex(RuntimeError, "corrupted block"):
+            next(windows)
+
+    def test_close_stops_the_read_ahead_thread(self):
+        threads = set(threading.enumerate())
+        gdal_ds = TiledGdalDataset(block=(100, 1))
+        windows = read_windows(gdal_ds, block_size=1, read_ahead=2)
+        next(windows)
+        self.assertGreater(len(set(threading.enumerate()) - threads), 0)
+        windows.close()
+        self.assertEqual(set(threading.enumerate()) - threads, set())
+        # the reader stopped at most a few windows ahead of the consumer
+        self.assertLess(len(gdal_ds.reads), 70)
+
+
+def naive_patches(np_arr, positions, patch_size):
+    """
+    Returns the patches of an image, sliced one by one
+    """
+    return np.stack([
+        np_arr[row:row + patch_size, col:col + patch_size]
+        for row, col in positions
+    ])
+
+
+class PatchesTest(unittest.TestCase):
+
+    def test_grid_positions(self):
+        positions = grid_positions(10, 7, patch_size=3, stride=2)
+        self.assertEqual(positions.tolist(), [
+            [row, col] for row in (0, 2, 4, 6) for col in (0, 2, 4)
+        ])
+        self.assertEqual(
+            grid_positions(10, 7, patch_size=3).tolist(),
+            [[row, col] for row in (0, 3, 6) for col in (0, 3)]
+        )
+
+    def test_extract_patches_equals_slicing(self):
+        np_arr = np.random.RandomState(0).rand(30, 20, 3)
+        positions = np.random.RandomState(1).randint(0, [25, 15], (50, 2))
+        np.testing.assert_array_equal(
+            extract_patches(np_arr, positions, 6),
+            naive_patches(np_arr, positions, 6)
+        )
+
+    def test_extract_patches_rejects_outside_positions(self):
+        np_arr = np.zeros((30, 20, 1))
+        for position in ([-1, 0], [0, -1], [25, 0], [0, 15]):
+            with self.assertRaises(Exception):
+                extract_patches(np_arr, [[0, 0], position], 6)
+        self.assertEqual(extract_patches(np_arr, [[24, 14]], 6).shape,
+                         (1, 6, 6, 1))
+
+    def test_read_patches_equals_slicing(self):
+        gdal_ds = TiledGdalDataset()
+        np_arr = as_image(gdal_ds, Window(0, 0, 100, 70))
+        # patches across the windows borders, in random order
+        positions = np.random.RandomState(0).randint(0, [62, 92], (200, 2))
+        patches = read_patches(gdal_ds, positions, 8, block_size=16)
+        np.testing.assert_array_equal(
+            patches, naive_patches(np_arr, positions, 8)
+        )
+        # each window is read once
+        self.assertEqual(len(gdal_ds.reads), len(set(gdal_ds.reads)))
+
+    def test_read_patches_without_positions(self):
+        patches = read_patches(
+            TiledGdalDataset(), np.zeros((0, 2)), 8, dtype=np.float32
+        )
+        self.assertEqual(patches.shape, (0, 8, 8, 2))
+
+
+def read_back(filename):
+    """
+    Returns all the patches of a patches-image, read with
+    `PatchesImagesReader`, in streaming mode and in memory
+    """
+    return [
+        np.stack([
+            sample["xs"] for sample in
+            PatchesImagesReader({"xs": [filename]}, use_streaming=streaming)
+            .get_samples(range(10))
+        ])
+        for streaming in (True, False)
+    ]
+
+
+class PatchesImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = np.random.RandomState(0).randint(
+            0, 1000, (10, 8, 8, 3)
+        ).astype(np.uint16)
+
+    def test_write_patches_image(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "patches.tif")
+            # chunks that don't divide the number of patches
+            write_patches_image(filename, self.patches, patches_per_chunk=3)
+            gdal_ds = gdal_open(filename)
+            self.assertEqual(
+                (gdal_ds.RasterXSize, gdal_ds.RasterYSize), (8, 80)
+            )
+            # one internal block is one patch
+            self.assertEqual(gdal_ds.GetRasterBand(1).GetBlockSize(), [8, 8])
+            for patches in read_back(filename):
+                np.testing.assert_array_equal(patches, self.patches)
+
+    def test_retile_patches_image(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src_filename = os.path.join(tmpdir, "src.tif")
+            src_ds = gdal.GetDriverByName("GTiff").Create(
+                src_filename, 8, 80, 3, gdal.GDT_UInt16,
+                options=["BLOCKYSIZE=3"]
+            )
+            src_ds.SetGeoTransform((10, 1, 0, 20, 0, -1))
+            for band_idx in range(3):
+                band = src_ds.GetRasterBand(band_idx + 1)
+                band.SetNoDataValue(band_idx)
+                band.WriteArray(self.patches[..., band_idx].reshape(80, 8))
+            src_ds = None  # flush
+
+            dst_filename = os.path.join(tmpdir, "dst.tif")
+            retile_patches_image(
+                src_filename, dst_filename, patches_per_chunk=3
+            )
+            gdal_ds = gdal_open(dst_filename)
+            self.assertEqual(gdal_ds.GetRasterBand(1).GetBlockSize(), [8, 8])
+            self.assertEqual(gdal_ds.GetGeoTransform(), (10, 1, 0, 20, 0, -1))
+            self.assertEqual([
+                gdal_ds.GetRasterBand(band_idx + 1).GetNoDataValue()
+                for band_idx in range(3)
+            ], [0, 1, 2])
+            for patches in read_back(dst_filename):
+                np.testing.assert_array_equal(patches, self.patches)
+
+
+if __name__ == '__main__':
+    unittest.main()
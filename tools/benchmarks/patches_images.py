@@ -0,0 +1,83 @@
+"""
+This benchmark compares the streaming random-read throughput of
+patches-images with a generic blocks layout (tiles of 256x256 pixels, or the
+GDAL default strips) and of the same patches-images rewritten so that one
+internal block is exactly one patch (`otbtf.utils.retile_patches_image()`).
+
+Usage:
+    python tools/benchmarks/patches_images.py --n_samples 20000
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal
+
+from otbtf import PatchesImagesReader
+from otbtf.utils import write_patches_image, retile_patches_image
+from synthetic import base_parser, SyntheticPatchesReader
+
+parser = base_parser(description="Benchmark of the patches-images layouts")
+parser.add_argument("--compress", type=str, default="DEFLATE")
+parser.add_argument("--n_reads", type=int, default=5000)
+
+GENERIC_LAYOUTS = {
+    "tiles 256x256": ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256"],
+    "default strips": []
+}
+
+
+def random_reads(filename: str, n_reads: int) -> float:
+    """
+    Read random patches of a patches-image, in streaming mode
+
+    Params:
+        filename: patches-image
+        n_reads: number of patches to read
+
+    Returns:
+        number of patches per second
+
+    """
+    reader = PatchesImagesReader(
+        filenames_dict={"input_xs_patches": [filename]}, use_streaming=True
+    )
+    rng = np.random.default_rng(0)
+    indices = rng.integers(reader.get_size(), size=n_reads)
+    start = time.perf_counter()
+    for index in indices:
+        reader.get_sample(index=int(index))
+    return n_reads / (time.perf_counter() - start)
+
+
+def benchmark(params):
+    """
+    Run the benchmark.
+
+    """
+    reader = SyntheticPatchesReader(
+        n_samples=params.n_samples,
+        patch_size=params.patch_size,
+        n_bands=params.n_bands
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        reference = os.path.join(tmpdir, "reference.tif")
+        write_patches_image(reference, reader.xs, compress=params.compress)
+        for layout, options in GENERIC_LAYOUTS.items():
+            generic = os.path.join(tmpdir, "generic.tif")
+            gdal.Translate(
+                generic, reference,
+                creationOptions=options + [f"COMPRESS={params.compress}"]
+            )
+            retiled = os.path.join(tmpdir, "retiled.tif")
+            retile_patches_image(generic, retiled, compress=params.compress)
+            for name, filename in (("generic", generic), ("retiled", retiled)):
+                print(
+                    f"{layout}, {name}: "
+                    f"{random_reads(filename, params.n_reads):.0f} patches/s"
+                )
+
+
+if __name__ == "__main__":
+    benchmark(parser.parse_args())
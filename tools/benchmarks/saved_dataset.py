@@ -0,0 +1,62 @@
+"""
+This benchmark compares the reading throughput of the TFRecords (with the
+"tensor" and "raw" encodings) and of the datasets saved in the TensorFlow
+native format (`tf.data.Dataset.save`).
+
+Usage:
+    python tools/benchmarks/saved_dataset.py --n_samples 100000
+"""
+import os
+import tempfile
+
+from otbtf import TFRecords, SavedDataset
+from synthetic import base_parser, SyntheticPatchesReader, throughput
+
+parser = base_parser(description="Benchmark of the saved datasets")
+parser.add_argument("--n_shards", type=int, default=8)
+
+
+def benchmark(params):
+    """
+    Run the benchmark.
+
+    """
+    reader = SyntheticPatchesReader(
+        n_samples=params.n_samples,
+        patch_size=params.patch_size,
+        n_bands=params.n_bands
+    )
+    kwargs = {
+        "batch_size": params.batch_size,
+        "target_keys": ["labels_patches"]
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for encoding in ("tensor", "raw"):
+            outdir = os.path.join(tmpdir, encoding)
+            TFRecords(outdir).reader2tfrecord(
+                reader,
+                n_samples_per_shard=params.n_samples_per_shard,
+                encoding=encoding
+            )
+            tf_dataset = TFRecords(outdir).read(
+                batch_parsing=encoding == "raw", cycle_length=params.n_shards,
+                **kwargs
+            )
+            print(
+                f"TFRecords, encoding \"{encoding}\": "
+                f"{throughput(tf_dataset, params.n_epochs):.0f} samples/s"
+            )
+        for compression in (None, "SNAPPY"):
+            outdir = os.path.join(tmpdir, f"saved_{compression}")
+            SavedDataset(outdir).write(
+                reader, n_shards=params.n_shards, compression=compression
+            )
+            tf_dataset = SavedDataset(outdir).read(**kwargs)
+            print(
+                f"Saved dataset, compression {compression}: "
+                f"{throughput(tf_dataset, params.n_epochs):.0f} samples/s"
+            )
+
+
+if __name__ == "__main__":
+    benchmark(parser.parse_args())
@@ -0,0 +1,94 @@
+"""
+Synthetic patches, used to benchmark the otbtf datasets without depending on
+real patches-images.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from otbtf.dataset import PatchesReaderBase
+
+
+def base_parser(description: str) -> argparse.ArgumentParser:
+    """
+    Create a parser with the base parameters for the benchmarks
+
+    Params:
+        description: description of the benchmark
+
+    Returns:
+        argparse.ArgumentParser instance
+
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--n_samples", type=int, default=10000)
+    parser.add_argument("--patch_size", type=int, default=16)
+    parser.add_argument("--n_bands", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--n_samples_per_shard", type=int, default=1000)
+    parser.add_argument("--n_epochs", type=int, default=3)
+    return parser
+
+
+class SyntheticPatchesReader(PatchesReaderBase):
+    """
+    Delivers random uint16 patches ("input_xs_patches") and uint8 labels
+    ("labels_patches"), kept in memory.
+    """
+
+    def __init__(self, n_samples: int, patch_size: int, n_bands: int):
+        """
+        Params:
+            n_samples: number of samples
+            patch_size: patches size, in pixels
+            n_bands: number of bands of the input patches
+
+        """
+        rng = np.random.default_rng(42)
+        self.xs = rng.integers(
+            0, 10000, size=(n_samples, patch_size, patch_size, n_bands),
+            dtype=np.uint16
+        )
+        self.labels = rng.integers(
+            0, 2, size=(n_samples, 1, 1, 1), dtype=np.uint8
+        )
+
+    def get_sample(self, index: int) -> dict:
+        return {
+            "input_xs_patches": self.xs[index],
+            "labels_patches": self.labels[index]
+        }
+
+    def get_stats(self) -> dict:
+        return self._get_stats_sample_by_sample(
+            keys=["input_xs_patches", "labels_patches"]
+        )
+
+    def get_size(self) -> int:
+        return len(self.xs)
+
+
+def throughput(tf_dataset, n_epochs: int) -> float:
+    """
+    Iterate over a TF dataset, and measure its throughput. The first epoch is
+    used as a warm up, and is not measured.
+
+    Params:
+        tf_dataset: batched TF dataset delivering (inputs, targets) tuples
+        n_epochs: number of measured epochs
+
+    Returns:
+        number of samples per second
+
+    """
+    def _epoch():
+        n_samples = 0
+        for inputs, _ in tf_dataset:
+            n_samples += int(next(iter(inputs.values())).shape[0])
+        return n_samples
+
+    _epoch()
+    start = time.perf_counter()
+    n_samples = sum(_epoch() for _ in range(n_epochs))
+    return n_samples / (time.perf_counter() - start)
@@ -0,0 +1,51 @@
+"""
+This benchmark compares the parsing throughput of TFRecords written with the
+"tensor" encoding (serialized `TensorProto`) and the "raw" encoding (raw
+contiguous bytes), parsed sample by sample or by batches.
+
+Usage:
+    python tools/benchmarks/tfrecords_encoding.py --n_samples 100000
+"""
+import os
+import tempfile
+
+from otbtf import Dataset, TFRecords
+from synthetic import base_parser, SyntheticPatchesReader, throughput
+
+parser = base_parser(description="Benchmark of the TFRecords encodings")
+
+
+def benchmark(params):
+    """
+    Run the benchmark.
+
+    """
+    reader = SyntheticPatchesReader(
+        n_samples=params.n_samples,
+        patch_size=params.patch_size,
+        n_bands=params.n_bands
+    )
+    dataset = Dataset(patches_reader=reader)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for encoding in ("tensor", "raw"):
+            outdir = os.path.join(tmpdir, encoding)
+            dataset.to_tfrecords(
+                output_dir=outdir,
+                n_samples_per_shard=params.n_samples_per_shard,
+                encoding=encoding
+            )
+            for batch_parsing in (False, True):
+                tf_dataset = TFRecords(outdir).read(
+                    batch_size=params.batch_size,
+                    target_keys=["labels_patches"],
+                    batch_parsing=batch_parsing
+                )
+                print(
+                    f"Encoding \"{encoding}\", batch parsing "
+                    f"{batch_parsing}: "
+                    f"{throughput(tf_dataset, params.n_epochs):.0f} samples/s"
+                )
+
+
+if __name__ == "__main__":
+    benchmark(parser.parse_args())